@@ -0,0 +1,254 @@
+'''
+ASGI entry point which serves the routes of server.APP on an asyncio loop,
+e.g. with uvicorn (which is not needed for anything else):
+
+    cd src && uvicorn asgi:app
+
+Each request is handed to APP as a WSGI call, so the routes, the error
+handling of defaultHandler and the static files are the same as with
+server.py. The connections are held by the loop rather than by a thread
+each, and only their I/O is done on it. GET requests only read data.data,
+but they can wait for the lock of a channel or read many messages (e.g.
+/search with a short query), so they are run on one of READ_WORKERS threads.
+Every other request can wait for WRITE_LOCK or for the network (e.g.
+/user/profile/uploadphoto), so it is run on one of WRITE_WORKERS threads,
+which reads never queue behind.
+
+/channel/events is streamed by the loop too: each stream subscribes to the
+events of its channel (see events.py), so waiting for events takes no
+thread either. Its checks of the user are run on the read threads.
+'''
+import io
+import os
+import sys
+import asyncio
+from urllib.parse import parse_qsl
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+from server import APP
+from events import bus, format_event, format_events, EVENT_KEEPALIVE
+import channel
+import persistence
+
+# writes are applied one at a time (see persistence.WRITE_LOCK), so a few
+# threads are enough to keep the loop free while they wait
+WRITE_WORKERS = 4
+
+# reads run side by side, only a channel at a time is locked
+READ_WORKERS = 16
+
+_executor = ThreadPoolExecutor(max_workers=WRITE_WORKERS)
+_read_executor = ThreadPoolExecutor(max_workers=READ_WORKERS)
+
+def build_environ(scope, body):
+    '''
+    Return the WSGI environ of the ASGI http scope and request body
+    '''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def call_app(environ):
+    '''
+    Run APP on the environ. Return the status, headers and body it answered
+    with.
+    '''
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                               for name, value in headers]
+
+    result = APP.wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return response['status'], response['headers'], body
+
+async def read_body(receive):
+    '''
+    Return the whole body of the request
+    '''
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+async def lifespan(receive, send):
+    '''
+    Open the store when the server starts, as server.py does, and close it
+    when the server stops
+    '''
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if APP.config["PERSISTENCE_DIR"]:
+                persistence.open_store(APP.config["PERSISTENCE_DIR"])
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            persistence.close_store()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def wait_for_disconnect(receive):
+    '''
+    Return once the client has gone
+    '''
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+def open_subscription(token, channel_id, cursor, callback):
+    '''
+    Check the user can see the channel, then subscribe the callback to its
+    events. Return the subscription and the channel_events result after the
+    cursor, with the events published while it was subscribed.
+    '''
+    result = channel.channel_events(token, channel_id, cursor)
+    subscription = bus.subscribe(channel_id, callback)
+    events, cursor, is_complete = bus.get_events(channel_id, result['cursor'])
+    return subscription, dict(result, events=result['events'] + events, cursor=cursor,
+                              is_complete=result['is_complete'] and is_complete)
+
+async def stream_events(scope, receive, send, environ):
+    '''
+    Answer /channel/events: send the events of the channel as they are
+    published, until the client goes or can no longer see the channel
+    '''
+    params = dict(parse_qsl(environ['QUERY_STRING']))
+    cursor = environ.get('HTTP_LAST_EVENT_ID', params.get('cursor'))
+    try:
+        token = params.get('token')
+        channel_id = int(params.get('channel_id'))
+        cursor = None if cursor is None else int(cursor)
+    except (TypeError, ValueError):
+        channel_id = None
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    def callback(event):
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    subscription = None
+    try:
+        try:
+            if channel_id is None:
+                raise ValueError('invalid parameters')
+            # the channel is only subscribed to once the user is known to
+            # see it, so that bad requests leave nothing behind on the bus
+            subscription, result = await loop.run_in_executor(
+                _read_executor, open_subscription, token, channel_id, cursor, callback)
+        except (HTTPException, ValueError):
+            # let APP answer with the error, as server.py does
+            status, headers, body = await loop.run_in_executor(_read_executor, call_app, environ)
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+        ]})
+        await send({'type': 'http.response.body', 'body': format_events(result).encode('utf-8'),
+                    'more_body': True})
+        cursor = result['cursor']
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=EVENT_KEEPALIVE,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                getter.cancel()
+                return
+            if getter in done:
+                event = getter.result()
+                if event['cursor'] <= cursor:
+                    continue
+                chunk = format_event(event)
+                cursor = event['cursor']
+            else:
+                getter.cancel()
+                # check the user can still see the channel
+                try:
+                    if subscription is not None and bus.find_channel(channel_id) is subscription:
+                        result = await loop.run_in_executor(
+                            _read_executor, channel.channel_events, token, channel_id, cursor)
+                    else:
+                        # the events were cleared since the stream started,
+                        # tell the client to reload and follow the new ones
+                        subscription, result = await loop.run_in_executor(
+                            _read_executor, open_subscription, token, channel_id, None, callback)
+                        result = dict(result, is_complete=False)
+                except HTTPException:
+                    break
+                chunk = format_events(result)
+                cursor = result['cursor']
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'),
+                        'more_body': True})
+        disconnected.cancel()
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if subscription is not None:
+            bus.unsubscribe(channel_id, callback)
+
+async def app(scope, receive, send):
+    '''
+    The ASGI application
+    '''
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    environ = build_environ(scope, await read_body(receive))
+    if scope['method'] == 'GET' and scope['path'] == '/channel/events':
+        await stream_events(scope, receive, send, environ)
+        return
+    loop = asyncio.get_running_loop()
+    executor = _read_executor if scope['method'] == 'GET' else _executor
+    status, headers, body = await loop.run_in_executor(executor, call_app, environ)
+
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('asgi.py needs uvicorn to be installed (pip install uvicorn)')
+    uvicorn.run(app, host='127.0.0.1', port=int(os.environ.get('PORT', '8000')))
@@ -7,6 +7,7 @@ import smtplib
 import random
 import string
 from helper import authorise
+from persistence import persist
 
 def auth_login(email, password):
     '''
@@ -48,9 +49,19 @@ def auth_login(email, password):
 
     return {
         'u_id': u_id,
-        'token': User.generate_token(u_id),
+        'token': open_session(u_id),
     }
 
+@persist
+def open_session(u_id):
+    '''
+    Return the token of the user with the passed in u_id, opening a session
+    for it. Logged instead of auth_login so that passwords never reach the
+    write-ahead log.
+    '''
+    return User.generate_token(u_id)
+
+@persist
 @authorise
 def auth_logout(token):
     '''
@@ -96,25 +107,40 @@ def auth_register(email, password, name_first, name_last):
     '''
     # Check email
     User.check_email_format(email)
-    User.check_email_repeated(email)
 
     # Check password
     User.check_password(password)
 
-    # check if the lengths of first name and last name are in the range 1 ~ 50 
+    return add_user(email, User.encrypt_password(password), name_first, name_last)
+
+@persist
+def add_user(email, password, name_first, name_last):
+    '''
+    Create the account of a user with an already encrypted password, and
+    open a session for them.
+    Logged instead of auth_register so that passwords never reach the
+    write-ahead log. The email and names are checked here, under the
+    WRITE_LOCK taken by @persist, so that two registrations with the same
+    email cannot both pass the check.
+    '''
+    # Check email
+    User.check_email_format(email)
+    User.check_email_repeated(email)
+
+    # check if the lengths of first name and last name are in the range 1 ~ 50
     User.check_name_first(name_first)
     User.check_name_last(name_last)
 
     new_user = User(
         email=email,
-        password=User.encrypt_password(password),
+        password=password,
         name_first=name_first,
         name_last=name_last,
         handle_str=User.generate_handle(name_first, name_last),
     )
 
-    # the u_id is generated based on the number of existing users
-    u_id = len(data['users'])
+    # the u_id is handed out by the id allocator, starting from 0
+    u_id = data['ids'].allocate('users')
     new_user.set_u_id(u_id)
 
     # setting the permission_id
@@ -124,7 +150,7 @@ def auth_register(email, password, name_first, name_last):
         permission_id = 2
     new_user.set_permission_id(permission_id)
     
-    data['users'].append(new_user)
+    User.add_user(new_user)
 
     return {
         'u_id': u_id,
@@ -148,21 +174,22 @@ def auth_passwordreset_request(email):
     if isinstance(email, str) is False:
         raise InputError(description='Email is not a string')
 
-    # Generate reset code and confirm it is unique
+    # Generate reset code and confirm it is unique. Only its hash is kept,
+    # as for passwords, so that the code never reaches the write-ahead log
     resetcode = ''.join(random.choice(string.ascii_uppercase+string.digits) for _ in range(6))
-    User.check_resetcode_is_unique(resetcode)
+    User.check_resetcode_is_unique(User.encrypt_password(resetcode))
 
     # Check email is a registered user
     email_valid = False
     for user in data['users']:
         if email == user.get_email():
-            # Give registered user the reset code
-            user.set_reset_code(resetcode)
             name = user.get_name_first()
             email_valid = True
-            assert(resetcode == user.get_reset_code())
     if email_valid is False:
         raise InputError(description='Email is not valid')
+
+    # Give registered user the reset code
+    set_reset_code(email, User.encrypt_password(resetcode))
     
     # Create message, sender and receiver
     message = f'''
@@ -201,12 +228,14 @@ def auth_passwordreset_reset(reset_code, new_password):
     output format:
     {}
     '''
-    # Check that reset_code is valid
+    # Check that reset_code is valid, by its hash
     reset_code_is_valid = False
-    for user in data['users']:
-        if user.get_reset_code() == reset_code:
-            reset_code_is_valid = True
-            target = user
+    if isinstance(reset_code, str):
+        reset_code_hash = User.encrypt_password(reset_code)
+        for user in data['users']:
+            if user.get_reset_code() == reset_code_hash:
+                reset_code_is_valid = True
+                target = user
     
     if reset_code_is_valid == False:
         raise InputError(description='Reset Code is not valid')
@@ -214,7 +243,30 @@ def auth_passwordreset_reset(reset_code, new_password):
     # Check that password is valid
     User.check_password(new_password)
 
-    # Set new password
-    target.set_password(User.encrypt_password(new_password))
+    # Set new password, which uses up the reset code
+    set_password(target.get_u_id(), User.encrypt_password(new_password))
 
     return {}
+
+@persist
+def set_reset_code(email, reset_code):
+    '''
+    Give the user registered with the passed in email the hash of a reset
+    code. Logged instead of auth_passwordreset_request, which picks the code
+    at random and sends an email.
+    '''
+    for user in data['users']:
+        if email == user.get_email():
+            user.set_reset_code(reset_code)
+
+@persist
+def set_password(u_id, password):
+    '''
+    Replace the password of the user by an already encrypted password, and
+    clear the reset code it was set with so that it can not be used again.
+    Logged instead of auth_passwordreset_reset so that passwords never reach
+    the write-ahead log.
+    '''
+    user = data['users'][User.find_user(u_id)]
+    user.set_password(password)
+    user.set_reset_code(None)
@@ -1,10 +1,11 @@
 import sys
 sys.path.append('../')
 from auth import auth_register, auth_logout
-from channel import channel_invite, channel_details, channel_messages, channel_leave, channel_join, channel_addowner, channel_removeowner
+from channel import channel_invite, channel_details, channel_messages, channel_leave, channel_join, channel_addowner, channel_removeowner, channel_events, channel_sync, channel_pinned
 from channels import channels_create
 from error import InputError, AccessError
-from message import message_send
+from message import message_send, message_remove, message_edit, message_react, message_unreact, message_pin, message_unpin, message_sendlater
+from datetime import datetime, timezone
 from pytest import raises
 from other import clear
 
@@ -262,6 +263,47 @@ def test_channel_message_end_not_equal_to_minus1():
 	assert result['start'] == 0
 	assert result['end'] == 50
 
+def test_channel_message_last_page():
+	''' 
+	test if the last page holds the least recent messages, most recent first
+	'''
+	# clear data
+	clear()
+	
+	# initiate data
+	user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user['token'], 'COMP6080', False)
+	for i in range(0,120):
+		message_send(user['token'], channel['channel_id'], "Hello world!" + str(i))
+	
+	result = channel_messages(user['token'], channel['channel_id'], 100)
+	# check result
+	assert len(result['messages']) == 20
+	assert result['messages'][0]['message'] == "Hello world!19"
+	assert result['messages'][-1]['message'] == "Hello world!0"
+	assert result['start'] == 100
+	assert result['end'] == -1
+
+def test_channel_message_removed_message():
+	''' 
+	test if a removed message is no longer returned by channel_messages
+	'''
+	# clear data
+	clear()
+	
+	# initiate data
+	user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user['token'], 'COMP6080', False)
+	message1 = message_send(user['token'], channel['channel_id'], "Hello")
+	message2 = message_send(user['token'], channel['channel_id'], "World")
+	message_remove(user['token'], message2['message_id'])
+	
+	result = channel_messages(user['token'], channel['channel_id'], 0)
+	# check result
+	assert len(result['messages']) == 1
+	assert result['messages'][0]['message_id'] == message1['message_id']
+	assert result['end'] == -1
+
 def test_channel_leave():
 	'''
 	test if channel_leave can correctly work
@@ -718,4 +760,258 @@ def test_channel_removeowner_invalid_token2():
 
 	# check if it will raise AccessError when token is invalid
 	with raises(AccessError):
-		channel_removeowner(user1['token'], channel['channel_id'], user2['u_id'])	
\ No newline at end of file
+		channel_removeowner(user1['token'], channel['channel_id'], user2['u_id'])	
+
+
+def test_channel_events_regular():
+	'''
+	test if channel_events returns the changes made to the channel in order,
+	and only the ones after the cursor
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+	start = channel_events(user1['token'], channel['channel_id'])
+	assert start['events'] == []
+
+	message = message_send(user1['token'], channel['channel_id'], 'Hello')
+	message_edit(user1['token'], message['message_id'], 'Hello world')
+	message_react(user1['token'], message['message_id'], 1)
+	message_pin(user1['token'], message['message_id'])
+	message_remove(user1['token'], message['message_id'])
+
+	result = channel_events(user1['token'], channel['channel_id'], start['cursor'])
+	assert [event['type'] for event in result['events']] == [
+		'message_sent',
+		'message_edited',
+		'message_reacted',
+		'message_pinned',
+		'message_removed',
+	]
+	assert all(event['message_id'] == message['message_id'] for event in result['events'])
+	assert result['events'][1]['message'] == 'Hello world'
+	assert result['events'][2]['u_id'] == user1['u_id']
+	assert result['is_complete'] == True
+	assert result['cursor'] == result['events'][-1]['cursor']
+
+	# resume from the cursor of an event
+	resumed = channel_events(user1['token'], channel['channel_id'], result['events'][2]['cursor'])
+	assert resumed['events'] == result['events'][3:]
+
+	# nothing new since the last cursor
+	latest = channel_events(user1['token'], channel['channel_id'], result['cursor'])
+	assert latest['events'] == []
+	assert latest['cursor'] == result['cursor']
+
+def test_channel_events_not_member():
+	'''
+	test if channel_events raises AccessError for a user outside the channel
+	and InputError for an invalid channel
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+
+	with raises(AccessError):
+		channel_events(user2['token'], channel['channel_id'])
+	with raises(InputError):
+		channel_events(user1['token'], channel['channel_id'] + 1)
+
+def test_channel_events_after_clear():
+	'''
+	test if a cursor handed out before the data was cleared is told the
+	events are not complete, and gets the cursor to resume from
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+	message_send(user1['token'], channel['channel_id'], 'Hello')
+	message_send(user1['token'], channel['channel_id'], 'World')
+	old = channel_events(user1['token'], channel['channel_id'], 0)
+
+	clear()
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+	message_send(user1['token'], channel['channel_id'], 'Hi')
+
+	result = channel_events(user1['token'], channel['channel_id'], old['cursor'])
+	assert result['events'] == []
+	assert result['is_complete'] == False
+	assert result['cursor'] < old['cursor']
+
+	# the events after the reset are read from the cursor returned
+	message_send(user1['token'], channel['channel_id'], 'Again')
+	result = channel_events(user1['token'], channel['channel_id'], result['cursor'])
+	assert [event['message'] for event in result['events']] == ['Again']
+	assert result['is_complete'] == True
+
+
+def test_channel_sync_cursor():
+	'''
+	test if channel_sync pages through the messages before and after a
+	message, and the pages do not move when messages are sent
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+	message_ids = [message_send(user1['token'], channel['channel_id'], str(i))['message_id']
+		for i in range(120)]
+
+	# the most recent messages, oldest first
+	result = channel_sync(user1['token'], channel['channel_id'])
+	assert [message['message_id'] for message in result['messages']] == message_ids[70:]
+	assert result['has_more'] == True
+
+	# a new message does not move the page before a message
+	message_send(user1['token'], channel['channel_id'], 'new')
+	result = channel_sync(user1['token'], channel['channel_id'], before=message_ids[70])
+	assert [message['message_id'] for message in result['messages']] == message_ids[20:70]
+	assert result['has_more'] == True
+	result = channel_sync(user1['token'], channel['channel_id'], before=message_ids[20])
+	assert [message['message_id'] for message in result['messages']] == message_ids[:20]
+	assert result['has_more'] == False
+
+	result = channel_sync(user1['token'], channel['channel_id'], after=message_ids[100])
+	assert [message['message'] for message in result['messages']] == [str(i) for i in range(101, 120)] + ['new']
+	assert result['has_more'] == False
+
+def test_channel_sync_since_version():
+	'''
+	test if channel_sync returns the messages changed since a version, once
+	each, with the removed ones marked
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+	message1 = message_send(user1['token'], channel['channel_id'], 'Hello')
+	message2 = message_send(user1['token'], channel['channel_id'], 'World')
+	version = channel_sync(user1['token'], channel['channel_id'])['version']
+
+	# nothing has changed yet
+	result = channel_sync(user1['token'], channel['channel_id'], since_version=version)
+	assert result == {'messages': [], 'version': version, 'has_more': False, 'is_complete': True}
+
+	message_react(user1['token'], message2['message_id'], 1)
+	message_edit(user1['token'], message1['message_id'], 'Hi')
+	message_unreact(user1['token'], message2['message_id'], 1)
+	message_react(user1['token'], message2['message_id'], 1)
+	message3 = message_send(user1['token'], channel['channel_id'], 'Bye')
+	message_remove(user1['token'], message3['message_id'])
+
+	result = channel_sync(user1['token'], channel['channel_id'], since_version=version)
+	assert result['messages'][0]['message'] == 'Hi'
+	assert result['messages'][1]['reacts'] == [{'react_id': 1, 'u_ids': [user1['u_id']], 'is_this_user_reacted': True}]
+	assert result['messages'][2] == {'message_id': message3['message_id'], 'is_removed': True}
+	assert result['has_more'] == False
+
+	# the version returned is where the next sync starts
+	message_pin(user1['token'], message1['message_id'])
+	result = channel_sync(user1['token'], channel['channel_id'], since_version=result['version'])
+	assert [(message['message_id'], message['is_pinned']) for message in result['messages']] == [(message1['message_id'], True)]
+
+def test_channel_sync_since_version_sendlater():
+	'''
+	test if a message sent later is left out of channel_sync until it is
+	delivered, even once it has been changed
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+	version = channel_sync(user1['token'], channel['channel_id'])['version']
+	time_sent = int(datetime.now(timezone.utc).timestamp()) + 100
+	message = message_sendlater(user1['token'], channel['channel_id'], 'Hello', time_sent)
+	message_pin(user1['token'], message['message_id'])
+
+	result = channel_sync(user1['token'], channel['channel_id'], since_version=version)
+	assert result['messages'] == []
+	assert result['has_more'] == False
+	assert result['is_complete'] == True
+
+def test_channel_sync_invalid():
+	'''
+	test if channel_sync raises InputError for a cursor from another channel
+	or several cursors, and AccessError for a user outside the channel
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+	channel1 = channels_create(user1['token'], 'COMP1531', True)
+	channel2 = channels_create(user1['token'], 'COMP2521', True)
+	message = message_send(user1['token'], channel2['channel_id'], 'Hello')
+
+	with raises(InputError):
+		channel_sync(user1['token'], channel1['channel_id'], before=message['message_id'])
+	with raises(InputError):
+		channel_sync(user1['token'], channel1['channel_id'], before=message['message_id'] + 1)
+	with raises(InputError):
+		channel_sync(user1['token'], channel2['channel_id'], after=message['message_id'], since_version=0)
+	with raises(AccessError):
+		channel_sync(user2['token'], channel1['channel_id'])
+
+
+def test_channel_pinned_regular():
+	'''
+	test if channel_pinned returns the pinned messages of the channel oldest
+	first, following pins, unpins and removals
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+	message_ids = [message_send(user1['token'], channel['channel_id'], text)['message_id']
+		for text in ['Hello', 'World', 'Bye']]
+	assert channel_pinned(user1['token'], channel['channel_id']) == {'messages': []}
+
+	message_pin(user1['token'], message_ids[2])
+	message_pin(user1['token'], message_ids[0])
+	message_pin(user1['token'], message_ids[1])
+	result = channel_pinned(user1['token'], channel['channel_id'])
+	assert [message['message_id'] for message in result['messages']] == message_ids
+	assert all(message['is_pinned'] for message in result['messages'])
+
+	message_unpin(user1['token'], message_ids[1])
+	message_remove(user1['token'], message_ids[2])
+	result = channel_pinned(user1['token'], channel['channel_id'])
+	assert [message['message'] for message in result['messages']] == ['Hello']
+
+def test_channel_pinned_not_member():
+	'''
+	test if channel_pinned raises AccessError for a user outside the channel
+	and InputError for an invalid channel
+	'''
+	# clear data
+	clear()
+
+	# initiate data
+	user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+	user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+	channel = channels_create(user1['token'], 'COMP1531', True)
+
+	with raises(AccessError):
+		channel_pinned(user2['token'], channel['channel_id'])
+	with raises(InputError):
+		channel_pinned(user1['token'], channel['channel_id'] + 1)
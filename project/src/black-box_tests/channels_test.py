@@ -1,7 +1,7 @@
 import sys
 sys.path.append('../')
 from channels import channels_list, channels_listall, channels_create
-from channel import channel_invite
+from channel import channel_invite, channel_join, channel_leave
 from pytest import raises
 from auth import auth_register, auth_logout
 from error import InputError, AccessError
@@ -47,6 +47,33 @@ def test_channels_list():
 	}
 	assert channels_list(user3['token']) == exp_result4
 
+def test_channels_list_after_join_and_leave():
+	clear()
+
+	# initiate data
+	user1 = auth_register('h.smith@gmail.com', '12345678', 'Hadise', 'Smith')
+	user2 = auth_register('t.zhang@gmail.com', '87654321', 'Tom', 'Zhang')
+	channel1 = channels_create(user1['token'], 'LOL', True)
+	channel2 = channels_create(user1['token'], 'WOW', True)
+	channel_join(user2['token'], channel2['channel_id'])
+	channel_join(user2['token'], channel1['channel_id'])
+
+	exp_result1 = {
+		'channels': [
+			{'channel_id': channel1["channel_id"], 'name': 'LOL'},            
+			{'channel_id': channel2["channel_id"], 'name': 'WOW'},    
+		]
+	}
+	assert channels_list(user2['token']) == exp_result1
+
+	channel_leave(user2['token'], channel1['channel_id'])
+	exp_result2 = {
+		'channels': [
+			{'channel_id': channel2["channel_id"], 'name': 'WOW'},    
+		]
+	}
+	assert channels_list(user2['token']) == exp_result2
+
 def test_channels_listall():
 	clear()
 
@@ -4,12 +4,12 @@
 import sys
 sys.path.append('../')
 from pytest import raises
-from message import message_send, message_remove, message_edit, message_react, message_unreact, message_sendlater, message_pin, message_unpin
+from message import message_send, message_remove, message_edit, message_react, message_unreact, message_sendlater, message_pin, message_unpin, message_sendbatch
 from channels import channels_create
 from auth import auth_register, auth_logout
 from error import InputError, AccessError
 from other import clear, search
-from channel import channel_join, channel_leave, channel_invite
+from channel import channel_join, channel_leave, channel_invite, channel_messages
 from datetime import datetime, timezone
 import time
 
@@ -471,7 +471,7 @@ def test_message_react_invalid_react_id():
     message = message_send(user['token'], channel['channel_id'], 'Hello')
 
     # check if an InputError is raised if react_id is invalid
-    invalid_react_id = 2
+    invalid_react_id = 0
     with raises(InputError):
         message_react(user['token'], message['message_id'], invalid_react_id)
 
@@ -625,7 +625,7 @@ def test_message_unreact_invalid_react_id():
     message_react(user['token'], message['message_id'], 1) 
 
     # check if an InputError is raised if react_id is invalid
-    invalid_react_id = 2
+    invalid_react_id = 0
     with raises(InputError):
         message_unreact(user['token'], message['message_id'], invalid_react_id)
 
@@ -1145,3 +1145,129 @@ def test_message_unpin_invalid_token2():
     # check if it will raise AccessError when token is invalid
     with raises(AccessError):
         message_unpin(user['token'], message['message_id'])
+
+def test_message_sendbatch_regular():
+    '''
+    Test if message_sendbatch sends every message to its channel and returns
+    their message_ids in order
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel1 = channels_create(user['token'], 'COMP1531', False)
+    channel2 = channels_create(user['token'], 'COMP2521', False)
+
+    result = message_sendbatch(user['token'], [
+        {'channel_id': channel1['channel_id'], 'message': 'Hello'},
+        {'channel_id': channel2['channel_id'], 'message': 'Hi'},
+        {'channel_id': channel1['channel_id'], 'message': 'World'},
+    ])
+    assert len(set(result['message_ids'])) == 3
+
+    messages = channel_messages(user['token'], channel1['channel_id'], 0)['messages']
+    assert [(message['message_id'], message['message']) for message in messages] == [
+        (result['message_ids'][2], 'World'),
+        (result['message_ids'][0], 'Hello'),
+    ]
+    messages = channel_messages(user['token'], channel2['channel_id'], 0)['messages']
+    assert [message['message_id'] for message in messages] == [result['message_ids'][1]]
+
+    # the ids of later messages follow the block
+    message = message_send(user['token'], channel2['channel_id'], 'Bye')
+    assert message['message_id'] not in result['message_ids']
+
+def test_message_sendbatch_invalid():
+    '''
+    Test if no message is sent when one of them is invalid or is sent to a
+    channel the user has not joined
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel1 = channels_create(user1['token'], 'COMP1531', True)
+    channel2 = channels_create(user2['token'], 'COMP2521', False)
+
+    with raises(InputError):
+        message_sendbatch(user1['token'], [
+            {'channel_id': channel1['channel_id'], 'message': 'Hello'},
+            {'channel_id': channel1['channel_id'], 'message': 'a' * 1001},
+        ])
+    with raises(InputError):
+        message_sendbatch(user1['token'], [
+            {'channel_id': channel1['channel_id'], 'message': 'Hello'},
+            {'channel_id': channel2['channel_id'] + 1, 'message': 'Hello'},
+        ])
+    with raises(AccessError):
+        message_sendbatch(user2['token'], [
+            {'channel_id': channel2['channel_id'], 'message': 'Hello'},
+            {'channel_id': channel1['channel_id'], 'message': 'Hello'},
+        ])
+    with raises(AccessError):
+        message_sendbatch("ThisIsAnInvalidToken", [])
+
+    assert channel_messages(user1['token'], channel1['channel_id'], 0)['messages'] == []
+    assert channel_messages(user2['token'], channel2['channel_id'], 0)['messages'] == []
+
+def test_message_sendbatch_malformed():
+    '''
+    Test if InputError is raised, and no message is sent, when the messages
+    are not a list of {channel_id, message}
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    valid = {'channel_id': channel['channel_id'], 'message': 'Hello'}
+
+    for messages in [
+            None,
+            {'channel_id': channel['channel_id'], 'message': 'Hello'},
+            [valid, {'channel_id': channel['channel_id']}],
+            [valid, {'message': 'Hello'}],
+            [valid, 'x'],
+            [valid, {'channel_id': channel['channel_id'], 'message': 1531}],
+            [valid, {'channel_id': str(channel['channel_id']), 'message': 'Hello'}],
+        ]:
+        with raises(InputError):
+            message_sendbatch(user['token'], messages)
+
+    assert channel_messages(user['token'], channel['channel_id'], 0)['messages'] == []
+
+def test_message_react_several_react_ids():
+    '''
+    Test if a message can be reacted to with several react ids, each listed
+    with the users who used it
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+    channel_join(user2['token'], channel['channel_id'])
+    message = message_send(user1['token'], channel['channel_id'], 'Hello')
+
+    message_react(user2['token'], message['message_id'], 3)
+    message_react(user1['token'], message['message_id'], 3)
+    message_react(user1['token'], message['message_id'], 2)
+    message_unreact(user2['token'], message['message_id'], 3)
+    message_react(user2['token'], message['message_id'], 3)
+
+    messages = channel_messages(user1['token'], channel['channel_id'], 0)['messages']
+    assert messages[0]['reacts'] == [
+        {'react_id': 1, 'u_ids': [], 'is_this_user_reacted': False},
+        {'react_id': 2, 'u_ids': [user1['u_id']], 'is_this_user_reacted': True},
+        {'react_id': 3, 'u_ids': [user1['u_id'], user2['u_id']], 'is_this_user_reacted': True},
+    ]
+    with raises(InputError):
+        message_react(user1['token'], message['message_id'], 2)
+    with raises(InputError):
+        message_unreact(user2['token'], message['message_id'], 2)
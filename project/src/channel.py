@@ -1,10 +1,15 @@
 '''
 Last modified on 15/11/2020
 '''
+import bisect
 from error import InputError, AccessError
 from data import data, User, Channel, Message
-from helper import authorise
+from helper import authorise, get_authorised_uid
+from persistence import persist
+from events import bus
+from views import get_message_view
 
+@persist
 @authorise
 def channel_invite(token, channel_id, u_id):
 	'''
@@ -22,7 +27,7 @@ def channel_invite(token, channel_id, u_id):
 	}
 	'''
 	# find the matching user by token 
-	u_id2 = User.get_uid_from_token(token)
+	u_id2 = get_authorised_uid()
 
 	channel_index = Channel.find_channel(channel_id)
 	user_index = User.find_user(u_id)
@@ -39,15 +44,7 @@ def channel_invite(token, channel_id, u_id):
 		raise AccessError(description="The user has to be a member of this channel")
 
 	# Add the user in channel
-	user = data['users'][user_index]
-	user_info = {
-		'u_id': u_id, 
-		'name_first': user.get_name_first(), 
-		'name_last': user.get_name_last(),
-		'profile_img_url': user.get_profile_img_url(),
-		}
-	if user_info not in data['channels'][channel_index].get_all_members():
-		data['channels'][channel_index].add_all_members(user_info)
+	data['channels'][channel_index].add_all_members(u_id)
 	
 	return {}
 
@@ -69,7 +66,7 @@ def channel_details(token, channel_id):
 	}
 	'''
 	# find the matching user by token 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 
 	# Raise InputError if channel_id does not refer to a valid channel
 	channel_index = Channel.find_channel(channel_id)
@@ -80,29 +77,8 @@ def channel_details(token, channel_id):
 	if Channel.is_user_in_channel(u_id, channel_id) == False:
 		raise AccessError(description="The user has to be a member of this channel")
 
-	owners = data['channels'][channel_index].get_owner_members()
-	for owner in owners:
-		# find the user object
-		user = data['users'][owner['u_id']]
-		# get the latest value
-		owner['name_first'] = user.get_name_first()
-		owner['name_last'] = user.get_name_last()
-		owner['profile_img_url'] = user.get_profile_img_url()
-
-	members = data['channels'][channel_index].get_all_members()
-	for member in members:
-		# find the user object
-		user = data['users'][member['u_id']]
-		# get the latest value
-		member['name_first'] = user.get_name_first()
-		member['name_last'] = user.get_name_last()
-		member['profile_img_url'] = user.get_profile_img_url()
-
-	return {
-		'name': data['channels'][channel_index].get_name(),
-		'owner_members': owners,
-		'all_members': members,
-	}
+	# the payload is kept by the channel between reads
+	return data['channels'][channel_index].get_details()
 
 @authorise
 def channel_messages(token, channel_id, start):
@@ -127,60 +103,235 @@ def channel_messages(token, channel_id, start):
 	}
 	'''
 	# find the matching user by token 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 
 	channel_index = Channel.find_channel(channel_id)
 	# raise InputError if channel ID is not a valid channel
 	if channel_index == None:
 		raise InputError(description="channel_id does not refer to a valid channel")
 
-	# use a list to collect messages in the channel
-	_messages_in_channel = []
-	for message in data['messages']:
-		if message.get_channel_id() == channel_id:
-			new_message = {
-				'message_id': message.get_message_id(), 
-				'u_id': message.get_u_id(), 
-				'message': message.get_message(), 
-				'time_created': message.get_time_created(),
-				'reacts': message.get_reacts(),
-				'is_pinned': message.get_is_pinned(),
-			}
-			i = 0
-			for react in new_message['reacts']:
-				if Message.is_message_reacted_by_user(u_id, new_message['message_id'], react['react_id']):
-					new_message['reacts'][i]['is_this_user_reacted'] = True
-				else:
-					new_message['reacts'][i]['is_this_user_reacted'] = False
-				i += 1
-			_messages_in_channel.append(new_message)
-
-	messages_in_channel = sorted(_messages_in_channel ,key = lambda e:e.__getitem__('time_created'))
+	# the timeline only lists the messages that can be seen, oldest first
+	timeline = data['channels'][channel_index].get_timeline()
 	# raise InputError if start is greater than the total number of messages in the channel
-	if start > len(messages_in_channel):
+	if start > len(timeline):
 		raise InputError(description="start is greater than the number of messages")
 
-	u_id = User.get_uid_from_token(token)
 	# raise AccessError if Authorised user is not a member of channel with channel_id
 	if Channel.is_user_in_channel(u_id, channel_id) == False:
 		raise AccessError(description="The user has to be a member of this channel")
 
+	# Message with index 0 is the most recent message, so only the entries of
+	# the requested page are read, from the end of the timeline backwards.
+	# The page is read while holding the lock of the channel.
 	messages = []
-	for message in messages_in_channel:
-		if (message['message'] != ''):
-			messages.insert(0, message)
+	with Channel.get_lock(channel_id):
+		total = len(timeline)
+		page_end = max(total - start, 0)
+		page_start = max(page_end - 50, 0)
+		for _, message_id in reversed(timeline[page_start:page_end]):
+			messages.append(get_message_view(Message.load(message_id), u_id))
 
 	# Set end to 1 to indicate there are no more messages to load after this return.
 	end = start + 50
-	if end >= len(messages):
+	if end >= total:
 		end = -1
 
 	return {
-		'messages': messages[start:start+50],
+		'messages': messages,
 		'start': start,
 		'end': end,
 	}
 
+@authorise
+def channel_sync(token, channel_id, before=None, after=None, since_version=None):
+	'''
+	Input format:
+	(
+		token: string,
+		channel_id: integer,
+		before: message_id, optional
+		after: message_id, optional
+		since_version: integer, optional
+	)
+	Given a Channel with ID channel_id that the authorised user is part of,
+	return up to 50 of its messages, oldest first:
+		before: the messages sent just before the message
+		after: the messages sent just after the message
+		since_version: the messages changed (sent, edited, removed, reacted
+			to, pinned or unpinned) after that version of the channel, in the
+			order of their last change. A removed message only has its
+			message_id and is_removed.
+		none of them: the most recent messages
+	The cursors are stable: unlike start in channel_messages, they do not
+	move when messages are sent, and a removed message still works as one. version is the version of the channel the
+	messages are from, to be passed as since_version to catch up later.
+	has_more is True when there are more messages past the last one returned.
+	is_complete is False when since_version is older than the changes the
+	channel keeps: no messages are returned, and the client has to fetch the
+	channel again and sync from the version returned with it.
+	Output format:
+	{
+		'messages': [{ message_id, u_id, message, time_created, reacts, is_pinned, is_removed }],
+		'version': integer,
+		'has_more': boolean,
+		'is_complete': boolean,
+	}
+	'''
+	u_id = get_authorised_uid()
+
+	channel_index = Channel.find_channel(channel_id)
+	# raise InputError if channel ID is not a valid channel
+	if channel_index == None:
+		raise InputError(description="channel_id does not refer to a valid channel")
+
+	# raise InputError if more than one cursor is given
+	if [before, after, since_version].count(None) < 2:
+		raise InputError(description="Only one of before, after and since_version can be given")
+
+	# raise AccessError if Authorised user is not a member of channel with channel_id
+	if Channel.is_user_in_channel(u_id, channel_id) == False:
+		raise AccessError(description="The user has to be a member of this channel")
+
+	channel = data['channels'][channel_index]
+	with Channel.get_lock(channel_id):
+		if since_version is not None:
+			changes = channel.get_changes(since_version)
+			if changes == None:
+				return {
+					'messages': [],
+					'version': channel.get_version(),
+					'has_more': False,
+					'is_complete': False,
+				}
+			has_more = len(changes) > 50
+			changes = changes[:50]
+			messages = []
+			for _, message_id in changes:
+				message = Message.load(message_id)
+				# a removed message may have been compacted away
+				if message == None or message_id in data['tombstones']:
+					messages.append({'message_id': message_id, 'is_removed': True})
+				# a message sent later which has not been delivered yet is
+				# left out until it is
+				elif message.get_message() == '':
+					continue
+				else:
+					messages.append(dict(get_message_view(message, u_id), is_removed=False))
+			# a client which is behind resumes from the last change returned
+			version = changes[-1][0] if has_more else channel.get_version()
+			return {
+				'messages': messages,
+				'version': version,
+				'has_more': has_more,
+				'is_complete': True,
+			}
+
+		timeline = channel.get_timeline()
+		cursor = before if before is not None else after
+		if cursor is not None:
+			# a removed message is still a cursor, before and after compaction
+			entry = channel.get_cursor(cursor)
+			# raise InputError if the cursor is not a message of the channel
+			if entry == None:
+				raise InputError(description="The cursor is not a message of this channel")
+
+		# find the page in the timeline, which is ordered by time_created
+		if after is not None:
+			page_start = bisect.bisect_right(timeline, entry)
+			page_end = min(page_start + 50, len(timeline))
+			has_more = page_end < len(timeline)
+		else:
+			page_end = len(timeline) if before is None else bisect.bisect_left(timeline, entry)
+			page_start = max(page_end - 50, 0)
+			has_more = page_start > 0
+
+		messages = [get_message_view(Message.load(message_id), u_id)
+			for _, message_id in timeline[page_start:page_end]]
+		return {
+			'messages': messages,
+			'version': channel.get_version(),
+			'has_more': has_more,
+			'is_complete': True,
+		}
+
+@authorise
+def channel_pinned(token, channel_id):
+	'''
+	Input format:
+	(
+		token: string,
+		channel_id: integer,
+	)
+	Given a Channel with ID channel_id that the authorised user is part of,
+	return its pinned messages, oldest first. Only the pinned messages are
+	read.
+	Output format:
+	{
+		'messages': [{ message_id, u_id, message, time_created, reacts, is_pinned }],
+	}
+	'''
+	u_id = get_authorised_uid()
+
+	channel_index = Channel.find_channel(channel_id)
+	# raise InputError if channel ID is not a valid channel
+	if channel_index == None:
+		raise InputError(description="channel_id does not refer to a valid channel")
+
+	# raise AccessError if Authorised user is not a member of channel with channel_id
+	if Channel.is_user_in_channel(u_id, channel_id) == False:
+		raise AccessError(description="The user has to be a member of this channel")
+
+	with Channel.get_lock(channel_id):
+		messages = [get_message_view(Message.load(message_id), u_id)
+			for _, message_id in data['channels'][channel_index].get_pinned()]
+	return {
+		'messages': messages,
+	}
+
+@authorise
+def channel_events(token, channel_id, cursor=None, timeout=0):
+	'''
+	Input format:
+	(
+		token: string,
+		channel_id: integer,
+		cursor: integer, or None for the events from now on
+		timeout: number of seconds to wait for an event if there is none yet
+	)
+	Given a Channel with ID channel_id that the authorised user is part of,
+	return the events of the channel after cursor (see events.py).
+	is_complete is False when some of them are no longer kept, or the cursor
+	was handed out before the events were cleared, and the channel has to
+	be loaded again with channel_messages. The events after it are read
+	from the returned cursor.
+	Output format:
+	{
+		'events': [{ cursor, type, ... }],
+		'cursor': integer,
+		'is_complete': boolean,
+	}
+	'''
+	u_id = get_authorised_uid()
+
+	# raise InputError if channel ID is not a valid channel
+	if Channel.find_channel(channel_id) == None:
+		raise InputError(description="channel_id does not refer to a valid channel")
+
+	# raise AccessError if Authorised user is not a member of channel with channel_id
+	if Channel.is_user_in_channel(u_id, channel_id) == False:
+		raise AccessError(description="The user has to be a member of this channel")
+
+	if cursor is None:
+		cursor = bus.get_cursor(channel_id)
+	events, cursor, is_complete = bus.wait(channel_id, cursor, timeout)
+
+	return {
+		'events': events,
+		'cursor': cursor,
+		'is_complete': is_complete,
+	}
+
+@persist
 @authorise
 def channel_leave(token, channel_id):
 	'''
@@ -195,28 +346,23 @@ def channel_leave(token, channel_id):
 	}
 	'''
 	# find the matching user by token 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 
 	channel_index = Channel.find_channel(channel_id)
 	# raise InputError if channel ID is not a valid channel
 	if channel_index == None:
 		raise InputError(description="channel ID does not refer a valid channel")
 
-	u_id = User.get_uid_from_token(token)
 	# raise AccessError if Authorised user is not a member of channel with channel_id
 	if Channel.is_user_in_channel(u_id, channel_id) == False:
 		raise AccessError(description="The user has to be a member of this channel")
 
-	for member in data['channels'][channel_index].get_all_members():
-		if u_id == member['u_id']:
-			data['channels'][channel_index].remove_all_members(member)
-
-	for member in data['channels'][channel_index].get_owner_members():
-		if u_id == member['u_id']:
-			data['channels'][channel_index].remove_owner_members(member)
+	data['channels'][channel_index].remove_all_members(u_id)
+	data['channels'][channel_index].remove_owner_members(u_id)
 
 	return {}
 
+@persist
 @authorise
 def channel_join(token, channel_id):
 	'''
@@ -232,7 +378,7 @@ def channel_join(token, channel_id):
 	}
 	'''
 	# find the matching user by token 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 
 	index = Channel.find_channel(channel_id)
 	user_index = User.find_user(u_id)
@@ -244,18 +390,10 @@ def channel_join(token, channel_id):
 	if not data['channels'][index].get_is_public() and data['users'][user_index].get_permission_id() != 1:
 		raise AccessError(description="Channel that is private")
 
-	user_index = User.find_user(u_id)
-	user = data['users'][user_index]
-	user_info = {
-		'u_id': u_id, 
-		'name_first': user.get_name_first(), 
-		'name_last':user.get_name_last(),
-		'profile_img_url': user.get_profile_img_url(),
-	}
-	if user_info not in data['channels'][index].get_all_members():
-		data['channels'][index].add_all_members(user_info)
+	data['channels'][index].add_all_members(u_id)
 	return {}
 
+@persist
 @authorise
 def channel_addowner(token, channel_id, u_id):
 	'''
@@ -271,7 +409,7 @@ def channel_addowner(token, channel_id, u_id):
 	}
 	'''
 	# find the matching user by token s
-	u_id2 = User.get_uid_from_token(token)
+	u_id2 = get_authorised_uid()
 
 	channel_index = Channel.find_channel(channel_id)
 	# raise InputError if channel ID is not a valid channel
@@ -292,23 +430,13 @@ def channel_addowner(token, channel_id, u_id):
 	if Channel.is_user_owner(u_id2, channel_id) == False and data['users'][user_index2].get_permission_id() != 1:
 		raise AccessError(description="You are not the owner of the channel or the flockr")
 
-	user_index = User.find_user(u_id)
-	user = data['users'][user_index]
-	user_info = {
-		'u_id': u_id, 
-		'name_first': user.get_name_first(), 
-		'name_last':user.get_name_last(),
-		'profile_img_url': user.get_profile_img_url(),
-	}
 	channel_index = Channel.find_channel(channel_id)
-
-	
-	data['channels'][channel_index].add_owner_members(user_info)
-	if user_info not in data['channels'][channel_index].get_all_members():
-		data['channels'][channel_index].add_all_members(user_info)
+	data['channels'][channel_index].add_owner_members(u_id)
+	data['channels'][channel_index].add_all_members(u_id)
 
 	return {}
 
+@persist
 @authorise
 def channel_removeowner(token, channel_id, u_id):
 	'''
@@ -324,7 +452,7 @@ def channel_removeowner(token, channel_id, u_id):
 	}
 	'''
 	# find the matching user by token 
-	u_id2 = User.get_uid_from_token(token)
+	u_id2 = get_authorised_uid()
 	
 	channel_index = Channel.find_channel(channel_id)
 	# raise InputError if channel ID is not a valid channel
@@ -341,19 +469,10 @@ def channel_removeowner(token, channel_id, u_id):
 		raise InputError(description="The user is already an owner of the flockr")   
 
 	# raise AccessError when the authorised user is not an owner of the flockr, or an owner of this channel
-	u_id2 = User.get_uid_from_token(token)
 	user_index2 = User.find_user(u_id2)
 	if Channel.is_user_owner(u_id2, channel_id) == False and data['users'][user_index2].get_permission_id() != 1:
 		raise AccessError(description="You are not the owner of the channel or the flockr")
 
 	channel_index = Channel.find_channel(channel_id)
-   
-	user_info = {
-		'u_id': u_id, 
-		'name_first': data['users'][user_index].get_name_first(),
-		'name_last': data['users'][user_index].get_name_last(),
-		'profile_img_url': data['users'][user_index].get_profile_img_url(),
-	}
-
-	data['channels'][channel_index].remove_owner_members(user_info)
+	data['channels'][channel_index].remove_owner_members(u_id)
 	return {}
@@ -1,6 +1,7 @@
 from error import InputError, AccessError
-from data import data, User, Channel 
-from helper import authorise
+from data import data, Channel
+from helper import authorise, get_authorised_uid
+from persistence import persist
 
 @authorise
 def channels_list(token):
@@ -17,20 +18,20 @@ def channels_list(token):
 	'''
 
 	# find the matching user by token 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 
 	# create an empty list to store the result
 	all = []
 
-	# search through all the channels for the required ones
-	for channel in data['channels']:
-		if Channel.is_user_in_channel(u_id, channel.get_channel_id()) == True:
-			channel_info = {}
-			channel_info['channel_id'] = channel.get_channel_id()
-			channel_info['name'] = channel.get_name()
+	# only visit the channels the user is a member of
+	for channel_id in Channel.get_user_channels(u_id):
+		channel = data['channels'][Channel.find_channel(channel_id)]
+		channel_info = {}
+		channel_info['channel_id'] = channel.get_channel_id()
+		channel_info['name'] = channel.get_name()
 
-			# put the found channels at the tail of the result list
-			all.append(channel_info)
+		# put the found channels at the tail of the result list
+		all.append(channel_info)
 
 	return {'channels': all}
 
@@ -60,6 +61,7 @@ def channels_listall(token):
 	# put the found channels at the tail of the result list
 	return {'channels': all}
 
+@persist
 @authorise
 def channels_create(token, name, is_public):
 	'''
@@ -76,7 +78,7 @@ def channels_create(token, name, is_public):
 	}
 	'''
 	# find the matching user by token 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 
 	# name must be less or equal to 20 cahracters
 	if len(name) >= 20:
@@ -87,26 +89,16 @@ def channels_create(token, name, is_public):
 
 	# set attributes
 	new_channel.set_name(name)
-	new_channel.set_channel_id(len(data['channels']))
+	new_channel.set_channel_id(data['ids'].allocate('channels'))
 	new_channel.set_all_members([])
 	new_channel.set_owner_members([])
 	new_channel.set_is_public(is_public)
 
-	# find the information of the owner
-	user_index = User.find_user(u_id)
-	user = data['users'][user_index]
-
-	# add the information of the user to this channel
-	user_info = {
-		'u_id': user.get_u_id(), 
-		'name_first': user.get_name_first(), 
-		'name_last': user.get_name_last(),
-		'profile_img_url': user.get_profile_img_url(),
-	}
-	new_channel.add_owner_members(user_info)
-	new_channel.add_all_members(user_info)
+	# add the user to this channel as its owner
+	new_channel.add_owner_members(u_id)
+	new_channel.add_all_members(u_id)
 
-	data['channels'].append(new_channel)
+	Channel.add_channel(new_channel)
 
 	# return channel_id
 	return {
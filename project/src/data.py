@@ -15,8 +15,8 @@ data = {
         {
             'name':string,
             'id':integer,
-            'all_members':[{'u_id': integer, 'name_first': string, 'name_last': string}],
-            'owner_members':[{'u_id': integer, 'name_first': string, 'name_last': string}],
+            'all_members': [u_id],
+            'owner_members': [u_id],
             'is_public': boolean,
         }
     ],
@@ -29,25 +29,409 @@ data = {
             'time_created': double,
         }
     ],
-    'valid_tokens': [],
-
+    'sessions': {token: {'u_id': integer, 'time_created': integer}},
+    'user_index': {u_id: index in data['users']},
+    'channel_index': {channel_id: index in data['channels']},
+    'message_index': {message_id: index in data['messages']},
+    'user_channels': {u_id: set of the channel_ids the user is a member of},
+    'search_index': {trigram: {channel_id: array of the message_ids, in
+                     increasing order, whose text contains or contained it}},
+    'message_archive': MessageArchive holding the older messages in columns,
+    'ids': IdAllocator handing out the u_ids, channel_ids and message_ids,
+    'tombstones': set of the message_ids of the removed messages which are
+                  still in data['messages'], until they are compacted,
 }
 '''
 import re
+import copy
 import hashlib
+import bisect
+import threading
 import jwt
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+from contextvars import ContextVar
 from error import InputError
+from events import bus
 
 SECRET = 'spicythingy'
 
+# every substring of a message with GRAM_LENGTH characters is indexed, shorter
+# queries are answered by reading the timelines of the channels
+GRAM_LENGTH = 3
+
+# once data['messages'] holds more than HOT_MESSAGE_LIMIT messages, the oldest
+# are moved to the archive until HOT_MESSAGE_LIMIT // 2 are left. Messages
+# which can not be archived do not count, the next archive is only run once
+# HOT_MESSAGE_LIMIT // 2 more messages have been sent (see MessageArchive)
+HOT_MESSAGE_LIMIT = 10000
+
+# the number of changed messages each channel remembers for channel_sync, a
+# client which is further behind has to fetch the channel again
+CHANGE_HISTORY = 1000
+
+# the react_ids a message can be reacted to with, 1 being the thumbs up of
+# the frontend
+VALID_REACT_IDS = (1, 2, 3, 4, 5)
+
+# set while a logged command is run, so that every read of the clock made by
+# the command returns the time it was first run at (see persistence.py)
+clock_override = ContextVar('clock_override', default=None)
+
+def time_now():
+    '''
+    Return the current UTC time as an integer timestamp
+    '''
+    override = clock_override.get()
+    if override is not None:
+        return override
+    return int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp())
+
+
+class IdAllocator(object):
+    '''
+    Hands out the ids of new users, channels and messages. The ids of a kind
+    are handed out in increasing order and never twice, even once the object
+    they were given to has been removed, so ids do not depend on where the
+    objects are kept. With stride n and offset i only ids which are i modulo n
+    are handed out, so n allocators can give out ids side by side. The stride
+    and offset only apply to the passed in kinds, or to every kind if None.
+    '''
+    def __init__(self, stride=1, offset=0, kinds=None):
+        self.stride = stride
+        self.offset = offset
+        self.kinds = kinds
+        # kind -> the next id to hand out
+        self.next_ids = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_copy(self):
+        '''
+        Return a copy of the allocator which later allocations do not reach
+        '''
+        allocator = IdAllocator(self.stride, self.offset, self.kinds)
+        with self.lock:
+            allocator.next_ids = dict(self.next_ids)
+        return allocator
+
+    def clear(self):
+        '''
+        Start every kind from its first id again
+        '''
+        with self.lock:
+            self.next_ids.clear()
+
+    def allocate(self, kind):
+        '''
+        Return a new id of the kind, e.g. 'messages'
+        '''
+        return self.allocate_block(kind, 1)[0]
+
+    def allocate_block(self, kind, size):
+        '''
+        Return a range of size new ids of the kind, for callers which add
+        many objects at once
+        '''
+        if self.kinds is None or kind in self.kinds:
+            stride, offset = self.stride, self.offset
+        else:
+            stride, offset = 1, 0
+        with self.lock:
+            start = self.next_ids.get(kind, offset)
+            self.next_ids[kind] = start + size * stride
+        return range(start, start + size * stride, stride)
+
+
+class MessageArchive(object):
+    '''
+    Messages which are no longer kept as Message objects, stored row by row
+    in typed arrays sorted by message_id:
+        message_ids, u_ids, channel_ids, times_created: array of integers
+        text_starts, text_lengths: the UTF-8 text of the row in text
+        is_live: 0 once the message has been taken back out of the archive
+    Rows are never removed, a message which comes back to the archive is
+    written over its old row, keeping its text if it did not change. Rows are
+    only ever appended, so that readers need no lock: message_ids is appended
+    to last and is_live is set last. Once most of text is no longer used, it
+    is compacted into a copy of the archive (see compact).
+    '''
+    # the number of messages data['messages'] may hold before the next
+    # archive, and the bytes of text used by the live rows. Snapshots taken
+    # before they were kept have the class defaults.
+    hot_limit = HOT_MESSAGE_LIMIT
+    text_size = 0
+
+    # the columns which are only appended to: a row written over keeps its
+    # message_id, u_id, channel_id and time_created, and text only grows
+    APPENDED_COLUMNS = ('message_ids', 'u_ids', 'channel_ids', 'times_created', 'text')
+
+    def __init__(self):
+        self.clear()
+
+    def get_copy(self):
+        '''
+        Return a copy of the archive which later changes do not reach
+        '''
+        return self.start_copy().finish_copy()
+
+    def start_copy(self):
+        '''
+        Start a copy of the archive. Only the columns rows are written over
+        are copied, the others are shared until finish_copy cuts them to the
+        length they have now, so a copy started under persistence.WRITE_LOCK
+        can be finished once it has been let go.
+        '''
+        archive = MessageArchive.__new__(MessageArchive)
+        archive.__dict__.update({name: value if name in self.APPENDED_COLUMNS else copy.copy(value)
+                                 for name, value in self.__dict__.items()})
+        archive.copy_lengths = (len(self.message_ids), len(self.text))
+        return archive
+
+    def finish_copy(self):
+        '''
+        Cut the columns shared by start_copy, after which later changes to
+        the archive it was started from do not reach this one. Return it.
+        '''
+        rows, text_length = self.__dict__.pop('copy_lengths')
+        for name in self.APPENDED_COLUMNS:
+            setattr(self, name, getattr(self, name)[:text_length if name == 'text' else rows])
+        return self
+
+    def clear(self):
+        '''
+        Remove every row
+        '''
+        self.message_ids = array('q')
+        self.u_ids = array('q')
+        self.channel_ids = array('q')
+        self.times_created = array('q')
+        self.text_starts = array('q')
+        self.text_lengths = array('q')
+        self.text = bytearray()
+        self.is_live = bytearray()
+        self.live_count = 0
+        self.hot_limit = HOT_MESSAGE_LIMIT
+        self.text_size = 0
+
+    def get_live_count(self):
+        '''
+        Return the number of messages held by the archive
+        '''
+        return self.live_count
+
+    def get_live_rows(self):
+        '''
+        Return the rows of the messages held by the archive
+        '''
+        return [row for row in range(len(self.message_ids)) if self.is_live[row]]
+
+    def find_row(self, message_id):
+        '''
+        Return the row of the live message with the passed in message_id.
+        None will be returned if it is not found.
+        '''
+        row = bisect.bisect_left(self.message_ids, message_id)
+        if row == len(self.message_ids) or self.message_ids[row] != message_id:
+            return None
+        if not self.is_live[row]:
+            return None
+        return row
+
+    def can_archive(self, message):
+        '''
+        Check if every field of the message fits in the columns, i.e. it has
+        no reacts, it is not pinned and its time_created is an integer, and
+        it has a row or its row can be appended
+        '''
+        if message.reacts is not None or message.get_is_pinned() or \
+                type(message.get_time_created()) is not int:
+            return False
+        message_id = message.get_message_id()
+        if not self.message_ids or self.message_ids[-1] < message_id:
+            return True
+        row = bisect.bisect_left(self.message_ids, message_id)
+        return self.message_ids[row] == message_id
+
+    def get_hot_limit(self):
+        '''
+        Return the number of messages data['messages'] may hold before the
+        oldest are archived
+        '''
+        return self.hot_limit
+
+    def set_hot_limit(self, hot_count):
+        '''
+        Set the hot_limit after an archive which left hot_count messages in
+        data['messages']
+        '''
+        self.hot_limit = max(HOT_MESSAGE_LIMIT, hot_count + HOT_MESSAGE_LIMIT // 2)
+
+    def add(self, message):
+        '''
+        Store the message in its row, which is made if it is not there yet.
+        The text of the row is kept if it is the text of the message.
+        '''
+        text = message.get_message().encode('utf-8')
+        message_id = message.get_message_id()
+        row = bisect.bisect_left(self.message_ids, message_id)
+        if row == len(self.message_ids):
+            self.u_ids.append(0)
+            self.channel_ids.append(0)
+            self.times_created.append(0)
+            self.text_starts.append(0)
+            self.text_lengths.append(0)
+            self.is_live.append(0)
+            self.message_ids.append(message_id)
+        start = self.text_starts[row]
+        if self.text[start:start + self.text_lengths[row]] != text:
+            start = len(self.text)
+            self.text += text
+        self.u_ids[row] = message.get_u_id()
+        self.channel_ids[row] = message.get_channel_id()
+        self.times_created[row] = message.get_time_created()
+        self.text_starts[row] = start
+        self.text_lengths[row] = len(text)
+        if not self.is_live[row]:
+            self.text_size += len(text)
+            self.is_live[row] = 1
+            self.live_count += 1
+
+    def needs_compact(self):
+        '''
+        Check if most of text is held by rows which are no longer live or
+        texts which were written again
+        '''
+        return len(self.text) > 2 * self.text_size
+
+    def compact(self):
+        '''
+        Return a copy of the archive whose text only holds the texts of the
+        live rows. The archive is copied rather than changed, as it is read
+        without a lock.
+        '''
+        archive = MessageArchive()
+        archive.u_ids = array('q', self.u_ids)
+        archive.channel_ids = array('q', self.channel_ids)
+        archive.times_created = array('q', self.times_created)
+        archive.is_live = bytearray(self.is_live)
+        archive.live_count = self.live_count
+        archive.hot_limit = self.hot_limit
+        for row in range(len(self.message_ids)):
+            start, length = self.text_starts[row], self.text_lengths[row]
+            if not self.is_live[row]:
+                start, length = 0, 0
+            archive.text_starts.append(len(archive.text))
+            archive.text_lengths.append(length)
+            archive.text += self.text[start:start + length]
+        archive.text_size = len(archive.text)
+        archive.message_ids = array('q', self.message_ids)
+        return archive
+
+    def load(self, row):
+        '''
+        Return a Message built from the row
+        '''
+        start = self.text_starts[row]
+        text = bytes(self.text[start:start + self.text_lengths[row]]).decode('utf-8')
+        return Message(self.message_ids[row], self.u_ids[row], text,
+                       self.channel_ids[row], self.times_created[row], None, False)
+
+    def remove(self, row):
+        '''
+        Mark the message of the row as taken out of the archive
+        '''
+        if self.is_live[row]:
+            self.is_live[row] = 0
+            self.live_count -= 1
+            self.text_size -= self.text_lengths[row]
+
+
+class Timeline(object):
+    '''
+    The (time_created, message_id) pairs of the messages of a channel, ordered
+    from the oldest, kept in two arrays so that a message takes 16 bytes
+    whether it is in data['messages'] or in the archive. It is read like a
+    list of pairs, so it can be bisected and sliced.
+    '''
+    def __init__(self, entries=()):
+        self.times = array('d')
+        self.message_ids = array('q')
+        for time_created, message_id in entries:
+            self.times.append(time_created)
+            self.message_ids.append(message_id)
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(self.times[index], self.message_ids[index]))
+        return (self.times[index], self.message_ids[index])
+
+    def __iter__(self):
+        return zip(self.times, self.message_ids)
+
+    def get_copy(self):
+        '''
+        Return a copy of the timeline which later changes do not reach
+        '''
+        timeline = Timeline()
+        timeline.times = array('d', self.times)
+        timeline.message_ids = array('q', self.message_ids)
+        return timeline
+
+    def insert(self, entry):
+        '''
+        Insert the (time_created, message_id) pair in order, unless it is there
+        '''
+        if not self.message_ids or self[-1] < entry:
+            index = len(self.message_ids)
+        else:
+            index = bisect.bisect_left(self, entry)
+            if self[index] == entry:
+                return
+        self.times.insert(index, entry[0])
+        self.message_ids.insert(index, entry[1])
+
+    def remove(self, entry):
+        '''
+        Remove the (time_created, message_id) pair if it is there
+        '''
+        index = bisect.bisect_left(self, entry)
+        if index < len(self.message_ids) and self[index] == entry:
+            del self.times[index]
+            del self.message_ids[index]
+
 
 data = {
     'users': [],
     'channels': [],
     'messages': [],
-    'valid_tokens': [],
+    'sessions': {},
+    'user_index': {},
+    'channel_index': {},
+    'message_index': {},
+    'user_channels': {},
+    'search_index': {},
+    'message_archive': MessageArchive(),
+    'ids': IdAllocator(),
+    'tombstones': set(),
 }
 
+# held while data['messages'] and message_index are changed in a way that
+# moves messages between them and the archive, see Message.load
+index_lock = threading.Lock()
+
 class User(object):
     """
     new_user = {
@@ -58,9 +442,14 @@ class User(object):
         'name_last': string,
         'handle_str': string
         'permission_id': integer,
-        'reset_code': string
+        'reset_code': the hash of the reset code sent to the user, None
+                      once it has been used
+        'view': the u_id, names and profile_img_url shown in the members of
+                every channel of the user, or None until it is read
     }
     """
+    view = None
+
     def __init__(self, u_id=None, email=None, password=None, name_first=None, 
     name_last=None, handle_str=None, permission_id=None, reset_code=None, profile_img_url=None):
         self.u_id = u_id
@@ -74,6 +463,12 @@ class User(object):
         if profile_img_url is None:
             self.profile_img_url = ''
 
+    def get_copy(self):
+        '''
+        Return a copy of the user which later changes do not reach
+        '''
+        return copy.copy(self)
+
     def set_u_id(self, u_id):
         '''
         Replace the u_id by the passed in u_id
@@ -115,6 +510,8 @@ class User(object):
         Replace the name_first by the passed in name_first
         '''
         self.name_first = name_first
+        self.view = None
+        Channel.forget_details(self.u_id)
 
     def get_name_first(self):
         '''
@@ -127,6 +524,8 @@ class User(object):
         Replace the name_last by the passed in name_last
         '''
         self.name_last = name_last
+        self.view = None
+        Channel.forget_details(self.u_id)
 
     def get_name_last(self):
         '''
@@ -181,6 +580,24 @@ class User(object):
         Replace the profile_img_url by the passed in profile_img_url
         '''
         self.profile_img_url = profile_img_url
+        self.view = None
+        Channel.forget_details(self.u_id)
+
+    def get_view(self):
+        '''
+        Return the u_id, names and profile_img_url of the user, as listed in
+        the members of a channel. The same dict is shared by every channel
+        until the user changes, so it must not be changed.
+        '''
+        view = self.view
+        if view is None:
+            view = self.view = {
+                'u_id': self.u_id,
+                'name_first': self.name_first,
+                'name_last': self.name_last,
+                'profile_img_url': self.profile_img_url,
+            }
+        return view
 
 
     @staticmethod
@@ -264,21 +681,22 @@ class User(object):
             if reset_code == user.get_reset_code():
                 raise InputError(description='Email is not unique')
 
+    @staticmethod
+    def add_user(user):
+        '''
+        Append the user to data['users'] and record its position in the
+        user_index so that it can be found by u_id in constant time.
+        '''
+        data['user_index'][user.get_u_id()] = len(data['users'])
+        data['users'].append(user)
+
     @staticmethod
     def find_user(u_id):
         '''
         Return the index of the user whose u_id matches the passed in
         u_id. None will be returned if it is not found.
         '''
-        index = None
-        i = 0
-        for user in data['users']:
-            if u_id == user.get_u_id():
-                index = i
-                break
-            i += 1
-
-        return index
+        return data['user_index'].get(u_id)
 
     @staticmethod
     def encrypt_password(password):
@@ -291,7 +709,7 @@ class User(object):
     def generate_token(u_id):
         '''
         Return the token generated based on the passed in u_id.
-        If the token does not exist, add it to the valid_tokens list
+        If the token does not exist, open a session for it in data['sessions']
         The payload:
         {
             "u_id": integer,
@@ -301,32 +719,34 @@ class User(object):
             "u_id": u_id,
         }
         token = jwt.encode(payload, SECRET, algorithm='HS256').decode('utf-8')
-        if token not in data['valid_tokens']:
-            data['valid_tokens'].append(token)
+        if token not in data['sessions']:
+            data['sessions'][token] = {
+                'u_id': u_id,
+                'time_created': time_now(),
+            }
         return token
     
     @staticmethod
     def get_uid_from_token(token):
         '''
-        Return the u_id decoded from the passed in token.
-        If the token is not in the valid_tokens list, return None.
+        Return the u_id of the session opened for the passed in token.
+        If there is no session for the token, return None.
         If the u_id does not exist, return None.
         '''
-        if token not in data['valid_tokens']:
+        if not isinstance(token, str):
             return None
-        payload = jwt.decode(token.encode('utf-8'), SECRET, algorithms=['HS256'])
-        if User.find_user(payload['u_id']) is None:
+        session = data['sessions'].get(token)
+        if session is None or User.find_user(session['u_id']) is None:
             return None
-        else:
-            return payload['u_id']
+        return session['u_id']
             
     @staticmethod
     def invalidate_token(token):
         '''
         Assumes the token passed in is valid
-        Remove the token from the valid_tokens list
+        Close the session of the token
         '''
-        data['valid_tokens'].remove(token)
+        data['sessions'].pop(token, None)
 
 
     @staticmethod
@@ -366,26 +786,102 @@ class Channel(object):
     'new_channel': {
             'name':string,
             'channel_id':integer,
-            'all_members':[{'u_id': integer, 'name_first': string, 'name_last': string}],
-            'owner_members':[{'u_id': integer, 'name_first': string, 'name_last': string}],
+            'all_members': [u_id] in the order the users joined
+            'owner_members': [u_id] in the order the users became owners
             'is_public': boolean,
             'time_finish': integer
+            'timeline': Timeline of the (time_created, message_id) of the
+                        messages which can be seen, sorted oldest first
+            'pinned': [(time_created, message_id)] of the pinned messages of
+                      the timeline, sorted oldest first
+            'member_ids': {u_id: None}, all_members kept as an ordered set
+            'owner_ids': {u_id: None}, owner_members kept as an ordered set
+            'version': integer, counts the changes made to the messages
+            'changes': {message_id: version of its last change}, ordered by
+                       version, of the last CHANGE_HISTORY changed messages
+            'changes_floor': integer, the newest version which has been
+                             dropped from changes
+            'removed_ids': array of the message_ids of the removed messages
+                           which have been compacted, sorted, so that they
+                           still work as cursors
+            'removed_times': array of their time_created, in the same order
+            'details': the payload of channel_details, or None until it is
+                       read
     }
+    Every change to the members, the timeline, the standup or the messages of
+    the channel is made while holding its lock, and readers hold it while
+    they copy them, so that they never see a change half made.
     '''
     def __init__(self, name=None, channel_id=None, all_members=None,
                 owner_members=None, is_public=None, time_finish=None):
         self.name = name
         self.channel_id = channel_id
-        self.all_members = all_members
-        self.owner_members = owner_members
+        self.details = None
+        self.set_all_members(all_members)
+        self.set_owner_members(owner_members)
         self.is_public = is_public
         self.time_finish = time_finish
         self.standup_message = ''
+        self.timeline = Timeline()
+        self.pinned = []
+        self.version = 0
+        self.changes = OrderedDict()
+        self.changes_floor = 0
+        self.removed_ids = array('q')
+        self.removed_times = array('d')
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        # the details are built again from the users when they are read
+        state['details'] = None
+        return state
+
+    def __setstate__(self, state):
+        # older snapshots list the members as dicts and keep them twice
+        for key, old_key in [('member_ids', 'all_members'), ('owner_ids', 'owner_members')]:
+            if old_key in state:
+                state[key] = dict.fromkeys(member['u_id'] for member in state.pop(old_key) or [])
+        # older snapshots keep the timeline in a list
+        if not isinstance(state.get('timeline'), Timeline):
+            state['timeline'] = Timeline(state.get('timeline', []))
+        # older snapshots keep the removed messages in a dict
+        removed = sorted(state.pop('removed', {}).items())
+        state.setdefault('removed_ids', array('q', [message_id for message_id, _ in removed]))
+        state.setdefault('removed_times', array('d', [time_created for _, time_created in removed]))
+        # older snapshots keep every change
+        if not isinstance(state.get('changes'), OrderedDict):
+            changes = OrderedDict(state.get('changes', {}))
+            state['changes_floor'] = 0
+            while len(changes) > CHANGE_HISTORY:
+                _, state['changes_floor'] = changes.popitem(last=False)
+            state['changes'] = changes
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def get_copy(self):
+        '''
+        Return a copy of the channel which later changes do not reach
+        '''
+        channel = Channel.__new__(Channel)
+        with self.lock:
+            channel.__setstate__(self.__getstate__())
+            channel.member_ids = dict(self.member_ids)
+            channel.owner_ids = dict(self.owner_ids)
+            channel.timeline = self.timeline.get_copy()
+            channel.pinned = list(self.pinned)
+            channel.changes = OrderedDict(self.changes)
+            channel.removed_ids = array('q', self.removed_ids)
+            channel.removed_times = array('d', self.removed_times)
+        return channel
+
     def set_name(self, name):
         '''
         Replace the name by the passed in name
         '''
         self.name = name
+        self.update_details('name', lambda _: name)
 
     def get_name(self):
         '''
@@ -407,27 +903,33 @@ class Channel(object):
     
     def set_all_members(self, all_members):
         '''
-        Replace the all_numbers by the passed in all_numbers
+        Replace the all_numbers by the passed in u_ids
         '''
-        self.all_members = all_members
+        for u_id in getattr(self, 'member_ids', ()):
+            data['user_channels'][u_id].discard(self.channel_id)
+        self.details = None
+        self.member_ids = dict.fromkeys(all_members or [])
+        for u_id in self.member_ids:
+            data['user_channels'].setdefault(u_id, set()).add(self.channel_id)
 
     def get_all_members(self):
         '''
-        Return the all_numbers of the object
+        Return the u_ids of all_numbers of the object
         '''
-        return self.all_members
+        return list(self.member_ids)
 
     def set_owner_members(self, owner_members):
         '''
-        Replace the owner_members by the passed in name
+        Replace the owner_members by the passed in u_ids
         '''
-        self.owner_members = owner_members
+        self.details = None
+        self.owner_ids = dict.fromkeys(owner_members or [])
 
     def get_owner_members(self):
         '''
-        Return the owner_members of the object
+        Return the u_ids of the owner_members of the object
         '''
-        return self.owner_members
+        return list(self.owner_ids)
 
     def set_is_public(self, is_public):
         '''
@@ -441,29 +943,100 @@ class Channel(object):
         '''
         return self.is_public
 
-    def add_all_members(self, user):
+    def has_member(self, u_id):
+        '''
+        Return whether the user with the passed in u_id is in channel.all_members
+        '''
+        return u_id in self.member_ids
+
+    def has_owner(self, u_id):
         '''
-        add the channel.all_members
+        Return whether the user with the passed in u_id is in channel.owner_members
         '''
-        self.all_members.append(user)
+        return u_id in self.owner_ids
 
-    def add_owner_members(self, user):
+    def add_all_members(self, u_id):
         '''
-        add the channel.owner_members
+        add the user with u_id to channel.all_members, unless the user is
+        already a member
         '''
-        self.owner_members.append(user)
+        with self.lock:
+            if u_id not in self.member_ids:
+                self.member_ids[u_id] = None
+                data['user_channels'].setdefault(u_id, set()).add(self.channel_id)
+                self.update_details('all_members', lambda members:
+                                    members + [Channel.get_member_details(u_id)])
 
-    def remove_all_members(self, user):
+    def add_owner_members(self, u_id):
         '''
-        remove the channel.all_members
+        add the user with u_id to channel.owner_members, unless the user is
+        already an owner
         '''
-        self.all_members.remove(user)
+        with self.lock:
+            if u_id not in self.owner_ids:
+                self.owner_ids[u_id] = None
+                self.update_details('owner_members', lambda members:
+                                    members + [Channel.get_member_details(u_id)])
 
-    def remove_owner_members(self, user):
+    def remove_all_members(self, u_id):
         '''
-        remove the channel.owner_members
+        remove the user with u_id from channel.all_members
         '''
-        self.owner_members.remove(user)
+        with self.lock:
+            if u_id in self.member_ids:
+                del self.member_ids[u_id]
+                data['user_channels'][u_id].discard(self.channel_id)
+                self.update_details('all_members', lambda members:
+                                    [member for member in members if member['u_id'] != u_id])
+
+    def remove_owner_members(self, u_id):
+        '''
+        remove the user with u_id from channel.owner_members
+        '''
+        with self.lock:
+            if u_id in self.owner_ids:
+                del self.owner_ids[u_id]
+                self.update_details('owner_members', lambda members:
+                                    [member for member in members if member['u_id'] != u_id])
+
+    def get_details(self):
+        '''
+        Return the name, owner_members and all_members of the channel, with
+        the latest names and profile_img_url of each user, as returned by
+        channel_details. The payload is built on the first read and kept up to
+        date by the changes to the channel, so it must not be changed.
+        '''
+        with self.lock:
+            if self.details is None:
+                self.details = {
+                    'name': self.name,
+                    'owner_members': [Channel.get_member_details(u_id) for u_id in self.owner_ids],
+                    'all_members': [Channel.get_member_details(u_id) for u_id in self.member_ids],
+                }
+            return self.details
+
+    def update_details(self, key, change):
+        '''
+        Replace the value of key in the details by change(value). The details
+        are copied rather than changed, as the ones already returned by
+        get_details may still be in use.
+        '''
+        with self.lock:
+            if self.details is not None:
+                self.details = dict(self.details, **{key: change(self.details[key])})
+
+    @staticmethod
+    def forget_details(u_id):
+        '''
+        Drop the details of every channel the user with the passed in u_id is
+        a member of, after a change to their names or profile_img_url
+        '''
+        for channel_id in list(data['user_channels'].get(u_id, ())):
+            channel_index = Channel.find_channel(channel_id)
+            if channel_index is not None:
+                channel = data['channels'][channel_index]
+                with channel.lock:
+                    channel.details = None
     
     def set_time_finish(self, time_finish):
         '''
@@ -476,6 +1049,14 @@ class Channel(object):
         '''
         return self.time_finish
 
+    def is_standup_active(self):
+        '''
+        Return whether a standup is running in the channel at the moment
+        '''
+        if self.time_finish is None:
+            return False
+        return self.time_finish >= time_now()
+
     def set_standup_message(self, message):
         '''
         set the standup_message of the object
@@ -491,22 +1072,179 @@ class Channel(object):
         '''
         Append the new passed in message to the existing messgae
         '''
-        self.standup_message += new_message
+        with self.lock:
+            self.standup_message += new_message
+
+    def get_timeline(self):
+        '''
+        Return the (time_created, message_id) pairs of the messages that can
+        be seen in the channel, ordered from the oldest to the most recent
+        '''
+        return self.timeline
+
+    def add_to_timeline(self, message):
+        '''
+        Insert the message into the timeline, keeping it ordered by time_created
+        '''
+        with self.lock:
+            self.timeline.insert((message.get_time_created(), message.get_message_id()))
+
+    def remove_from_timeline(self, message):
+        '''
+        Remove the message from the timeline if it is listed there
+        '''
+        with self.lock:
+            self.timeline.remove((message.get_time_created(), message.get_message_id()))
+
+    def get_pinned(self):
+        '''
+        Return the (time_created, message_id) pairs of the pinned messages
+        which can be seen in the channel, ordered from the oldest
+        '''
+        return self.pinned
+
+    def add_pinned(self, message):
+        '''
+        Insert the message into the pinned messages, unless it is there
+        '''
+        entry = (message.get_time_created(), message.get_message_id())
+        with self.lock:
+            index = bisect.bisect_left(self.pinned, entry)
+            if index == len(self.pinned) or self.pinned[index] != entry:
+                self.pinned.insert(index, entry)
+
+    def remove_pinned(self, message):
+        '''
+        Remove the message from the pinned messages if it is there
+        '''
+        entry = (message.get_time_created(), message.get_message_id())
+        with self.lock:
+            index = bisect.bisect_left(self.pinned, entry)
+            if index < len(self.pinned) and self.pinned[index] == entry:
+                del self.pinned[index]
+
+    def add_removed(self, message):
+        '''
+        Keep the time_created of a removed message of the channel which is
+        being compacted
+        '''
+        message_id = message.get_message_id()
+        with self.lock:
+            index = bisect.bisect_left(self.removed_ids, message_id)
+            if index == len(self.removed_ids) or self.removed_ids[index] != message_id:
+                self.removed_ids.insert(index, message_id)
+                self.removed_times.insert(index, message.get_time_created())
+
+    def get_cursor(self, message_id):
+        '''
+        Return the (time_created, message_id) of the message of the channel
+        with the passed in message_id, as it is ordered in the timeline, even
+        once it has been removed and compacted. None will be returned if it is
+        not a message of the channel.
+        '''
+        with self.lock:
+            index = bisect.bisect_left(self.removed_ids, message_id)
+            if index < len(self.removed_ids) and self.removed_ids[index] == message_id:
+                return (self.removed_times[index], message_id)
+        message = Message.load(message_id)
+        if message is None or message.get_channel_id() != self.channel_id:
+            return None
+        return (message.get_time_created(), message_id)
+
+    def get_version(self):
+        '''
+        Return the version of the last change made to the messages
+        '''
+        return self.version
+
+    def add_change(self, message_id):
+        '''
+        Record a change to the message (sent, edited, removed, reacted to or
+        pinned). Return the new version of the channel.
+        '''
+        with self.lock:
+            self.version += 1
+            # move the message to the end, so changes stays ordered by version
+            self.changes.pop(message_id, None)
+            self.changes[message_id] = self.version
+            while len(self.changes) > CHANGE_HISTORY:
+                _, self.changes_floor = self.changes.popitem(last=False)
+            return self.version
+
+    @staticmethod
+    def get_message_version(channel_id, message_id):
+        '''
+        Return the version of the last change to the message in its channel,
+        or None if it has not been changed (e.g. a message sent later which
+        has not been delivered)
+        '''
+        channel_index = Channel.find_channel(channel_id)
+        if channel_index is None:
+            return None
+        return data['channels'][channel_index].changes.get(message_id)
+
+    def get_changes(self, since_version):
+        '''
+        Return the (version, message_id) of the messages changed after
+        since_version, ordered by version. Only the newest changes are read.
+        None will be returned if some of those changes are no longer kept.
+        '''
+        changes = []
+        with self.lock:
+            if since_version < self.changes_floor:
+                return None
+            for message_id, version in reversed(self.changes.items()):
+                if version <= since_version:
+                    break
+                changes.append((version, message_id))
+        changes.reverse()
+        return changes
     
+    @staticmethod
+    def add_channel(channel):
+        '''
+        Append the channel to data['channels'] and record its position in the
+        channel_index so that it can be found by channel_id in constant time.
+        '''
+        data['channel_index'][channel.get_channel_id()] = len(data['channels'])
+        data['channels'].append(channel)
+
     @staticmethod
     def find_channel(channel_id):
         '''
         Return the index of the channel whose channel_id matches the passed in
         channel_id. None will be returned if it is not found.
         '''
-        index = None
-        i = 0
-        for channel in data['channels']:
-            if channel.get_channel_id() == channel_id:
-                index = i
-                break
-            i += 1
-        return index
+        return data['channel_index'].get(channel_id)
+
+    @staticmethod
+    def get_lock(channel_id):
+        '''
+        Return the lock of the channel with the passed in channel_id. A new
+        lock is returned if the channel is not found, as there is nothing to
+        guard.
+        '''
+        index = Channel.find_channel(channel_id)
+        if index is None:
+            return threading.RLock()
+        return data['channels'][index].lock
+
+    @staticmethod
+    def get_member_details(u_id):
+        '''
+        Return the u_id, names and profile_img_url of the user with the
+        passed in u_id, as listed in all_members and owner_members. The dict
+        is shared (see User.get_view), so it must not be changed.
+        '''
+        return data['users'][User.find_user(u_id)].get_view()
+
+    @staticmethod
+    def get_user_channels(u_id):
+        '''
+        Return the channel_ids of the channels the user with the passed in
+        u_id is a member of, in the order the channels were created.
+        '''
+        return sorted(data['user_channels'].get(u_id, ()))
 
     @staticmethod
     def is_user_in_channel(u_id, channel_id):
@@ -515,13 +1253,7 @@ class Channel(object):
         with the passed in channel_id.
         '''
         index = Channel.find_channel(channel_id)
-        channel = data['channels'][index]
-        all_members = channel.get_all_members()
-        for member in all_members:
-            if u_id == member['u_id']:
-                return True
-
-        return False
+        return data['channels'][index].has_member(u_id)
 
     @staticmethod
     def is_user_owner(u_id, channel_id):
@@ -530,19 +1262,23 @@ class Channel(object):
         with the passed in channel_id.
         '''
         index = Channel.find_channel(channel_id)
-        channel = data['channels'][index]
-        owner_members = channel.get_owner_members()
-        for member in owner_members:
-            if u_id == member['u_id']:
-                return True
-
-        return False
+        return data['channels'][index].has_owner(u_id)
 
     @staticmethod
-    def standup_send_final_message(channel, message_detail):
-        message = channel.get_standup_message()
-        message_detail.set_message(message)
-        channel.set_standup_message('')
+    def standup_send_final_message(channel_id, message_id):
+        '''
+        Give the message of the standup the messages buffered by standup_send
+        '''
+        channel_index = Channel.find_channel(channel_id)
+        if channel_index is None:
+            return
+        channel = data['channels'][channel_index]
+        with channel.lock:
+            message = channel.get_standup_message()
+            Message.modify_message_by_id(message_id, message)
+            channel.set_standup_message('')
+            bus.publish(channel_id, 'standup_finished', message_id=message_id,
+                        time_finish=channel.get_time_finish())
 
 class Message(object):
     '''
@@ -553,18 +1289,45 @@ class Message(object):
             'message': string, 
             'channel_id': integer,
             'time_created': double,
+            'reacts': None, or {react_id: {u_id: None}} once someone has
+                      reacted, the u_ids kept as an ordered set
+            'is_pinned': boolean,
         }
     ],
+    Tens of millions of messages can be held, so a message has no __dict__
+    and its reacts are only allocated by the first react.
     '''
+    __slots__ = ('message_id', 'u_id', 'message', 'channel_id', 'time_created',
+                 'reacts', 'is_pinned')
+
+    def __setstate__(self, state):
+        _, slots = state
+        for name, value in slots.items():
+            setattr(self, name, value)
+        # older snapshots keep the u_ids of a react in a list
+        if self.reacts is not None:
+            self.reacts = {react_id: dict.fromkeys(u_ids) for react_id, u_ids in self.reacts.items()}
+
     def __init__(self, message_id=None, u_id=None, message=None, channel_id=None, time_created=None, reacts=None, is_pinned=None):
         self.message_id = message_id
         self.u_id = u_id
         self.message = message
         self.channel_id = channel_id
         self.time_created = time_created
-        self.reacts = reacts
+        self.reacts = None
+        self.set_reacts(reacts)
         self.is_pinned = is_pinned
 
+    def get_copy(self):
+        '''
+        Return a copy of the message which later changes do not reach
+        '''
+        message = Message(self.message_id, self.u_id, self.message, self.channel_id,
+                          self.time_created, None, self.is_pinned)
+        if self.reacts is not None:
+            message.reacts = {react_id: dict(u_ids) for react_id, u_ids in self.reacts.items()}
+        return message
+
     def set_message_id(self, message_id):
         '''
         Replace the message_id by the passed in message_id
@@ -597,9 +1360,13 @@ class Message(object):
 
     def set_reacts(self, reacts):
         '''
-        Replace the reacts by the passed in time_created
+        Replace the reacts by the passed in reacts, given in the same
+        [{'react_id', 'u_ids'}] format as get_reacts returns
         '''
-        self.reacts = reacts
+        self.reacts = None
+        for react in reacts or []:
+            for u_id in react['u_ids']:
+                self.add_react(react['react_id'], u_id)
 
     def set_is_pinned(self, is_pinned):
         '''
@@ -639,9 +1406,65 @@ class Message(object):
 
     def get_reacts(self):
         '''
-        Return the reacts of the objec
+        Return the reacts of the object as a new list of
+        {'react_id', 'u_ids'} dictionaries ordered by react_id. React 1 is
+        always listed, the others once someone has reacted with them.
+        '''
+        reacts = [{'react_id': 1, 'u_ids': []}]
+        if self.reacts is not None:
+            for react_id in sorted(self.reacts):
+                if react_id == 1:
+                    reacts[0]['u_ids'] = list(self.reacts[1])
+                else:
+                    reacts.append({'react_id': react_id, 'u_ids': list(self.reacts[react_id])})
+        return reacts
+
+    def get_react_count(self, react_id):
+        '''
+        Return the number of users who have reacted to the object with
+        react_id
         '''
-        return self.reacts
+        if self.reacts is None:
+            return 0
+        return len(self.reacts.get(react_id, ()))
+
+    def has_react(self, react_id, u_id):
+        '''
+        Return whether the user has reacted to the object with react_id
+        '''
+        if self.reacts is None:
+            return False
+        return u_id in self.reacts.get(react_id, ())
+
+    def add_react(self, react_id, u_id):
+        '''
+        Add the react of the user, allocating the reacts on the first one
+        '''
+        with Channel.get_lock(self.channel_id):
+            if self.has_react(react_id, u_id):
+                return
+            if self.reacts is None:
+                self.reacts = {}
+            self.reacts.setdefault(react_id, {})[u_id] = None
+            bus.publish(self.channel_id, 'message_reacted', message_id=self.message_id,
+                        react_id=react_id, u_id=u_id,
+                        version=Message.add_change(self))
+
+    def remove_react(self, react_id, u_id):
+        '''
+        Remove the react of the user, freeing the reacts after the last one
+        '''
+        with Channel.get_lock(self.channel_id):
+            if not self.has_react(react_id, u_id):
+                return
+            del self.reacts[react_id][u_id]
+            if not self.reacts[react_id]:
+                del self.reacts[react_id]
+                if not self.reacts:
+                    self.reacts = None
+            bus.publish(self.channel_id, 'message_unreacted', message_id=self.message_id,
+                        react_id=react_id, u_id=u_id,
+                        version=Message.add_change(self))
 
     def get_is_pinned(self):
         '''
@@ -649,35 +1472,379 @@ class Message(object):
         '''
         return self.is_pinned
 
+    @staticmethod
+    def add_message(message):
+        '''
+        Append the message to data['messages'] and record its position in the
+        message_index so that it can be found by message_id in constant time.
+        The oldest messages are archived once there are too many.
+        '''
+        data['messages'].append(message)
+        data['message_index'][message.get_message_id()] = len(data['messages']) - 1
+        if message.get_message():
+            with Channel.get_lock(message.get_channel_id()):
+                Message.update_timeline(message, True)
+                Message.index_text(message, message.get_message())
+                Message.publish(message, 'message_sent')
+        if len(data['messages']) > data['message_archive'].get_hot_limit():
+            Message.archive_messages(HOT_MESSAGE_LIMIT // 2)
+
+    @staticmethod
+    def archive_messages(keep):
+        '''
+        Move the oldest messages of data['messages'] to the archive until only
+        keep are left. Messages with reacts or a pin stay in data['messages'].
+        The messages are in the archive before they leave data['messages'],
+        and the new data['messages'], message_index and archive (if it was
+        compacted) are swapped in under index_lock. Removed messages are
+        dropped on the way.
+        Assumes persistence.WRITE_LOCK is held.
+        '''
+        archive = data['message_archive']
+        tombstones = data['tombstones']
+        excess = len(data['messages']) - keep
+        hot_messages = []
+        dropped = []
+        for message in data['messages']:
+            if message.get_message_id() in tombstones:
+                dropped.append(message)
+            elif excess > 0 and archive.can_archive(message):
+                archive.add(message)
+                excess -= 1
+            else:
+                hot_messages.append(message)
+        message_index = {message.get_message_id(): index
+                         for index, message in enumerate(hot_messages)}
+        # the removed messages are still found as cursors once they are gone
+        for message in dropped:
+            channel_index = Channel.find_channel(message.get_channel_id())
+            data['channels'][channel_index].add_removed(message)
+        archive.set_hot_limit(len(hot_messages))
+        if archive.needs_compact():
+            archive = archive.compact()
+        with index_lock:
+            data['messages'][:] = hot_messages
+            data['message_index'] = message_index
+            data['message_archive'] = archive
+        tombstones.difference_update(message.get_message_id() for message in dropped)
+
+    @staticmethod
+    def compact_messages():
+        '''
+        Drop the removed messages from data['messages'] (and archive the
+        oldest ones if there are too many). Their message_ids are never handed
+        out again, and they are already not found by find_message.
+        Assumes persistence.WRITE_LOCK is held.
+        '''
+        if data['tombstones']:
+            Message.archive_messages(HOT_MESSAGE_LIMIT)
+
+    @staticmethod
+    def load(message_id):
+        '''
+        Return the message with the passed in message_id without taking it out
+        of the archive, so it must only be read. None will be returned if it is
+        not found.
+        No lock is needed, unless the message is not where the index says
+        because data['messages'] is being swapped by archive_messages.
+        '''
+        message = Message.load_hot(message_id)
+        if message is not None:
+            return message
+        archive = data['message_archive']
+        row = archive.find_row(message_id)
+        if row is not None:
+            return archive.load(row)
+        with index_lock:
+            return Message.load_hot(message_id)
+
+    @staticmethod
+    def load_hot(message_id):
+        '''
+        Return the message with the passed in message_id if it is in
+        data['messages'] where message_index says it is, otherwise None
+        '''
+        index = data['message_index'].get(message_id)
+        messages = data['messages']
+        if index is None or index >= len(messages):
+            return None
+        message = messages[index]
+        if message.get_message_id() != message_id:
+            return None
+        return message
+
+    @staticmethod
+    def update_timeline(message, is_visible):
+        '''
+        Add the message to (or remove it from) the timeline of its channel.
+        Only messages with a non-empty text are listed in a timeline.
+        '''
+        channel_index = Channel.find_channel(message.get_channel_id())
+        if channel_index is None:
+            return
+        channel = data['channels'][channel_index]
+        if is_visible:
+            channel.add_to_timeline(message)
+        else:
+            channel.remove_from_timeline(message)
+
+    @staticmethod
+    def update_pinned(message, is_pinned):
+        '''
+        Add the message to (or remove it from) the pinned messages of its
+        channel
+        '''
+        channel_index = Channel.find_channel(message.get_channel_id())
+        if channel_index is None:
+            return
+        channel = data['channels'][channel_index]
+        if is_pinned:
+            channel.add_pinned(message)
+        else:
+            channel.remove_pinned(message)
+
+    @staticmethod
+    def pin_message(message, is_pinned):
+        '''
+        Pin or unpin the message, keeping the pinned messages of its channel
+        up to date, and tell the clients following the channel
+        '''
+        with Channel.get_lock(message.get_channel_id()):
+            message.set_is_pinned(is_pinned)
+            if message.get_message() != '':
+                Message.update_pinned(message, is_pinned)
+            Message.publish(message, 'message_pinned' if is_pinned else 'message_unpinned')
+
     @staticmethod    
     def find_message(message_id):
         '''
         Return the index of the message whose message_id matches the passed in
-        message_id. None will be returned if it is not found.
+        message_id. An archived message is taken out of the archive and
+        appended to data['messages'] first, so that it can be changed.
+        None will be returned if it is not found or has been removed.
         '''
-        index = None
-        i = 0
-        for message in data['messages']:
-            if message.get_message_id() == message_id:
-                index = i
-                break
-            i += 1
-        return index
+        if message_id in data['tombstones']:
+            return None
+        index = data['message_index'].get(message_id)
+        if index is not None:
+            return index
+        archive = data['message_archive']
+        with index_lock:
+            row = archive.find_row(message_id)
+            if row is None:
+                return None
+            message = archive.load(row)
+            data['messages'].append(message)
+            data['message_index'][message_id] = len(data['messages']) - 1
+            archive.remove(row)
+        return data['message_index'][message_id]
 
     @staticmethod    
     def is_message_reacted_by_user(u_id, message_id, react_id):
         '''
         Check if the message is already reacted by the authorised user
         '''
-        message_index = Message.find_message(message_id)
-        for react in data['messages'][message_index].get_reacts():
-            if react['react_id'] == react_id:
-                for _u_id in react['u_ids']:
-                    if _u_id == u_id:
-                        return True
-        
-        return False
+        return Message.load(message_id).has_react(react_id, u_id)
 
     @staticmethod   
     def modify_message(_message, message):
-        _message.set_message(message)
+        '''
+        Replace the text of the message and update the search index. The
+        message leaves the timeline of its channel when the text becomes empty,
+        and joins it when a message with an empty text (e.g. a message sent
+        later) gets its text.
+        '''
+        with Channel.get_lock(_message.get_channel_id()):
+            old_message = _message.get_message()
+            if old_message == message:
+                return
+            _message.set_message(message)
+            Message.index_text(_message, message, old_message)
+            if (old_message != '') != (message != ''):
+                Message.update_timeline(_message, message != '')
+                if _message.get_is_pinned():
+                    Message.update_pinned(_message, message != '')
+            if old_message == '':
+                Message.publish(_message, 'message_sent')
+            elif message == '':
+                # the message is gone for good, its storage is reclaimed by
+                # compact_messages
+                data['tombstones'].add(_message.get_message_id())
+                Message.publish(_message, 'message_removed')
+            else:
+                Message.publish(_message, 'message_edited')
+
+    @staticmethod
+    def publish(message, event_type):
+        '''
+        Record a change to the message in its channel and tell the clients
+        following the channel about it (see events.py)
+        '''
+        with Channel.get_lock(message.get_channel_id()):
+            bus.publish(message.get_channel_id(), event_type,
+                        message_id=message.get_message_id(),
+                        u_id=message.get_u_id(),
+                        message=message.get_message(),
+                        time_created=message.get_time_created(),
+                        is_pinned=message.get_is_pinned(),
+                        version=Message.add_change(message))
+
+    @staticmethod
+    def add_change(message):
+        '''
+        Record a change to the message in its channel. Return the new version
+        of the channel, or 0 if the channel is not found.
+        '''
+        channel_index = Channel.find_channel(message.get_channel_id())
+        if channel_index is None:
+            return 0
+        return data['channels'][channel_index].add_change(message.get_message_id())
+
+    @staticmethod
+    def modify_message_by_id(message_id, message):
+        '''
+        Replace the text of the message with the passed in message_id, for the
+        scheduled jobs, which only hold on to the message_id
+        '''
+        message_index = Message.find_message(message_id)
+        if message_index is not None:
+            Message.modify_message(data['messages'][message_index], message)
+
+    @staticmethod
+    def get_grams(text):
+        '''
+        Return the set of every substring of the text which is GRAM_LENGTH
+        characters long
+        '''
+        return {text[start:start + GRAM_LENGTH]
+                for start in range(len(text) - GRAM_LENGTH + 1)}
+
+    @staticmethod
+    def build_search_index():
+        '''
+        Make data['search_index'] again from the messages in data['messages']
+        and in the archive. It is not saved in snapshots (see persistence.py).
+        The archive is read first, as its message_ids are mostly the oldest.
+        '''
+        data['search_index'] = {}
+        archive = data['message_archive']
+        for row in archive.get_live_rows():
+            message = archive.load(row)
+            Message.index_text(message, message.get_message())
+        tombstones = data['tombstones']
+        for message in data['messages']:
+            if message.get_message() and message.get_message_id() not in tombstones:
+                Message.index_text(message, message.get_message())
+
+    @staticmethod
+    def index_text(message, text, old_text=''):
+        '''
+        Add the message to the postings of every n-gram of the text which is
+        not in old_text, the text it replaces. Postings are arrays of
+        message_ids in increasing order, and a message is never taken back
+        out of them: the text of the messages found is checked when searching.
+        '''
+        channel_id = message.get_channel_id()
+        message_id = message.get_message_id()
+        for gram in Message.get_grams(text) - Message.get_grams(old_text):
+            postings = data['search_index'].setdefault(gram, {})
+            message_ids = postings.get(channel_id)
+            if message_ids is None:
+                postings[channel_id] = array('q', [message_id])
+            elif message_ids[-1] < message_id:
+                message_ids.append(message_id)
+            else:
+                # a message edited or delivered after newer ones were sent
+                index = bisect.bisect_left(message_ids, message_id)
+                if message_ids[index] != message_id:
+                    message_ids.insert(index, message_id)
+
+    @staticmethod
+    def search_channel(channel_id, query_str):
+        '''
+        Return the message_ids of the messages in the channel whose text
+        contains query_str, in the order they were sent. Only the messages
+        holding every trigram of query_str are looked at, queries shorter
+        than a trigram are checked against every message of the channel.
+        '''
+        with Channel.get_lock(channel_id):
+            if len(query_str) < GRAM_LENGTH:
+                channel = data['channels'][Channel.find_channel(channel_id)]
+                return sorted(message_id for _, message_id in channel.get_timeline()
+                              if query_str in Message.load(message_id).get_message())
+
+            grams = Message.get_grams(query_str)
+
+            # intersect the postings from the smallest one up, looking up its
+            # message_ids in the others by bisection
+            postings = []
+            for gram in grams:
+                message_ids = data['search_index'].get(gram, {}).get(channel_id)
+                if not message_ids:
+                    return []
+                postings.append(message_ids)
+            postings.sort(key=len)
+            candidates = postings[0]
+            for message_ids in postings[1:]:
+                matches = []
+                lo = 0
+                for message_id in candidates:
+                    lo = bisect.bisect_left(message_ids, message_id, lo)
+                    if lo == len(message_ids):
+                        break
+                    if message_ids[lo] == message_id:
+                        matches.append(message_id)
+                if not matches:
+                    return []
+                candidates = matches
+
+            # trigrams can match in the wrong order, and the postings still
+            # hold the messages which were edited or removed since
+            matches = []
+            for message_id in candidates:
+                message = Message.load(message_id)
+                if message is not None and query_str in message.get_message():
+                    matches.append(message_id)
+            return matches
+
+def copy_data():
+    '''
+    Return a copy of the parts of data which are saved in snapshots, which
+    the commands run after it do not change once finish_copy has been called.
+    The indexes are left out, they are made again by build_indexes. Only the
+    hot messages and the parts which are changed in place are copied, the
+    columns of the archive which are only appended to are cut by finish_copy.
+    Assumes persistence.WRITE_LOCK is held.
+    '''
+    return {
+        'users': [user.get_copy() for user in data['users']],
+        'channels': [channel.get_copy() for channel in data['channels']],
+        'messages': [message.get_copy() for message in data['messages']],
+        'sessions': dict(data['sessions']),
+        'message_archive': data['message_archive'].start_copy(),
+        'ids': data['ids'].get_copy(),
+        'tombstones': set(data['tombstones']),
+    }
+
+def finish_copy(state):
+    '''
+    Finish the copy returned by copy_data, without persistence.WRITE_LOCK
+    '''
+    state['message_archive'].finish_copy()
+    return state
+
+def build_indexes():
+    '''
+    Make the indexes of data again from the users, channels and messages,
+    once they have been loaded from a snapshot
+    '''
+    data['user_index'] = {user.get_u_id(): index for index, user in enumerate(data['users'])}
+    data['channel_index'] = {channel.get_channel_id(): index
+                             for index, channel in enumerate(data['channels'])}
+    data['message_index'] = {message.get_message_id(): index
+                             for index, message in enumerate(data['messages'])}
+    data['user_channels'] = {}
+    for channel in data['channels']:
+        for u_id in channel.get_all_members():
+            data['user_channels'].setdefault(u_id, set()).add(channel.get_channel_id())
+    Message.build_search_index()
@@ -0,0 +1,181 @@
+'''
+Events of each channel, pushed to clients by /channel/events instead of them
+polling /channel/messages and /standup/active.
+
+An event is:
+    {
+        'cursor': integer, counts up from 1 within the channel
+        'type': string, e.g. 'message_sent', 'standup_finished'
+        ...the fields of the type, e.g. 'message_id'
+    }
+The last EVENT_HISTORY events of each channel are kept, so a client which
+passes the cursor of the last event it saw gets every event after it. A
+client whose cursor is older than that, or ahead of the channel because the
+events were cleared (or the server restarted) since, is told the events are
+not complete, and has to reload the channel.
+'''
+import json
+import threading
+from collections import deque
+
+EVENT_HISTORY = 1000
+
+# seconds between the comments sent to keep an idle event stream open
+EVENT_KEEPALIVE = 15
+
+class ChannelEvents(object):
+    '''
+    The recent events of a channel and the ones waiting for more
+    '''
+    def __init__(self):
+        self.events = deque(maxlen=EVENT_HISTORY)
+        self.cursor = 0
+        self.condition = threading.Condition()
+        self.subscribers = []
+
+class EventBus(object):
+    '''
+    The events of every channel
+    '''
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def get_channel(self, channel_id):
+        '''
+        Return the ChannelEvents of the channel, made if there is none yet
+        '''
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                channel = self.channels[channel_id] = ChannelEvents()
+            return channel
+
+    def find_channel(self, channel_id):
+        '''
+        Return the ChannelEvents of the channel, or None if its events have
+        not been read or published since they were last cleared
+        '''
+        with self.lock:
+            return self.channels.get(channel_id)
+
+    def get_cursor(self, channel_id):
+        '''
+        Return the cursor of the last event of the channel
+        '''
+        return self.get_channel(channel_id).cursor
+
+    def publish(self, channel_id, event_type, **fields):
+        '''
+        Add an event to the channel, wake the ones waiting for it and pass it
+        to the subscribers. Subscribers are called while the event is being
+        published, so they must return quickly.
+        '''
+        channel = self.get_channel(channel_id)
+        with channel.condition:
+            channel.cursor += 1
+            event = dict(fields, cursor=channel.cursor, type=event_type)
+            channel.events.append(event)
+            channel.condition.notify_all()
+            subscribers = list(channel.subscribers)
+        for callback in subscribers:
+            callback(event)
+        return event
+
+    def get_events(self, channel_id, cursor):
+        '''
+        Return the events of the channel after the cursor, the cursor to pass
+        next time, and whether they are all of them (False if some are no
+        longer kept)
+        '''
+        channel = self.get_channel(channel_id)
+        with channel.condition:
+            return self.read(channel, cursor)
+
+    def wait(self, channel_id, cursor, timeout):
+        '''
+        Like get_events, but wait for up to timeout seconds for an event if
+        there is none after the cursor yet
+        '''
+        channel = self.get_channel(channel_id)
+        with channel.condition:
+            if channel.cursor == cursor and timeout:
+                channel.condition.wait_for(lambda: channel.cursor > cursor, timeout)
+            return self.read(channel, cursor)
+
+    @staticmethod
+    def read(channel, cursor):
+        '''
+        Return the kept events after the cursor, the cursor of the last event
+        and whether none are missing. A cursor ahead of the channel was
+        handed out before the events were cleared, so nothing after it is
+        known. Assumes channel.condition is held.
+        '''
+        if channel.cursor == cursor:
+            return [], cursor, True
+        if channel.cursor < cursor:
+            return [], channel.cursor, False
+        first = channel.cursor - len(channel.events) + 1
+        is_complete = cursor + 1 >= first
+        start = max(cursor + 1 - first, 0)
+        events = [channel.events[index] for index in range(start, len(channel.events))]
+        return events, channel.cursor, is_complete
+
+    def subscribe(self, channel_id, callback):
+        '''
+        Call callback(event) for every event published to the channel from
+        now, until the events are cleared. Return the ChannelEvents
+        subscribed to. Only a channel whose events have been read or
+        published can be subscribed to, so that callers check the channel
+        first (see channel.channel_events) and no entry is made for a channel
+        which does not exist. None will be returned for any other channel.
+        '''
+        channel = self.find_channel(channel_id)
+        if channel is None:
+            return None
+        with channel.condition:
+            channel.subscribers.append(callback)
+        return channel
+
+    def unsubscribe(self, channel_id, callback):
+        '''
+        Stop calling the callback
+        '''
+        channel = self.find_channel(channel_id)
+        if channel is None:
+            return
+        with channel.condition:
+            if callback in channel.subscribers:
+                channel.subscribers.remove(callback)
+
+    def clear(self):
+        '''
+        Forget the events of every channel
+        '''
+        with self.lock:
+            channels, self.channels = self.channels, {}
+        for channel in channels.values():
+            with channel.condition:
+                channel.condition.notify_all()
+
+def format_event(event):
+    '''
+    Return the event as a server-sent event
+    '''
+    return f"id: {event['cursor']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+def format_events(result):
+    '''
+    Return the events of a channel_events result as server-sent events,
+    after a 'reset' event if some of them are missing, or a comment if
+    there are none, which keeps the stream open
+    '''
+    chunks = []
+    if not result['is_complete']:
+        chunks.append('event: reset\ndata: {}\n\n')
+    chunks += [format_event(event) for event in result['events']]
+    if not chunks:
+        chunks.append(': keepalive\n\n')
+    return ''.join(chunks)
+
+bus = EventBus()
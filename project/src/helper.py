@@ -3,20 +3,40 @@ The helper_test.py only calls the static methods from different classes
 so that the helper_test.py is left unchanged
 '''
 
+from contextvars import ContextVar
+from functools import wraps
 from data import User, Channel, Message
 from error import AccessError
 
+# the u_id of the user authorised for the function currently being run
+_authorised_uid = ContextVar('authorised_uid', default=None)
+
 def authorise(function):
     '''
-    Use decorator to remove repetition with the checks for token
+    Use decorator to remove repetition with the checks for token.
+    The token is resolved once, and the u_id it belongs to can be read by the
+    decorated function through get_authorised_uid()
     '''
+    @wraps(function)
     def wrapper(*args, **kwargs):
         token = args[0]
-        if get_uid_from_token(token) is None:
+        u_id = get_uid_from_token(token)
+        if u_id is None:
             raise AccessError(description="Invalid token!")
-        return function(*args)
+        reset_token = _authorised_uid.set(u_id)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _authorised_uid.reset(reset_token)
     return wrapper
 
+def get_authorised_uid():
+    '''
+    Return the u_id of the user authorised by @authorise for the function
+    currently being run. None is returned outside of an authorised function.
+    '''
+    return _authorised_uid.get()
+
 def check_name_first(name):
     '''
     check if the name is between 1 and 50 characters.
@@ -99,7 +119,7 @@ def encrypt_password(password):
 def generate_token(u_id):
     '''
     Return the token generated based on the passed in u_id.
-    If the token does not exist, add it to the valid_tokens list
+    If the token does not exist, open a session for it in data['sessions']
     The payload:
     {
         "u_id": integer,
@@ -109,8 +129,8 @@ def generate_token(u_id):
 
 def get_uid_from_token(token):
     '''
-    Return the u_id decoded from the passed in token.
-    If the token is not in the valid_tokens list, return None.
+    Return the u_id of the session opened for the passed in token.
+    If there is no session for the token, return None.
     If the u_id does not exist, return None.
     '''
     return User.get_uid_from_token(token)
@@ -118,7 +138,7 @@ def get_uid_from_token(token):
 def invalidate_token(token):
     '''
     Assumes the token passed in is valid
-    Remove the token from the valid_tokens list
+    Close the session of the token
     '''
     User.invalidate_token(token)
 
@@ -9,12 +9,13 @@ import random
 from pytest import raises
 
 
-from error import InputError
+from error import InputError, AccessError
 from auth import auth_register, auth_login
 from helper import check_name_first, check_name_last, check_email_format, \
 check_email_repeated, check_password, check_handle, find_channel, find_user, \
 is_user_in_channel, is_user_owner, find_message, encrypt_password, \
-generate_token, get_uid_from_token, invalidate_token, is_message_reacted_by_user
+generate_token, get_uid_from_token, invalidate_token, is_message_reacted_by_user, \
+authorise, get_authorised_uid
 from channel import channel_invite
 from channels import channels_create
 from message import message_send
@@ -252,13 +253,13 @@ def test_valid_token():
 
 def test_repeated_token():
     '''
-    Make sure nothing is added to the valid_tokens list if the new token
-    generated is already in the list
+    Make sure no new session is opened if the new token generated
+    already has one
     '''
     clear()
     auth_register('h.smith@gmail.com', '12345678', 'Hadise', 'Smith')
     auth_login('h.smith@gmail.com', '12345678')
-    assert len(data['valid_tokens']) == 1
+    assert len(data['sessions']) == 1
 
 
 def test_invalidate_token():
@@ -269,9 +270,44 @@ def test_invalidate_token():
     clear()
     user1 = auth_register('h.smith@gmail.com', '12345678', 'Hadise', 'Smith')
     invalidate_token(user1['token'])
-    print(data['valid_tokens'])
+    print(data['sessions'])
     assert get_uid_from_token(user1['token']) is None
 
+def test_session_records_u_id():
+    '''
+    Test if the session opened for a token records the u_id of its user
+    '''
+    clear()
+    user1 = auth_register('h.smith@gmail.com', '12345678', 'Hadise', 'Smith')
+    assert data['sessions'][user1['token']]['u_id'] == user1['u_id']
+
+def test_token_without_session():
+    '''
+    Test if get_uid_from_token() rejects tokens which were never issued
+    '''
+    clear()
+    auth_register('h.smith@gmail.com', '12345678', 'Hadise', 'Smith')
+    assert get_uid_from_token('ThisIsAnInvalidToken') is None
+    assert get_uid_from_token(None) is None
+
+def test_authorise_passes_uid():
+    '''
+    Test if a function decorated by authorise() can read the u_id of the
+    authorised user, and that it is forgotten once the function returns
+    '''
+    clear()
+    auth_register('h.smith@gmail.com', '12345678', 'Hadise', 'Smith')
+    user2 = auth_register('t.zhang@gmail.com', '87654321', 'Tom', 'Zhang')
+
+    @authorise
+    def whoami(token):
+        return get_authorised_uid()
+
+    assert whoami(user2['token']) == user2['u_id']
+    assert get_authorised_uid() is None
+    with raises(AccessError):
+        whoami('ThisIsAnInvalidToken')
+
 def test_is_message_reacted_by_user():
     '''
     Test if is_message_reacted_by_user() is working correctly
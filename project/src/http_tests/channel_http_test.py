@@ -1910,3 +1910,151 @@ def test_channel_removeowner_invalid_token2(url):
         'u_id': user2['u_id'],
     })
     assert response.status_code == AccessError.code
+
+def test_channel_events_regular(url):
+    '''
+        test the events of a channel are streamed as they happen
+    '''
+    requests.delete(f'{url}clear')
+    user = requests.post(f'{url}auth/register', json={
+        'email': "t.holland@gmail.com",
+        'password': "12345678",
+        'name_first': "Tom",
+        'name_last': "Holland",
+    }).json()
+    channel = requests.post(f'{url}channels/create', json={
+        'token': user['token'],
+        'name': "COMP1531",
+        'is_public': True,
+    }).json()
+
+    stream = requests.get(f'{url}channel/events', params={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+    }, stream=True, timeout=10)
+    assert stream.headers['Content-Type'].startswith('text/event-stream')
+    lines = stream.iter_lines(chunk_size=1, decode_unicode=True)
+    # the stream starts with a comment when there are no events yet
+    assert next(lines) == ': keepalive'
+
+    requests.post(f'{url}message/send', json={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+        'message': "Hello",
+    })
+    event = [line for line in [next(lines), next(lines), next(lines), next(lines)] if line]
+    stream.close()
+    assert event[0] == 'id: 1'
+    assert event[1] == 'event: message_sent'
+    assert '"message": "Hello"' in event[2]
+
+    # a client resuming after the event gets nothing more
+    response = requests.get(f'{url}channel/events', params={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+        'cursor': 0,
+    }, stream=True, timeout=10)
+    assert next(response.iter_lines(chunk_size=1, decode_unicode=True)) == 'id: 1'
+    response.close()
+
+def test_channel_events_not_member(url):
+    '''
+        test the stream is refused to a user outside the channel
+    '''
+    requests.delete(f'{url}clear')
+    user1 = requests.post(f'{url}auth/register', json={
+        'email': "t.holland@gmail.com",
+        'password': "12345678",
+        'name_first': "Tom",
+        'name_last': "Holland",
+    }).json()
+    user2 = requests.post(f'{url}auth/register', json={
+        'email': "h.styles@gmail.com",
+        'password': "12345678",
+        'name_first': "Harry",
+        'name_last': "Styles",
+    }).json()
+    channel = requests.post(f'{url}channels/create', json={
+        'token': user1['token'],
+        'name': "COMP1531",
+        'is_public': True,
+    }).json()
+    response = requests.get(f'{url}channel/events', params={
+        'token': user2['token'],
+        'channel_id': channel['channel_id'],
+    })
+    assert response.json()['code'] == AccessError.code
+
+def test_channel_sync_regular(url):
+    '''
+        test the messages after a message and the changes since a version
+    '''
+    requests.delete(f'{url}clear')
+    user = requests.post(f'{url}auth/register', json={
+        'email': "t.holland@gmail.com",
+        'password': "12345678",
+        'name_first': "Tom",
+        'name_last': "Holland",
+    }).json()
+    channel = requests.post(f'{url}channels/create', json={
+        'token': user['token'],
+        'name': "COMP1531",
+        'is_public': True,
+    }).json()
+    message_ids = [requests.post(f'{url}message/send', json={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+        'message': text,
+    }).json()['message_id'] for text in ["Hello", "World"]]
+
+    result = requests.get(f'{url}channel/sync', params={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+        'after': message_ids[0],
+    }).json()
+    assert [message['message'] for message in result['messages']] == ["World"]
+    assert result['has_more'] is False
+
+    requests.put(f'{url}message/edit', json={
+        'token': user['token'],
+        'message_id': message_ids[0],
+        'message': "Hi",
+    })
+    result = requests.get(f'{url}channel/sync', params={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+        'since_version': result['version'],
+    }).json()
+    assert [message['message'] for message in result['messages']] == ["Hi"]
+
+def test_channel_pinned_regular(url):
+    '''
+        test the pinned messages of a channel are returned
+    '''
+    requests.delete(f'{url}clear')
+    user = requests.post(f'{url}auth/register', json={
+        'email': "t.holland@gmail.com",
+        'password': "12345678",
+        'name_first': "Tom",
+        'name_last': "Holland",
+    }).json()
+    channel = requests.post(f'{url}channels/create', json={
+        'token': user['token'],
+        'name': "COMP1531",
+        'is_public': True,
+    }).json()
+    message_ids = [requests.post(f'{url}message/send', json={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+        'message': text,
+    }).json()['message_id'] for text in ["Hello", "World"]]
+    requests.post(f'{url}message/pin', json={
+        'token': user['token'],
+        'message_id': message_ids[1],
+    })
+
+    result = requests.get(f'{url}channel/pinned', params={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+    }).json()
+    assert [message['message'] for message in result['messages']] == ["World"]
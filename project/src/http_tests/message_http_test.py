@@ -1669,7 +1669,7 @@ def test_message_react_invalid_react_id(url):
     message = response.json()
 
     # check if an InputError is raised if react_id is invalid
-    invalid_react_id = 2
+    invalid_react_id = 0
     response = requests.post(url_react, json={
         'token': user['token'],
         'message_id':  message['message_id'],
@@ -2128,7 +2128,7 @@ def test_message_unreact_invalid_react_id(url):
         'react_id': 1,
     })
     # check if an InputError is raised if react_id is invalid
-    invalid_react_id = 2
+    invalid_react_id = 0
     response = requests.post(url_unreact, json={
         'token': user['token'],
         'message_id': message['message_id'],
@@ -3161,4 +3161,62 @@ def test_message_unpin_invalid_token2(url):
         'token': user['token'],
         'message_id': message['message_id'],
     })
-    assert response.status_code == AccessError.code
\ No newline at end of file
+    assert response.status_code == AccessError.code
+
+
+def test_message_sendbatch_regular(url):
+    '''
+    Test if many messages are sent in one request
+    '''
+    requests.delete(f'{url}clear')
+    user = requests.post(f'{url}auth/register', json={
+        'email': 't.holland@gmail.com',
+        'password': '12345678',
+        'name_first': 'Tom',
+        'name_last': 'Holland',
+    }).json()
+    channel = requests.post(f'{url}channels/create', json={
+        'token': user['token'],
+        'name': 'COMP1531',
+        'is_public': True,
+    }).json()
+
+    result = requests.post(f'{url}message/sendbatch', json={
+        'token': user['token'],
+        'messages': [{'channel_id': channel['channel_id'], 'message': f'Hello {i}'} for i in range(3)],
+    }).json()
+    assert len(result['message_ids']) == 3
+
+    messages = requests.get(f'{url}channel/messages', params={
+        'token': user['token'],
+        'channel_id': channel['channel_id'],
+        'start': 0,
+    }).json()['messages']
+    assert [message['message_id'] for message in messages] == result['message_ids'][::-1]
+
+def test_message_sendbatch_malformed(url):
+    '''
+    Test if malformed messages are answered with InputError rather than a
+    server error
+    '''
+    requests.delete(f'{url}clear')
+    user = requests.post(f'{url}auth/register', json={
+        'email': 't.holland@gmail.com',
+        'password': '12345678',
+        'name_first': 'Tom',
+        'name_last': 'Holland',
+    }).json()
+    channel = requests.post(f'{url}channels/create', json={
+        'token': user['token'],
+        'name': 'COMP1531',
+        'is_public': True,
+    }).json()
+
+    for messages in [None, ['x'], [{'channel_id': channel['channel_id']}],
+                     [{'channel_id': channel['channel_id'], 'message': 1531}]]:
+        response = requests.post(f'{url}message/sendbatch', json={
+            'token': user['token'],
+            'messages': messages,
+        })
+        assert response.status_code == InputError.code
+        assert response.json()['code'] == InputError.code
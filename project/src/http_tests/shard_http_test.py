@@ -0,0 +1,201 @@
+'''
+http test for the server when channels are split across two shards
+'''
+import os
+import re
+from subprocess import Popen, PIPE
+import signal
+from time import sleep
+import requests
+import pytest
+from error import AccessError
+
+
+
+# Use this fixture to get the URL of the router. It starts the router, which
+# starts the shards.
+@pytest.fixture
+def url():
+    '''Generate the url'''
+    url_re = re.compile(r' \* Running on ([^ ]*)')
+    env = dict(os.environ, FLOCKR_SHARDS='2')
+    server = Popen(["python3", "src/server.py"], stderr=PIPE, stdout=PIPE, env=env)
+    line = server.stderr.readline()
+    local_url = url_re.match(line.decode())
+    if local_url:
+        yield local_url.group(1)
+        # Terminate the server
+        server.send_signal(signal.SIGINT)
+        waited = 0
+        while server.poll() is None and waited < 5:
+            sleep(0.1)
+            waited += 0.1
+        if server.poll() is None:
+            server.kill()
+    else:
+        server.kill()
+        raise Exception("Couldn't get URL from local server")
+
+
+def test_shards_regular(url):
+    '''
+    test if channels are created on both shards, requests reach the shard
+    owning the channel or message, and list and search merge every shard
+    '''
+    requests.delete(f'{url}clear')
+
+    # register two users, who are known to every shard
+    user1 = requests.post(f'{url}auth/register', json={
+        'email': 't.holland@gmail.com',
+        'password': '12345678',
+        'name_first': 'Tom',
+        'name_last': 'Holland',
+    }).json()
+    user2 = requests.post(f'{url}auth/register', json={
+        'email': 'h.styles@gmail.com',
+        'password': '12345678',
+        'name_first': 'Harry',
+        'name_last': 'Styles',
+    }).json()
+
+    channels = []
+    for name in ['COMP1531', 'COMP2521']:
+        channel = requests.post(f'{url}channels/create', json={
+            'token': user1['token'],
+            'name': name,
+            'is_public': True,
+        }).json()
+        requests.post(f'{url}channel/join', json={
+            'token': user2['token'],
+            'channel_id': channel['channel_id'],
+        })
+        message = requests.post(f'{url}message/send', json={
+            'token': user2['token'],
+            'channel_id': channel['channel_id'],
+            'message': f'Hello {name}',
+        }).json()
+        response = requests.post(f'{url}message/react', json={
+            'token': user1['token'],
+            'message_id': message['message_id'],
+            'react_id': 1,
+        })
+        assert response.status_code == 200
+        channels.append(dict(channel, name=name))
+
+    # the two channels are owned by different shards
+    assert channels[0]['channel_id'] % 2 != channels[1]['channel_id'] % 2
+
+    # a batch is split between the shards and its message_ids put back in order
+    batch = requests.post(f'{url}message/sendbatch', json={
+        'token': user1['token'],
+        'messages': [{'channel_id': channel['channel_id'], 'message': f'Batch {channel["name"]}'}
+                     for channel in channels + channels],
+    }).json()
+    assert [message_id % 2 for message_id in batch['message_ids']] == \
+        [channel['channel_id'] % 2 for channel in channels + channels]
+
+    result = requests.get(f'{url}channels/list', params={'token': user2['token']}).json()
+    assert [channel['name'] for channel in result['channels']] == ['COMP1531', 'COMP2521']
+
+    result = requests.get(f'{url}search', params={'token': user2['token'], 'query_str': 'Hello'}).json()
+    assert sorted(message['message'] for message in result['messages']) == ['Hello COMP1531', 'Hello COMP2521']
+    assert all(message['reacts'][0]['u_ids'] == [user1['u_id']] for message in result['messages'])
+
+    # a change of name made on the first shard is seen by the second
+    requests.put(f'{url}user/profile/setname', json={
+        'token': user2['token'],
+        'name_first': 'Harold',
+        'name_last': 'Styles',
+    })
+    for channel in channels:
+        result = requests.get(f'{url}channel/details', params={
+            'token': user1['token'],
+            'channel_id': channel['channel_id'],
+        }).json()
+        assert [member['name_first'] for member in result['all_members']] == ['Tom', 'Harold']
+
+def test_shards_logout(url):
+    '''
+    test if a logout stops the token being accepted by every shard
+    '''
+    requests.delete(f'{url}clear')
+
+    user = requests.post(f'{url}auth/register', json={
+        'email': 't.holland@gmail.com',
+        'password': '12345678',
+        'name_first': 'Tom',
+        'name_last': 'Holland',
+    }).json()
+    channels = [requests.post(f'{url}channels/create', json={
+        'token': user['token'],
+        'name': name,
+        'is_public': True,
+    }).json() for name in ['COMP1531', 'COMP2521']]
+    requests.post(f'{url}auth/logout', json={'token': user['token']})
+
+    for channel in channels:
+        response = requests.get(f'{url}channel/details', params={
+            'token': user['token'],
+            'channel_id': channel['channel_id'],
+        })
+        assert response.json()['code'] == AccessError.code
+
+def test_shards_apply_refused(url):
+    '''
+    test if the commands sent to /shard/apply by anything but the router are
+    not applied
+    '''
+    requests.delete(f'{url}clear')
+
+    user = requests.post(f'{url}auth/register', json={
+        'email': 't.holland@gmail.com',
+        'password': '12345678',
+        'name_first': 'Tom',
+        'name_last': 'Holland',
+    }).json()
+    response = requests.post(f'{url}shard/apply', json={'commands': [
+        {'time': 0, 'command': 'other.clear', 'args': []},
+    ]})
+    assert response.json()['code'] == AccessError.code
+
+    # the user was not cleared
+    result = requests.get(f'{url}user/profile', params={
+        'token': user['token'],
+        'u_id': user['u_id'],
+    }).json()
+    assert result['user']['email'] == 't.holland@gmail.com'
+
+def test_shards_events(url):
+    '''
+    test if the events of a channel are streamed through the router from the
+    shard owning it
+    '''
+    requests.delete(f'{url}clear')
+
+    user = requests.post(f'{url}auth/register', json={
+        'email': 't.holland@gmail.com',
+        'password': '12345678',
+        'name_first': 'Tom',
+        'name_last': 'Holland',
+    }).json()
+    channels = [requests.post(f'{url}channels/create', json={
+        'token': user['token'],
+        'name': name,
+        'is_public': True,
+    }).json() for name in ['COMP1531', 'COMP2521']]
+
+    for channel in channels:
+        stream = requests.get(f'{url}channel/events', params={
+            'token': user['token'],
+            'channel_id': channel['channel_id'],
+        }, stream=True, timeout=10)
+        lines = stream.iter_lines(chunk_size=1, decode_unicode=True)
+        assert next(lines) == ': keepalive'
+        requests.post(f'{url}message/send', json={
+            'token': user['token'],
+            'channel_id': channel['channel_id'],
+            'message': 'Hello',
+        })
+        event = [line for line in [next(lines), next(lines), next(lines)] if line]
+        assert event == ['id: 1', 'event: message_sent']
+        stream.close()
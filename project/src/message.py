@@ -1,9 +1,17 @@
-from data import data, User, Channel, Message
+from data import data, User, Channel, Message, time_now, VALID_REACT_IDS
 from error import InputError, AccessError
-from datetime import datetime, timezone
-import threading
-from helper import authorise
+from helper import authorise, get_authorised_uid
+from persistence import persist, WRITE_LOCK
+from scheduler import scheduler
 
+# the most messages message_sendbatch sends in one call
+BATCH_LIMIT = 1000
+
+# seconds between the removal of a message and the compaction which drops it
+# from data['messages'], so that the removals in between are compacted at once
+COMPACT_DELAY = 60
+
+@persist
 @authorise
 def message_send(token, channel_id, message):
     '''
@@ -20,7 +28,7 @@ def message_send(token, channel_id, message):
     }
     '''
     # find the matching user by token 
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     # InputError when message is more than 1000 characters
     if len(message) > 1000:
@@ -38,23 +46,86 @@ def message_send(token, channel_id, message):
 
     # intiate message, message_id is non-neagtive interger which starts from 0
     message_detail = Message()
-    message_detail.set_message_id(len(data['messages']))
+    message_detail.set_message_id(data['ids'].allocate('messages'))
     message_detail.set_message(message)
     message_detail.set_u_id(u_id)
     message_detail.set_channel_id(channel_id)
-    message_detail.set_reacts([{'react_id': 1, 'u_ids': []}])
     message_detail.set_is_pinned(False)
-    dt_now = datetime.utcnow()
-    timestamp = int(dt_now.replace(tzinfo=timezone.utc).timestamp())
-    message_detail.set_time_created(timestamp)
+    message_detail.set_time_created(time_now())
     # insert message to the front of data['messages']
-    data['messages'].append(message_detail)
+    Message.add_message(message_detail)
 
     # return a dictionary which contains message_id
     return {
         'message_id': message_detail.get_message_id()
     }
 
+@persist
+@authorise
+def message_sendbatch(token, messages):
+    '''
+    Send many messages from authorised_user at once, each to the channel
+    given with it. Every message is checked before any is sent, so either
+    all of them are sent or none is.
+	Input format:
+    (
+        token: string,
+		messages: [{channel_id: integer, message: string}],
+    )
+    Output format:
+    {
+        message_ids: [integer], in the order of messages
+    }
+    '''
+    # find the matching user by token 
+    u_id = get_authorised_uid()
+
+    # InputError when the messages are not a list of
+    # {channel_id: integer, message: string}
+    if type(messages) is not list:
+        raise InputError(description="Messages Must Be A List")
+    for item in messages:
+        if type(item) is not dict or type(item.get('channel_id')) is not int \
+                or type(item.get('message')) is not str:
+            raise InputError(description="Invalid Message(needs an integer channel_id and a string message)")
+
+    # InputError when there are more than BATCH_LIMIT messages
+    if len(messages) > BATCH_LIMIT:
+        raise InputError(description="Too Many Messages")
+
+    # check the membership of the user once per channel
+    is_flockr_owner = data['users'][User.find_user(u_id)].get_permission_id() == 1
+    checked_channels = set()
+    for item in messages:
+        # InputError when a message is more than 1000 characters or empty
+        if len(item['message']) > 1000:
+            raise InputError(description="Message Too Long")
+        if len(item['message']) == 0:
+            raise InputError(description="Invalid Message(empty string)")
+
+        channel_id = item['channel_id']
+        if channel_id in checked_channels:
+            continue
+        if Channel.find_channel(channel_id) == None:
+            raise InputError(description="Invalid Channel ID")
+        # AccessError when the authorised user has not 
+        # joined a channel they are trying to post to
+        if Channel.is_user_in_channel(u_id, channel_id) == False and not is_flockr_owner:
+            raise AccessError(description="Authorised User Not In Channel")
+        checked_channels.add(channel_id)
+
+    # the messages share one time_created and a block of message_ids
+    time_created = time_now()
+    message_ids = list(data['ids'].allocate_block('messages', len(messages)))
+    for message_id, item in zip(message_ids, messages):
+        Message.add_message(Message(message_id, u_id, item['message'], item['channel_id'],
+                                    time_created, None, False))
+
+    return {
+        'message_ids': message_ids,
+    }
+
+@persist
 @authorise
 def message_remove(token, message_id):
     '''
@@ -69,7 +140,7 @@ def message_remove(token, message_id):
     }
     '''
     # find the matching user by token
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     message_index = Message.find_message(message_id)    
     # InputError when message (based on ID) no longer exists
@@ -86,11 +157,13 @@ def message_remove(token, message_id):
         raise AccessError(description="No Permission")
     
     # remove the message from the channel. If the message is empty string, it no longer exist.
-    data['messages'][message_index].set_message('')
+    Message.modify_message(data['messages'][message_index], '')
+    schedule_compaction()
 
     return {
     }
 
+@persist
 @authorise
 def message_edit(token, message_id, message):
     '''
@@ -107,7 +180,7 @@ def message_edit(token, message_id, message):
     }
     '''
     # find the matching user by token 
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     message_index = Message.find_message(message_id)
     # Assumption: InputError when message (based on ID) no longer exists
@@ -127,11 +200,14 @@ def message_edit(token, message_id, message):
         raise InputError(description="Invalid Message")
 
     # update message's text with new text.
-    data['messages'][message_index].set_message(message)
+    Message.modify_message(data['messages'][message_index], message)
+    if message == '':
+        schedule_compaction()
 
     return {
     }
 
+@persist
 @authorise
 def message_sendlater(token, channel_id, message, time_sent):
     '''
@@ -148,11 +224,9 @@ def message_sendlater(token, channel_id, message, time_sent):
     }
     '''
     # find the matching user by token
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
-    dt_now = datetime.utcnow()
-    time_now = int(dt_now.replace(tzinfo=timezone.utc).timestamp())
-    time_diff = time_sent - time_now
+    time_diff = time_sent - time_now()
 
     channel_index = Channel.find_channel(channel_id)
     # InputError when any of:
@@ -171,24 +245,55 @@ def message_sendlater(token, channel_id, message, time_sent):
     message_detail = Message()
 
     # set attributes and set message empty string at first
-    message_detail.set_message_id(len(data['messages']))
+    message_detail.set_message_id(data['ids'].allocate('messages'))
     message_detail.set_message('')
     message_detail.set_u_id(u_id)
     message_detail.set_channel_id(channel_id)
-    message_detail.set_reacts([{'react_id': 1, 'u_ids': []}])
     message_detail.set_is_pinned(False)
     message_detail.set_time_created(time_sent)
     # insert message to the front of data['messages']
-    data['messages'].append(message_detail)
+    Message.add_message(message_detail)
 
-    # modify message after time_diff seconds
-    t = threading.Timer(time_diff, Message.modify_message, (message_detail, message,))
-    t.start()
+    # modify message at time_sent
+    message_id = message_detail.get_message_id()
+    scheduler.schedule(f'message_sendlater:{message_id}', time_sent, 'message_sendlater', (message_id, message,))
 
     return {
         'message_id': message_detail.get_message_id(),
     }
 
+@persist
+def message_sendlater_deliver(message_id, message):
+    '''
+    Give the message sent by message_sendlater its text, run by the scheduler
+    at time_sent. It removes its own job so that the two are logged together.
+    '''
+    scheduler.cancel(f'message_sendlater:{message_id}')
+    Message.modify_message_by_id(message_id, message)
+    return {}
+
+scheduler.register('message_sendlater', message_sendlater_deliver)
+
+def schedule_compaction():
+    '''
+    Compact the removed messages in COMPACT_DELAY seconds, unless a
+    compaction is already waiting
+    '''
+    if not scheduler.has_job('message_compact'):
+        scheduler.schedule('message_compact', time_now() + COMPACT_DELAY, 'message_compact', ())
+
+def message_compact():
+    '''
+    Reclaim the storage of the removed messages, run by the scheduler. It is
+    not logged: replaying the removals leaves tombstones to compact again.
+    '''
+    with WRITE_LOCK:
+        scheduler.cancel('message_compact')
+        Message.compact_messages()
+
+scheduler.register('message_compact', message_compact)
+
+@persist
 @authorise
 def message_react(token, message_id, react_id):
     '''
@@ -204,25 +309,24 @@ def message_react(token, message_id, react_id):
     }
     '''
     # find the matching user by token
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     # InputError when any of:
     # message_id is not a valid message within a channel that the authorised user has joined
-    # react_id is not a valid React ID. The only valid react ID the frontend has is 1
+    # react_id is not a valid React ID (see VALID_REACT_IDS)
     # Message with ID message_id already contains an active React with ID react_id from the authorised user
     message_index = Message.find_message(message_id)
     if message_index == None or Channel.is_user_in_channel(u_id, data['messages'][message_index].get_channel_id()) == False or \
-    react_id != 1 or Message.is_message_reacted_by_user(u_id, message_id, react_id) == True:
+    react_id not in VALID_REACT_IDS or Message.is_message_reacted_by_user(u_id, message_id, react_id) == True:
         raise InputError(description="Invalid Message ID or Invalid React ID")
 
     # Append u_id into  react['u_ids']
-    for react in data['messages'][message_index].get_reacts():
-        if react['react_id'] == react_id:
-            react['u_ids'].append(u_id)
+    data['messages'][message_index].add_react(react_id, u_id)
 
     return {
     }
 
+@persist
 @authorise
 def message_unreact(token, message_id, react_id):
     '''
@@ -238,25 +342,24 @@ def message_unreact(token, message_id, react_id):
     }
     '''
     # find the matching user by token s
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     # InputError when any of:
     # message_id is not a valid message within a channel that the authorised user has joined
-    # react_id is not a valid React ID. The only valid react ID the frontend has is 1
+    # react_id is not a valid React ID (see VALID_REACT_IDS)
     # Message with ID message_id already contains an active React with ID react_id from the authorised user
     message_index = Message.find_message(message_id)
     if message_index == None or Channel.is_user_in_channel(u_id, data['messages'][message_index].get_channel_id()) == False or \
-    react_id != 1 or Message.is_message_reacted_by_user(u_id, message_id, react_id) == False:
+    react_id not in VALID_REACT_IDS or Message.is_message_reacted_by_user(u_id, message_id, react_id) == False:
         raise InputError(description="Invalid Message ID or Invalid React ID")
 
-    # Append u_id into  react['u_ids']
-    for react in data['messages'][message_index].get_reacts():
-        if react['react_id'] == react_id:
-            react['u_ids'].remove(u_id)
+    # Remove u_id from react['u_ids']
+    data['messages'][message_index].remove_react(react_id, u_id)
 
     return {
     }
 
+@persist
 @authorise
 def message_pin(token, message_id):
 	'''
@@ -272,7 +375,7 @@ def message_pin(token, message_id):
 	}
 	'''
     # find the matching user by token s
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 	
 	message_index = Message.find_message(message_id)
 	# InputError when any of:
@@ -289,11 +392,12 @@ def message_pin(token, message_id):
 		raise AccessError(description="Not a Owner")
 
 	# set is_pinned to be Trueqqqqqqqqq
-	data['messages'][message_index].set_is_pinned(True)
+	Message.pin_message(data['messages'][message_index], True)
 	
 	return {
 	}
 
+@persist
 @authorise
 def message_unpin(token, message_id):
 	'''
@@ -308,7 +412,7 @@ def message_unpin(token, message_id):
 	}
 	'''
     # find the matching user by token 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 	
 	message_index = Message.find_message(message_id)
 	# InputError when any of:
@@ -325,7 +429,7 @@ def message_unpin(token, message_id):
 		raise AccessError(description="Not a Owner")
 	
 	# set is_pinned to be Flase
-	data['messages'][message_index].set_is_pinned(False)
+	Message.pin_message(data['messages'][message_index], False)
 	
 	return {
 	}
@@ -1,7 +1,12 @@
-from data import data, User, Message
-from helper import get_uid_from_token, find_user, authorise
+from data import data, User, Channel, Message
+from helper import authorise, get_authorised_uid
+from persistence import persist
+from scheduler import scheduler
+from events import bus
+from views import views, get_message_view
 from error import InputError, AccessError
 
+@persist
 def clear():
 	'''
 	Resets the internal data of the application to 
@@ -14,7 +19,18 @@ def clear():
 	data['users'].clear()
 	data['channels'].clear()
 	data['messages'].clear()
-	data['valid_tokens'].clear()
+	data['sessions'].clear()
+	data['user_index'].clear()
+	data['channel_index'].clear()
+	data['message_index'].clear()
+	data['message_archive'].clear()
+	data['ids'].clear()
+	data['user_channels'].clear()
+	data['search_index'].clear()
+	data['tombstones'].clear()
+	views.clear()
+	scheduler.cancel_all()
+	bus.clear()
 	return {}
 
 @authorise
@@ -51,6 +67,7 @@ def users_all(token):
 		'users': users_detail,
 	}
 
+@persist
 @authorise
 def admin_userpermission_change(token, u_id, permission_id):
 	'''
@@ -71,7 +88,7 @@ def admin_userpermission_change(token, u_id, permission_id):
 	if user_index == None:
 		raise InputError(description="Invalid u_id")
 
-	u_id2 = User.get_uid_from_token(token)
+	u_id2 = get_authorised_uid()
 	user_index2 = User.find_user(u_id2)	
 
 	Owner_permission = 1
@@ -83,7 +100,7 @@ def admin_userpermission_change(token, u_id, permission_id):
 		raise AccessError(description="Authorised user is not an owner")
 
 	
-	data['users'][u_id].set_permission_id(permission_id)
+	data['users'][user_index].set_permission_id(permission_id)
 	return {}
 
 @authorise
@@ -112,39 +129,18 @@ def search(token, query_str):
 	# create a new list to store the result
 	message_results = {'messages':[]}
 
-	u_id = User.get_uid_from_token(token)
+	u_id = get_authorised_uid()
 
 	# find all the channel_id that the authorised user is in and 
 	# collect them in a new list
-	channel_id_list = []
-	for channel in data['channels']:
-		for find_uid_channel in channel.get_all_members():
-			if u_id == find_uid_channel['u_id']:
-				channel_id_list.append(channel.get_channel_id())
+	channel_id_list = Channel.get_user_channels(u_id)
 	
-	# search through all the messages in the channels of the authorised 
-	# user to find the correct message and put them in a new dictionary
+	# look up the matching messages of each channel in the search index
+	# and put them in a new dictionary
 	for _channel in channel_id_list:
-		for message in data['messages']:
-			if _channel == message.get_channel_id():
-				mess_str = message.get_message()
-				check_str = query_str
-				if check_str in mess_str:
-					new_message = {
-						'message_id': message.get_message_id(), 
-						'u_id': message.get_u_id(), 
-						'message': message.get_message(), 
-						'time_created': message.get_time_created(),
-						'reacts': message.get_reacts(),
-						'is_pinned': message.get_is_pinned(),
-					}
-					i = 0
-					for react in new_message['reacts']:
-						if Message.is_message_reacted_by_user(u_id, new_message['message_id'], react['react_id']):
-							new_message['reacts'][i]['is_this_user_reacted'] = True
-						else:
-							new_message['reacts'][i]['is_this_user_reacted'] = False
-						i += 1
-					message_results['messages'].append(new_message)
+		with Channel.get_lock(_channel):
+			for message_id in Message.search_channel(_channel, query_str):
+				message = Message.load(message_id)
+				message_results['messages'].append(get_message_view(message, u_id))
 	return message_results
 
@@ -0,0 +1,350 @@
+'''
+Durable storage for data.data
+
+Every successful call of a function decorated with @persist is appended to a
+write-ahead log as a command record:
+    {"seq": integer, "time": integer, "command": string, "args": list}
+Records are buffered and written by a background thread which fsyncs once per
+batch (group commit), so a request never waits for the disk. Every
+snapshot_every records data.data is pickled to a snapshot and the log is
+started again in a new segment. Only a copy of the users, channels, messages
+and the rest of the primary state is taken under WRITE_LOCK, it is pickled
+after the lock is released. The indexes are left out of the snapshot and
+made again when it is loaded. At startup the snapshot is loaded and the
+records written after it are replayed, with the clock pinned to the time each
+command was first run.
+
+The jobs pending in scheduler.py are saved with the snapshot, and the jobs
+scheduled after it are scheduled again by replaying the commands which
+scheduled them.
+
+Persistence is off until open_store() is called (see server.py), so calling
+the functions directly, as the tests do, does not touch the disk.
+
+The same records are used to copy changes between processes: the commands run
+while capture is on are collected, and apply_commands() runs them in another
+process (see shard.py).
+'''
+import os
+import json
+import pickle
+import atexit
+import threading
+from functools import wraps
+from contextvars import ContextVar
+from data import data, clock_override, time_now, copy_data, finish_copy, build_indexes
+from scheduler import scheduler
+from views import views
+
+SNAPSHOT_FILE = 'snapshot.pickle'
+SEGMENT_PREFIX = 'wal-'
+SEGMENT_SUFFIX = '.log'
+
+# name -> function, for every function decorated with @persist
+_COMMANDS = {}
+# name -> the decorated function
+_LOGGED = {}
+
+# set while a command runs, so that the commands it calls are not logged again
+_in_command = ContextVar('in_command', default=False)
+# the list the commands run are collected in while capture is on, see
+# start_capture()
+_captured = ContextVar('captured_commands', default=None)
+
+# held while a command runs, whether persistence is on or not, and while a
+# snapshot is taken. Commands are applied one at a time so that the order of
+# the log is the order they were applied in, and ids are handed out in the
+# same order when the log is replayed. Readers do not take it, they take the
+# lock of the channel they read (see data.Channel).
+WRITE_LOCK = threading.RLock()
+
+# the open WriteAheadLog, None while persistence is off or during recovery
+_store = None
+
+def persist(function):
+    '''
+    Use decorator to run the function under WRITE_LOCK and append every
+    successful call of it to the write-ahead log. It has to be placed above
+    @authorise.
+    '''
+    name = f'{function.__module__}.{function.__name__}'
+    _COMMANDS[name] = function
+
+    @wraps(function)
+    def wrapper(*args):
+        with WRITE_LOCK:
+            captured = _captured.get()
+            if (_store is None and captured is None) or _in_command.get():
+                return function(*args)
+            timestamp = time_now()
+            reset_clock = clock_override.set(timestamp)
+            reset_command = _in_command.set(True)
+            try:
+                result = function(*args)
+            finally:
+                _in_command.reset(reset_command)
+                clock_override.reset(reset_clock)
+            if _store is not None:
+                _store.append(name, args, timestamp)
+            if captured is not None:
+                captured.append({'time': timestamp, 'command': name, 'args': list(args)})
+        return result
+    _LOGGED[name] = wrapper
+    return wrapper
+
+def start_capture():
+    '''
+    Collect the commands run from now on in this context. Return the list
+    they are collected in and the token to pass to stop_capture().
+    '''
+    commands = []
+    return commands, _captured.set(commands)
+
+def stop_capture(token):
+    '''
+    Stop collecting commands
+    '''
+    _captured.reset(token)
+
+def apply_commands(records):
+    '''
+    Run the commands captured in another process as if they had been called
+    here at the time they were first run. They are logged if persistence is on.
+    The error of the first command which fails is raised, and the commands
+    after it are not run.
+    '''
+    for record in records:
+        reset_token = clock_override.set(record['time'])
+        try:
+            _LOGGED[record['command']](*record['args'])
+        finally:
+            clock_override.reset(reset_token)
+
+class WriteAheadLog(object):
+    '''
+    The log segments and the snapshot kept in a directory
+    '''
+    def __init__(self, directory, flush_interval=0.05, snapshot_every=10000):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.records_since_snapshot = 0
+        self.buffer = []
+        self.segment = None
+        self.segment_path = None
+        # held while the segment is written to or replaced
+        self.segment_lock = threading.Lock()
+        # held while a snapshot is taken, so that they are written in order
+        self.snapshot_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.is_running = False
+        self.flusher = None
+
+    def get_seq(self):
+        '''
+        Return the seq of the last record appended
+        '''
+        return self.seq
+
+    def get_segments(self):
+        '''
+        Return the paths of the log segments, oldest first
+        '''
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def open_segment(self):
+        '''
+        Start a new segment named after the seq of its first record
+        '''
+        name = f'{SEGMENT_PREFIX}{self.seq + 1:012d}{SEGMENT_SUFFIX}'
+        self.segment_path = os.path.join(self.directory, name)
+        self.segment = open(self.segment_path, 'ab')
+
+    def append(self, name, args, timestamp):
+        '''
+        Buffer a record for the flusher thread. Assumes WRITE_LOCK is held.
+        '''
+        self.seq += 1
+        self.records_since_snapshot += 1
+        record = {'seq': self.seq, 'time': timestamp, 'command': name, 'args': list(args)}
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        with self.condition:
+            self.buffer.append(line)
+            if self.records_since_snapshot >= self.snapshot_every:
+                self.condition.notify()
+
+    def flush(self):
+        '''
+        Write the buffered records to the current segment and fsync it once
+        '''
+        with self.segment_lock:
+            with self.condition:
+                lines, self.buffer = self.buffer, []
+            if lines and self.segment is not None:
+                self.segment.write(b''.join(lines))
+                self.segment.flush()
+                os.fsync(self.segment.fileno())
+
+    def snapshot(self):
+        '''
+        Pickle data.data into the snapshot file, then remove the segments
+        which only hold records older than the snapshot. WRITE_LOCK is only
+        held while the state is copied, the archived messages are copied
+        after it is let go (see copy_data).
+        '''
+        with self.snapshot_lock:
+            with WRITE_LOCK:
+                self.flush()
+                state = {'seq': self.seq, 'data': copy_data(), 'jobs': scheduler.get_pending()}
+                with self.segment_lock:
+                    old_segments = self.get_segments()
+                    if self.segment is not None:
+                        self.segment.close()
+                    self.open_segment()
+                    segment_path = self.segment_path
+                self.records_since_snapshot = 0
+            finish_copy(state['data'])
+
+            path = os.path.join(self.directory, SNAPSHOT_FILE)
+            with open(path + '.tmp', 'wb') as snapshot_file:
+                pickle.dump(state, snapshot_file, pickle.HIGHEST_PROTOCOL)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(path + '.tmp', path)
+            for segment in old_segments:
+                if segment != segment_path:
+                    os.remove(segment)
+
+    def recover(self):
+        '''
+        Load the snapshot and replay the records logged after it.
+        Return the number of records replayed.
+        '''
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, 'rb') as snapshot_file:
+                state = pickle.load(snapshot_file)
+            data.clear()
+            data.update(state['data'])
+            build_indexes()
+            views.clear()
+            self.seq = state['seq']
+            scheduler.cancel_all()
+            for job in state['jobs']:
+                scheduler.schedule(job['key'], job['deadline'], job['kind'], job['args'])
+
+        replayed = 0
+        for segment in self.get_segments():
+            with open(segment, 'r+b') as segment_file:
+                offset = 0
+                for line in segment_file:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('record without its end of line')
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last record was only partly written, cut it off
+                        # so that new records are not appended after it
+                        segment_file.truncate(offset)
+                        break
+                    offset += len(line)
+                    if record['seq'] <= self.seq:
+                        continue
+                    replay(record)
+                    self.seq = record['seq']
+                    replayed += 1
+        return replayed
+
+    def run(self):
+        '''
+        Body of the flusher thread
+        '''
+        while self.is_running:
+            with self.condition:
+                self.condition.wait(self.flush_interval)
+            self.flush()
+            if self.records_since_snapshot >= self.snapshot_every:
+                self.snapshot()
+
+    def start(self):
+        '''
+        Start the flusher thread
+        '''
+        self.is_running = True
+        self.flusher = threading.Thread(target=self.run, daemon=True)
+        self.flusher.start()
+
+    def stop(self):
+        '''
+        Stop the flusher thread and write out what is still buffered
+        '''
+        self.is_running = False
+        with self.condition:
+            self.condition.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.flush()
+        with self.segment_lock:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+def replay(record):
+    '''
+    Run a logged command again, at the time it was first run
+    '''
+    reset_token = clock_override.set(record['time'])
+    try:
+        _COMMANDS[record['command']](*record['args'])
+    except Exception as err:
+        print('Could not replay record', record['seq'], err)
+    finally:
+        clock_override.reset(reset_token)
+
+def open_store(directory, flush_interval=0.05, snapshot_every=10000):
+    '''
+    Recover data.data and the scheduled jobs from the directory and start
+    logging to it. No job is run until the recovery is done, then the ones
+    which became due while the server was down are run.
+    A snapshot is taken straight away if any record had to be replayed, so
+    that the next start is quick.
+    '''
+    global _store
+    os.makedirs(directory, exist_ok=True)
+    store = WriteAheadLog(directory, flush_interval, snapshot_every)
+    scheduler.pause()
+    try:
+        with WRITE_LOCK:
+            replayed = store.recover()
+            store.open_segment()
+            _store = store
+    finally:
+        scheduler.resume()
+    if replayed:
+        store.snapshot()
+    store.start()
+    return store
+
+def close_store():
+    '''
+    Flush the log and stop logging
+    '''
+    global _store
+    store = _store
+    if store is None:
+        return
+    with WRITE_LOCK:
+        _store = None
+    store.stop()
+
+def take_snapshot():
+    '''
+    Snapshot data.data now rather than waiting for snapshot_every records
+    '''
+    if _store is not None:
+        _store.snapshot()
+
+atexit.register(close_store)
@@ -0,0 +1,165 @@
+'''
+Runs the jobs which have to happen at a later time, e.g. the delivery of a
+message sent by message_sendlater and the end of a standup.
+
+All jobs are kept in one heap ordered by deadline and run, one at a time, by a
+single worker thread, so pending jobs cost a heap entry each rather than an OS
+thread each. The pending jobs are saved in the snapshots of persistence.py
+and the handlers which change data are logged commands, so jobs survive a
+restart and the ones which became due meanwhile run straight after it.
+A job is:
+    key: string, unique, scheduling a job with a key in use replaces the job
+    deadline: UNIX timestamp the job is run at
+    kind: string, names the handler registered to run the job
+    args: list, passed to the handler
+'''
+import heapq
+import itertools
+import threading
+import time
+
+class Scheduler(object):
+    '''
+    A heap of jobs and the worker thread which runs them
+    '''
+    def __init__(self):
+        # kind -> function
+        self.handlers = {}
+        # key -> (deadline, seq, kind, args)
+        self.jobs = {}
+        # (deadline, seq, key), entries of replaced or cancelled jobs are
+        # skipped when they reach the top
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.is_paused = False
+        self.worker = None
+
+    def register(self, kind, handler):
+        '''
+        Set the function which runs the jobs of the kind
+        '''
+        self.handlers[kind] = handler
+
+    def schedule(self, key, deadline, kind, args):
+        '''
+        Run handlers[kind](*args) at the deadline
+        '''
+        with self.condition:
+            seq = next(self.counter)
+            self.jobs[key] = (deadline, seq, kind, list(args))
+            heapq.heappush(self.heap, (deadline, seq, key))
+            self.start()
+            self.condition.notify()
+
+    def cancel(self, key):
+        '''
+        Remove the job with the key. Return whether there was one.
+        '''
+        with self.condition:
+            if self.jobs.pop(key, None) is None:
+                return False
+            # drop the skipped entries once they are most of the heap
+            if len(self.heap) > 2 * len(self.jobs) + 64:
+                self.heap = [entry for entry in self.heap
+                             if self.is_current(entry)]
+                heapq.heapify(self.heap)
+            return True
+
+    def has_job(self, key):
+        '''
+        Return whether a job with the key is waiting to be run
+        '''
+        with self.condition:
+            return key in self.jobs
+
+    def cancel_all(self):
+        '''
+        Remove every job
+        '''
+        with self.condition:
+            self.jobs.clear()
+            self.heap = []
+
+    def get_pending(self):
+        '''
+        Return the jobs which have not been run yet, the next one first
+        '''
+        with self.condition:
+            jobs = sorted(self.jobs.items(), key=lambda item: item[1][:2])
+            return [{'key': key, 'deadline': deadline, 'kind': kind, 'args': list(args)}
+                    for key, (deadline, _, kind, args) in jobs]
+
+    def is_current(self, entry):
+        '''
+        Check if the heap entry is for a job which is still scheduled
+        '''
+        _, seq, key = entry
+        job = self.jobs.get(key)
+        return job is not None and job[1] == seq
+
+    def next_due(self):
+        '''
+        Return the key and the job which is to be run next if its deadline
+        has passed, otherwise return the number of seconds until it is due
+        (None if there is no job or the scheduler is paused). Assumes the
+        condition is held.
+        '''
+        while self.heap and not self.is_paused:
+            if not self.is_current(self.heap[0]):
+                heapq.heappop(self.heap)
+                continue
+            deadline, _, key = self.heap[0]
+            wait = deadline - time.time()
+            if wait > 0:
+                return wait
+            return key, self.jobs[key]
+        return None
+
+    def run(self):
+        '''
+        Body of the worker thread. A job is only removed once its handler has
+        returned, and a handler may remove it itself (see message.py), so a
+        snapshot never sees a job as both pending and done.
+        '''
+        while True:
+            with self.condition:
+                due = self.next_due()
+                while not isinstance(due, tuple):
+                    self.condition.wait(due)
+                    due = self.next_due()
+            key, job = due
+            _, _, kind, args = job
+            try:
+                self.handlers[kind](*args)
+            except Exception as err:
+                print('Could not run scheduled job', kind, args, err)
+            with self.condition:
+                if self.jobs.get(key) is job:
+                    del self.jobs[key]
+
+    def pause(self):
+        '''
+        Stop running jobs until resume() is called, e.g. while the jobs are
+        being recovered
+        '''
+        with self.condition:
+            self.is_paused = True
+
+    def resume(self):
+        '''
+        Run jobs again, starting with the ones which became due while paused
+        '''
+        with self.condition:
+            self.is_paused = False
+            self.condition.notify()
+
+    def start(self):
+        '''
+        Start the worker thread if it is not running yet
+        '''
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+scheduler = Scheduler()
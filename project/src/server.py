@@ -2,9 +2,10 @@
 Server file which runs our flask
 '''
 from json import dumps
-from flask import Flask, request, send_from_directory
+from flask import Flask, Response, request, send_from_directory
 from flask_cors import CORS
-from error import InputError
+from error import InputError, AccessError
+from events import EVENT_KEEPALIVE, format_events
 import user
 import auth
 import channel
@@ -13,6 +14,8 @@ import message
 import other
 import os
 import standup
+import persistence
+import shard
 
 def defaultHandler(err):
     '''
@@ -31,6 +34,16 @@ def defaultHandler(err):
 APP = Flask(__name__, static_url_path='/static/')
 CORS(APP)
 APP.config["IMAGE_UPLOADS"] = f"{os.getcwd()}/src/static"
+# data is only kept across restarts when a directory is given for it
+APP.config["PERSISTENCE_DIR"] = os.environ.get("FLOCKR_PERSISTENCE_DIR")
+# with more than one shard, this process routes the requests to shard
+# processes it starts, which are told their index (see shard.py)
+APP.config["SHARDS"] = int(os.environ.get("FLOCKR_SHARDS", "1"))
+APP.config["SHARD_INDEX"] = os.environ.get("FLOCKR_SHARD_INDEX")
+APP.config["SHARD_SECRET"] = os.environ.get("FLOCKR_SHARD_SECRET")
+if APP.config["SHARD_INDEX"] is not None:
+    shard.configure_worker(APP, int(APP.config["SHARD_INDEX"]), APP.config["SHARDS"],
+                           APP.config["SHARD_SECRET"])
 
 APP.config['TRAP_HTTP_EXCEPTIONS'] = True
 APP.register_error_handler(Exception, defaultHandler)
@@ -323,6 +336,119 @@ def messages():
     )
     return dumps(info_out)
 
+@APP.route("/channel/pinned", methods=['GET'])
+def pinned():
+    '''
+    input format:
+    {
+        token: string,
+        channel_id: integer,
+    }
+    Given a Channel with ID channel_id that the authorised user is part of,
+    return its pinned messages, oldest first
+
+    output format:
+    {
+        messages: [{message_id: integer, u_id: integer, message: string, time_created: integer}]
+    }
+    '''
+    info_in = {
+        'token': request.args.get('token'),
+        'channel_id': int(request.args.get('channel_id')),
+    }
+    info_out = channel.channel_pinned(
+        info_in['token'],
+        info_in['channel_id'],
+    )
+    return dumps(info_out)
+
+@APP.route("/channel/sync", methods=['GET'])
+def sync():
+    '''
+    input format:
+    {
+        token: string,
+        channel_id: integer,
+        before: integer, optional, a message_id
+        after: integer, optional, a message_id
+        since_version: integer, optional
+    }
+    Given a Channel with ID channel_id that the authorised user is part of,
+    return up to 50 messages before or after a message, or the messages
+    changed since a version of the channel (see channel.channel_sync).
+
+    output format:
+    {
+        messages: [{message_id: integer, u_id: integer, message: string, time_created: integer}],
+        version: integer,
+        has_more: boolean,
+        is_complete: boolean
+    }
+    '''
+    def get_int(name):
+        value = request.args.get(name)
+        return None if value is None else int(value)
+
+    info_in = {
+        'token': request.args.get('token'),
+        'channel_id': int(request.args.get('channel_id')),
+        'before': get_int('before'),
+        'after': get_int('after'),
+        'since_version': get_int('since_version'),
+    }
+    info_out = channel.channel_sync(
+        info_in['token'],
+        info_in['channel_id'],
+        info_in['before'],
+        info_in['after'],
+        info_in['since_version'],
+    )
+    return dumps(info_out)
+
+@APP.route("/channel/events", methods=['GET'])
+def channel_events():
+    '''
+    input format:
+    {
+        token: string,
+        channel_id: integer,
+        cursor: integer, optional, the Last-Event-ID header is used instead
+                if it is sent
+    }
+    Stream the events of the channel after cursor (or from now on) as
+    server-sent events, so that clients do not have to poll
+    /channel/messages and /standup/active. The stream ends once the user
+    can no longer see the channel.
+    output format: text/event-stream
+    '''
+    cursor = request.headers.get('Last-Event-ID', request.args.get('cursor'))
+    info_in = {
+        'token': request.args.get('token'),
+        'channel_id': int(request.args.get('channel_id')),
+        'cursor': None if cursor is None else int(cursor),
+    }
+    # any error is raised before the stream starts
+    info_out = channel.channel_events(
+        info_in['token'],
+        info_in['channel_id'],
+        info_in['cursor'],
+    )
+
+    def stream(info_out):
+        while True:
+            yield format_events(info_out)
+            try:
+                info_out = channel.channel_events(
+                    info_in['token'],
+                    info_in['channel_id'],
+                    info_out['cursor'],
+                    EVENT_KEEPALIVE,
+                )
+            except (InputError, AccessError):
+                return
+
+    return Response(stream(info_out), mimetype='text/event-stream')
+
 @APP.route("/channel/leave", methods=['POST'])
 def leave():
     '''
@@ -502,6 +628,28 @@ def send():
     )
     return dumps(info_out)
 
+@APP.route("/message/sendbatch", methods=['POST'])
+def sendbatch():
+    '''
+    input format:
+    {
+        token: string,
+        messages: [{channel_id: integer, message: string}]
+    }
+    Send many messages from authorised_user at once, each to the channel
+    given with it
+    output format:
+    {
+        message_ids: [integer]
+    }
+    '''
+    info_in = request.get_json()
+    info_out = message.message_sendbatch(
+        info_in['token'],
+        info_in['messages'],
+    )
+    return dumps(info_out)
+
 @APP.route("/message/remove", methods=['DELETE'])
 def remove():
     '''
@@ -899,4 +1047,10 @@ def standup_send():
     return dumps(info_out)
 
 if __name__ == "__main__":
-    APP.run(port=0) # Do not edit this port
+    if APP.config["SHARDS"] > 1 and APP.config["SHARD_INDEX"] is None:
+        urls, secret = shard.start_shards(APP.config["SHARDS"], os.path.abspath(__file__), APP.config["PERSISTENCE_DIR"])
+        shard.create_router_app(shard.Router(urls, secret)).run(port=0, threaded=True) # Do not edit this port
+    else:
+        if APP.config["PERSISTENCE_DIR"]:
+            persistence.open_store(APP.config["PERSISTENCE_DIR"])
+        APP.run(port=0, threaded=True) # Do not edit this port
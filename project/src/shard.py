@@ -0,0 +1,383 @@
+'''
+Splits the channels, with their messages and standups, across several server
+processes (shards), each of which keeps its own data.data.
+
+Each shard only hands out the channel_ids and message_ids which are its index
+modulo the number of shards, so the owner of an id is:
+    channel_id % shard_count
+    message_id % shard_count
+
+The users and their sessions are a directory copied to every shard. The
+requests which change it are run on shard 0, which captures the commands they
+ran (see persistence.start_capture). The router applies those commands on
+every other shard before it answers, so any shard can check a token. A shard
+only applies the commands which DIRECTORY_WRITES run, and only when they are
+sent with the secret start_shards handed to it and to the router.
+
+The router is a Flask app which sends each request on to the shard owning it:
+    /channels/create: the shards in turn
+    /channels/list, /channels/listall, /search: every shard, the results are
+        merged (scatter-gather)
+    a request with a channel_id: the owner of the channel
+    a request with a message_id: the owner of the message
+    /channel/events: the owner of the channel, streamed as it is sent
+    /message/sendbatch: the messages are split between the owners of their
+        channels, and the message_ids put back in order. Each shard sends
+        its part or none of it, but one shard may fail after another sent.
+    anything else, e.g. /users/all and /user/profile: shard 0, as every shard
+        holds the same users
+'''
+import os
+import re
+import sys
+import hmac
+import json
+import secrets
+import itertools
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, g
+from werkzeug.exceptions import InternalServerError
+from flask_cors import CORS
+from data import data, IdAllocator
+from persistence import start_capture, stop_capture, apply_commands
+from error import InputError, AccessError
+
+CAPTURE_HEADER = 'X-Flockr-Capture'
+COMMANDS_HEADER = 'X-Flockr-Commands'
+SECRET_HEADER = 'X-Flockr-Shard-Secret'
+
+URL_PATTERN = re.compile(r' \* Running on ([^ ]*)')
+
+# requests which change the user directory, run on shard 0 and copied
+DIRECTORY_WRITES = {
+    '/auth/register',
+    '/auth/login',
+    '/auth/logout',
+    '/auth/passwordreset/request',
+    '/auth/passwordreset/reset',
+    '/user/profile/setname',
+    '/user/profile/setemail',
+    '/user/profile/sethandle',
+    '/user/profile/uploadphoto',
+    '/admin/userpermission/change',
+    '/clear',
+}
+
+# the commands which DIRECTORY_WRITES run, the only ones /shard/apply runs
+DIRECTORY_COMMANDS = {
+    'auth.add_user',
+    'auth.open_session',
+    'auth.auth_logout',
+    'auth.set_reset_code',
+    'auth.set_password',
+    'user.user_profile_setname',
+    'user.user_profile_setemail',
+    'user.user_profile_sethandle',
+    'user.set_profile_img_url',
+    'other.admin_userpermission_change',
+    'other.clear',
+}
+
+# requests whose answer is passed on as the shard sends it
+STREAMED = {'/channel/events'}
+
+# requests answered by every shard: path -> (the list in the answer, the key
+# the merged list is sorted by)
+GATHERED = {
+    '/channels/list': ('channels', lambda channel: channel['channel_id']),
+    '/channels/listall': ('channels', lambda channel: channel['channel_id']),
+    '/search': ('messages', lambda message: (message['time_created'], message['message_id'])),
+}
+
+# requests whose list of items is split between the shards owning them:
+# path -> (the list in the request, the list in the answer)
+SPLIT = {
+    '/message/sendbatch': ('messages', 'message_ids'),
+}
+
+METHODS = ['GET', 'POST', 'PUT', 'DELETE']
+
+class Router(object):
+    '''
+    Sends the requests on to the shards listening at urls, which were
+    started with secret
+    '''
+    def __init__(self, urls, secret):
+        self.urls = urls
+        self.secret = secret
+        # held while a change to the user directory is run and copied, so
+        # that every shard applies them in the same order
+        self.directory_lock = threading.Lock()
+        self.next_shard = itertools.count()
+        self.pool = ThreadPoolExecutor(max_workers=len(urls))
+
+    def get_shard_count(self):
+        '''
+        Return the number of shards
+        '''
+        return len(self.urls)
+
+    def get_owner(self, params):
+        '''
+        Return the index of the shard owning the channel or the message named
+        in the parameters of a request, or 0 if there is none
+        '''
+        for key in ['channel_id', 'message_id']:
+            try:
+                return int(params[key]) % len(self.urls)
+            except (KeyError, TypeError, ValueError):
+                continue
+        return 0
+
+    def send(self, index, method, path, query, body, headers):
+        '''
+        Send a request to a shard. Return its status, headers and body.
+        '''
+        url = f'{self.urls[index].rstrip("/")}{path}'
+        if query:
+            url += f'?{query}'
+        shard_request = urllib.request.Request(url, data=body or None, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(shard_request) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as err:
+            return err.code, err.headers, err.read()
+
+    def stream(self, index, method, path, query, body, headers):
+        '''
+        Send a request to a shard. Return its status and headers, and the
+        lines of its body as the shard sends them.
+        '''
+        url = f'{self.urls[index].rstrip("/")}{path}'
+        if query:
+            url += f'?{query}'
+        shard_request = urllib.request.Request(url, data=body or None, method=method, headers=headers)
+        try:
+            response = urllib.request.urlopen(shard_request)
+        except urllib.error.HTTPError as err:
+            return err.code, err.headers, [err.read()]
+
+        def lines():
+            with response:
+                yield from response
+        return response.status, response.headers, lines()
+
+    def broadcast(self, indexes, method, path, query, body, headers):
+        '''
+        Send the same request to several shards at once. Return their answers
+        in the order of indexes.
+        '''
+        return list(self.pool.map(
+            lambda index: self.send(index, method, path, query, body, headers), indexes))
+
+    def gather(self, method, path, query, body, headers):
+        '''
+        Send the request to every shard and merge the lists they answer with
+        '''
+        key, sort_key = GATHERED[path]
+        answers = self.broadcast(range(len(self.urls)), method, path, query, body, headers)
+        merged = []
+        for status, shard_headers, shard_body in answers:
+            if status != 200:
+                return status, shard_headers, shard_body
+            merged += json.loads(shard_body)[key]
+        merged.sort(key=sort_key)
+        return 200, {'Content-Type': 'application/json'}, json.dumps({key: merged}).encode('utf-8')
+
+    def split(self, method, path, query, body, headers):
+        '''
+        Send each shard the items of the request which it owns, and merge the
+        lists they answer with back into the order of the items
+        '''
+        key, answer_key = SPLIT[path]
+        try:
+            params = json.loads(body or b'{}')
+            items = params[key]
+            owners = [self.get_owner(item) for item in items]
+        except (ValueError, KeyError, TypeError):
+            return self.send(0, method, path, query, body, headers)
+        indexes = sorted(set(owners)) or [0]
+        bodies = {index: json.dumps(dict(params, **{key: [
+            item for item, owner in zip(items, owners) if owner == index
+        ]})).encode('utf-8') for index in indexes}
+        answers = list(self.pool.map(
+            lambda index: self.send(index, method, path, query, bodies[index], headers), indexes))
+        results = {}
+        for index, (status, shard_headers, shard_body) in zip(indexes, answers):
+            if status != 200:
+                return status, shard_headers, shard_body
+            results[index] = iter(json.loads(shard_body)[answer_key])
+        merged = [next(results[owner]) for owner in owners]
+        return 200, {'Content-Type': 'application/json'}, json.dumps({answer_key: merged}).encode('utf-8')
+
+    def change_directory(self, method, path, query, body, headers):
+        '''
+        Run the request on shard 0, then apply the commands it ran on the
+        other shards
+        '''
+        with self.directory_lock:
+            status, shard_headers, shard_body = self.send(
+                0, method, path, query, body, dict(headers, **{CAPTURE_HEADER: '1'}))
+            commands = json.loads(shard_headers.get(COMMANDS_HEADER) or '[]')
+            failed = self.apply_directory(commands) if commands else []
+        if failed:
+            # the change was made on shard 0 but not everywhere, so the
+            # client must not be told it succeeded
+            error = InternalServerError(
+                description=f'The change was not applied on shards {failed}')
+            return error.code, {'Content-Type': 'application/json'}, json.dumps({
+                'code': error.code,
+                'name': 'System Error',
+                'message': error.description,
+            }).encode('utf-8')
+        return status, shard_headers, shard_body
+
+    def apply_directory(self, commands):
+        '''
+        Apply the commands run by a change to the user directory on every
+        shard but shard 0. Return the indexes of the shards which did not
+        apply them, or could not be reached.
+        '''
+        payload = json.dumps({'commands': commands}).encode('utf-8')
+        headers = {'Content-Type': 'application/json', SECRET_HEADER: self.secret}
+        def apply(index):
+            try:
+                status, _, _ = self.send(index, 'POST', '/shard/apply', '', payload, headers)
+            except OSError:
+                return False
+            return status == 200
+        indexes = range(1, len(self.urls))
+        return [index for index, applied in zip(indexes, self.pool.map(apply, indexes))
+                if not applied]
+
+    def handle(self, method, path, query, body, headers):
+        '''
+        Answer a request by sending it to the shards it concerns
+        '''
+        if path in GATHERED:
+            return self.gather(method, path, query, body, headers)
+        if path in SPLIT:
+            return self.split(method, path, query, body, headers)
+        if path in DIRECTORY_WRITES:
+            return self.change_directory(method, path, query, body, headers)
+        if path == '/channels/create':
+            index = next(self.next_shard) % len(self.urls)
+        elif method == 'GET':
+            index = self.get_owner(dict(urllib.parse.parse_qsl(query)))
+        else:
+            try:
+                params = json.loads(body or b'{}')
+            except ValueError:
+                params = {}
+            index = self.get_owner(params if isinstance(params, dict) else {})
+        return self.send(index, method, path, query, body, headers)
+
+def create_router_app(router):
+    '''
+    Return the Flask app which answers every request through the router
+    '''
+    app = Flask(__name__)
+    CORS(app)
+
+    @app.route('/', defaults={'path': ''}, methods=METHODS)
+    @app.route('/<path:path>', methods=METHODS)
+    def route(path):
+        headers = {'Host': request.host}
+        if request.content_type:
+            headers['Content-Type'] = request.content_type
+        if f'/{path}' in STREAMED:
+            if request.headers.get('Last-Event-ID'):
+                headers['Last-Event-ID'] = request.headers['Last-Event-ID']
+            query = request.query_string.decode('utf-8')
+            status, shard_headers, body = router.stream(
+                router.get_owner(dict(urllib.parse.parse_qsl(query))),
+                request.method, f'/{path}', query, None, headers)
+            return Response(body, status=status, content_type=shard_headers.get('Content-Type'))
+        status, shard_headers, body = router.handle(
+            request.method, f'/{path}', request.query_string.decode('utf-8'),
+            request.get_data(), headers)
+        return Response(body, status=status, content_type=shard_headers.get('Content-Type'))
+
+    return app
+
+def configure_worker(app, index, count, secret):
+    '''
+    Make the app one of count shards: hand out the ids it owns, capture the
+    commands of the requests the router asks it to, apply the commands sent
+    with secret by the router, and stop when the router does
+    '''
+    data['ids'] = IdAllocator(count, index, ('channels', 'messages'))
+
+    @app.before_request
+    def begin_capture():
+        if request.headers.get(CAPTURE_HEADER):
+            g.capture = start_capture()
+
+    @app.after_request
+    def end_capture(response):
+        capture = g.pop('capture', None)
+        if capture is not None:
+            commands, token = capture
+            stop_capture(token)
+            response.headers[COMMANDS_HEADER] = json.dumps(commands)
+        return response
+
+    @app.route('/shard/apply', methods=['POST'])
+    def shard_apply():
+        sent_secret = request.headers.get(SECRET_HEADER, '')
+        if not secret or not hmac.compare_digest(sent_secret, secret):
+            raise AccessError(description='Commands are only applied for the router')
+        commands = request.get_json()['commands']
+        for command in commands:
+            if command['command'] not in DIRECTORY_COMMANDS:
+                raise InputError(description='Only the commands changing the users are applied')
+        try:
+            apply_commands(commands)
+        except Exception as err:
+            # the shard no longer holds the same users as shard 0
+            raise InternalServerError(description=f'Could not apply the commands: {err!r}')
+        return json.dumps({})
+
+    router_pid = os.getppid()
+    def watch_router():
+        while os.getppid() == router_pid:
+            threading.Event().wait(1)
+        os._exit(0)
+    threading.Thread(target=watch_router, daemon=True).start()
+
+def start_shards(count, server_path, persistence_dir=None):
+    '''
+    Start count processes running server_path as shards. Return their urls
+    and the secret the router sends with the commands it applies on them.
+    '''
+    urls = []
+    secret = secrets.token_hex(32)
+    for index in range(count):
+        env = dict(os.environ, FLOCKR_SHARDS=str(count), FLOCKR_SHARD_INDEX=str(index),
+                   FLOCKR_SHARD_SECRET=secret)
+        if persistence_dir:
+            env['FLOCKR_PERSISTENCE_DIR'] = os.path.join(persistence_dir, f'shard-{index}')
+        worker = subprocess.Popen([sys.executable, server_path], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        for line in worker.stderr:
+            url = URL_PATTERN.match(line.decode('utf-8'))
+            if url:
+                urls.append(url.group(1))
+                break
+        else:
+            raise RuntimeError(f'Shard {index} did not start')
+        # keep reading what the shard prints so that it never blocks on it
+        threading.Thread(target=forward_output, args=(index, worker.stderr), daemon=True).start()
+    return urls, secret
+
+def forward_output(index, stream):
+    '''
+    Print what a shard prints, marked with its index
+    '''
+    for line in stream:
+        sys.stderr.write(f'[shard {index}] {line.decode("utf-8", "replace")}')
@@ -2,13 +2,14 @@
 Created on 05/11/2020
 Contains functions: standup_start, standup_active, standup_send
 '''
-from data import data, User, Channel, Message
-from datetime import datetime, timedelta, timezone
+from data import data, User, Channel, Message, time_now
 from error import InputError, AccessError
-from datetime import datetime, timezone
-from helper import authorise
-import threading
+from helper import authorise, get_authorised_uid
+from persistence import persist
+from scheduler import scheduler
+from events import bus
 
+@persist
 @authorise
 def standup_start(token, channel_id, length):
     '''
@@ -32,7 +33,7 @@ def standup_start(token, channel_id, length):
     {'time_finish': integer}
     '''
     # find the matching user by token 
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     # Channel ID is not a valid channel
     index = Channel.find_channel(channel_id)
@@ -45,12 +46,12 @@ def standup_start(token, channel_id, length):
         raise AccessError(description="The user has to be a member of this channel")
 
     # An active standup is currently running in this channel
-    if standup_active(token, channel_id)['is_active']:
+    if channel.is_standup_active():
         raise InputError(description="Active standup exists")
     
-    dt_time_finish = datetime.utcnow() + timedelta(seconds=int(length))
-    time_finish = int(dt_time_finish.replace(tzinfo=timezone.utc).timestamp())
+    time_finish = time_now() + int(length)
     channel.set_time_finish(time_finish)
+    bus.publish(channel_id, 'standup_started', time_finish=time_finish)
 
     # create a new message to be sent at the time_finish
     # it is first initialised to be an empty string and the new messages using
@@ -59,23 +60,34 @@ def standup_start(token, channel_id, length):
     # Create object of Message classs
     # set attributes and set message empty string at first
     message = Message(
-        len(data['messages']), 
+        data['ids'].allocate('messages'), 
         u_id, 
         '', 
         channel_id, 
-        int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()), 
-        [{'react_id': 1, 'u_ids': []}], 
+        time_now(), 
+        None, 
         False,
     )
 
     # Add the message to the list of messages
-    data['messages'].append(message)
+    Message.add_message(message)
 
-    # modify message after time_diff seconds
-    t = threading.Timer(length, Channel.standup_send_final_message, (channel, message,))
-    t.start()
+    # modify message at time_finish
+    scheduler.schedule(f'standup_finish:{channel_id}', time_finish, 'standup_finish', (channel_id, message.get_message_id(),))
     return {'time_finish': time_finish}
 
+@persist
+def standup_finish(channel_id, message_id):
+    '''
+    Send the messages buffered by standup_send, run by the scheduler at
+    time_finish. It removes its own job so that the two are logged together.
+    '''
+    scheduler.cancel(f'standup_finish:{channel_id}')
+    Channel.standup_send_final_message(channel_id, message_id)
+    return {}
+
+scheduler.register('standup_finish', standup_finish)
+
 @authorise
 def standup_active(token, channel_id):
     '''
@@ -95,7 +107,7 @@ def standup_active(token, channel_id):
     {'is_active': boolean, 'time_finish': integer}
     '''
     # find the matching user by token s
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     # Channel ID is not a valid channel
     index = Channel.find_channel(channel_id)
@@ -107,15 +119,12 @@ def standup_active(token, channel_id):
     if not Channel.is_user_in_channel(u_id, channel_id):
         raise AccessError(description="The user has to be a member of this channel")
     time_finish = channel.get_time_finish()
-    is_active = True
     if time_finish is None:
         return {'is_active': False, 'time_finish': None}
     
-    if time_finish < int(datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()):
-        is_active = False
-    
-    return {'is_active': is_active, 'time_finish': time_finish}
+    return {'is_active': channel.is_standup_active(), 'time_finish': time_finish}
 
+@persist
 @authorise
 def standup_send(token, channel_id, message):
     '''
@@ -133,7 +142,7 @@ def standup_send(token, channel_id, message):
     {}
     '''
     # find the matching user by token s
-    u_id = User.get_uid_from_token(token)
+    u_id = get_authorised_uid()
 
     # get the user object with this u_id
     user_index = User.find_user(u_id)
@@ -154,7 +163,7 @@ def standup_send(token, channel_id, message):
         raise InputError(description="The message is too long.")
 
     # An active standup is not currently running in this channel
-    if not standup_active(token, channel_id)['is_active']:
+    if not channel.is_standup_active():
         raise InputError(description="Active standup exists")
     
     # Formating the message
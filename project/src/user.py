@@ -4,6 +4,7 @@ created on 11/10/2020 by Chan Baek and Xinran Zhu
 '''
 from data import data, User
 from error import InputError, AccessError
+from persistence import persist
 import urllib.request
 from PIL import Image
 from flask import Flask, request
@@ -57,6 +58,7 @@ def user_profile(token, u_id):
         },
     }
 
+@persist
 def user_profile_setname(token, name_first, name_last):
     '''
     input format:
@@ -83,11 +85,13 @@ def user_profile_setname(token, name_first, name_last):
     User.check_name_last(name_last)
 
     # Set the new name for the user given
-    data['users'][u_id].set_name_first(name_first)
-    data['users'][u_id].set_name_last(name_last)
+    user = data['users'][User.find_user(u_id)]
+    user.set_name_first(name_first)
+    user.set_name_last(name_last)
     return {
     }
 
+@persist
 def user_profile_setemail(token, email):
     '''
     input format:
@@ -113,10 +117,11 @@ def user_profile_setemail(token, email):
     User.check_email_repeated(email)
 
     # Set the new email for the user given
-    data['users'][u_id].set_email(email)
+    data['users'][User.find_user(u_id)].set_email(email)
     return {
     }
 
+@persist
 def user_profile_sethandle(token, handle_str):
     '''
     input format:
@@ -140,7 +145,7 @@ def user_profile_sethandle(token, handle_str):
     # Check that the handle is valid
     User.check_handle(handle_str)
 
-    data['users'][u_id].set_handle_str(handle_str)
+    data['users'][User.find_user(u_id)].set_handle_str(handle_str)
     return {
     }
 
@@ -201,6 +206,14 @@ def user_profile_uploadphoto(token, img_url, x_start, y_start, x_end, y_end):
 
     # generate the unique url for this image and store it in the user object
     url = f"{str(request.host_url)}static/{filename}"
-    user.set_profile_img_url(url)
+    set_profile_img_url(u_id, url)
     
     return {}
+
+@persist
+def set_profile_img_url(u_id, url):
+    '''
+    Store the url of the uploaded profile image of the user.
+    Logged instead of user_profile_uploadphoto, which downloads the image.
+    '''
+    data['users'][User.find_user(u_id)].set_profile_img_url(url)
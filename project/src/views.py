@@ -0,0 +1,76 @@
+'''
+The messages as they are shown to a user by channel_messages, channel_sync
+and search.
+
+Most of a message payload is the same for every user, only
+is_this_user_reacted depends on who reads it. The shared part is kept in an
+LRU cache of MESSAGE_VIEW_LIMIT payloads, each tagged with the version of the
+last change to the message (see Channel.add_change), so a payload is reused
+until the message changes and nothing has to be told to drop it. A payload
+is read-only: each user gets a new dict around it with its own reacts.
+'''
+import threading
+from collections import OrderedDict
+from data import Channel
+
+MESSAGE_VIEW_LIMIT = 10000
+
+class MessageViews(object):
+    '''
+    The shared payloads of the messages read most recently
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        # message_id -> (channel_id, version, payload), least recent first
+        self.payloads = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_payload(self, message):
+        '''
+        Return the part of the payload of the message which is the same for
+        every user. It must not be changed.
+        '''
+        message_id = message.get_message_id()
+        channel_id = message.get_channel_id()
+        version = Channel.get_message_version(channel_id, message_id)
+        with self.lock:
+            entry = self.payloads.get(message_id)
+            if entry is not None and entry[:2] == (channel_id, version):
+                self.payloads.move_to_end(message_id)
+                return entry[2]
+
+        payload = {
+            'message_id': message_id,
+            'u_id': message.get_u_id(),
+            'message': message.get_message(),
+            'time_created': message.get_time_created(),
+            'reacts': message.get_reacts(),
+            'is_pinned': message.get_is_pinned(),
+        }
+        # a message which has no version yet cannot be told apart from its
+        # next change, so it is not kept
+        if version is not None:
+            with self.lock:
+                self.payloads[message_id] = (channel_id, version, payload)
+                self.payloads.move_to_end(message_id)
+                if len(self.payloads) > self.limit:
+                    self.payloads.popitem(last=False)
+        return payload
+
+    def clear(self):
+        '''
+        Forget every payload
+        '''
+        with self.lock:
+            self.payloads.clear()
+
+def get_message_view(message, u_id):
+    '''
+    Return the message as it is shown to the user with u_id
+    '''
+    view = dict(views.get_payload(message))
+    view['reacts'] = [dict(react, is_this_user_reacted=message.has_react(react['react_id'], u_id))
+                      for react in view['reacts']]
+    return view
+
+views = MessageViews(MESSAGE_VIEW_LIMIT)
@@ -0,0 +1,285 @@
+'''
+white-box tests for the ASGI entry point in asgi.py
+'''
+import sys
+sys.path.append('../')
+import json
+import asyncio
+import threading
+from urllib.parse import urlencode
+import asgi
+from asgi import app
+from events import bus
+from auth import auth_register
+from channels import channels_create
+from message import message_send
+from error import InputError, AccessError
+from other import clear
+from data import Channel
+
+
+async def call(method, path, params=None, payload=None):
+    '''
+    Send one request to the ASGI app, return its status and decoded body
+    '''
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': urlencode(params or {}).encode('latin-1'),
+        'headers': [(b'content-type', b'application/json')],
+        'server': ('127.0.0.1', 8000),
+    }
+    received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    return sent[0]['status'], json.loads(sent[1]['body'])
+
+def test_asgi_routes():
+    '''
+    test if the routes of server.py are served, reads and writes on the
+    worker threads
+    '''
+    # clear data
+    clear()
+
+    async def run():
+        status, user = await call('POST', '/auth/register', payload={
+            'email': 't.holland@gmail.com',
+            'password': '12345678',
+            'name_first': 'Tom',
+            'name_last': 'Holland',
+        })
+        assert status == 200
+        _, channel = await call('POST', '/channels/create', payload={
+            'token': user['token'],
+            'name': 'COMP1531',
+            'is_public': True,
+        })
+        await call('POST', '/message/send', payload={
+            'token': user['token'],
+            'channel_id': channel['channel_id'],
+            'message': 'Hello',
+        })
+        # many polls at once are answered side by side
+        results = await asyncio.gather(*[call('GET', '/channel/messages', params={
+            'token': user['token'],
+            'channel_id': channel['channel_id'],
+            'start': 0,
+        }) for _ in range(20)])
+        return results
+
+    results = asyncio.run(run())
+    for status, result in results:
+        assert status == 200
+        assert [message['message'] for message in result['messages']] == ['Hello']
+
+def test_asgi_blocked_read():
+    '''
+    test if a read waiting for the lock of a channel does not hold up the
+    other requests
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+
+    # another thread holds the lock of the channel for a moment
+    locked = threading.Event()
+    def hold_lock():
+        with Channel.get_lock(channel['channel_id']):
+            locked.set()
+            threading.Event().wait(1)
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    locked.wait()
+
+    answered = []
+    async def answer(path, params):
+        await call('GET', path, params)
+        answered.append(path)
+
+    async def run():
+        await asyncio.gather(
+            answer('/channel/messages', {
+                'token': user['token'],
+                'channel_id': channel['channel_id'],
+                'start': 0,
+            }),
+            answer('/users/all', {'token': user['token']}),
+        )
+
+    asyncio.run(run())
+    holder.join()
+    assert answered == ['/users/all', '/channel/messages']
+
+def test_asgi_errors():
+    '''
+    test if errors are answered by defaultHandler, as with server.py
+    '''
+    # clear data
+    clear()
+
+    status, result = asyncio.run(call('GET', '/echo', params={'data': 'echo'}))
+    assert status == InputError.code
+    assert result['code'] == InputError.code
+    assert result['name'] == 'System Error'
+
+def test_asgi_events():
+    '''
+    test if /channel/events is streamed by the loop, sending each event as it
+    is published until the client goes
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+
+    async def run():
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/channel/events',
+            'query_string': urlencode({
+                'token': user['token'],
+                'channel_id': channel['channel_id'],
+            }).encode('latin-1'),
+            'headers': [],
+        }
+        disconnect = asyncio.Event()
+        received = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        sent = []
+
+        async def receive():
+            if received:
+                return received.pop(0)
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            # a message is sent once the stream has started
+            if len(sent) == 2:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, message_send, user['token'], channel['channel_id'], 'Hello')
+            if b'message_sent' in message.get('body', b''):
+                disconnect.set()
+
+        await asyncio.wait_for(app(scope, receive, send), 5)
+        return sent
+
+    sent = asyncio.run(run())
+    assert sent[0]['status'] == 200
+    assert (b'content-type', b'text/event-stream; charset=utf-8') in sent[0]['headers']
+    assert sent[1]['body'] == b': keepalive\n\n'
+    lines = sent[2]['body'].decode('utf-8').splitlines()
+    assert lines[0] == 'id: 1'
+    assert lines[1] == 'event: message_sent'
+    assert json.loads(lines[2][len('data: '):])['message'] == 'Hello'
+
+def test_asgi_events_after_clear(monkeypatch):
+    '''
+    test if a stream whose events are cleared tells the client to reload,
+    and goes on with the events published after
+    '''
+    monkeypatch.setattr(asgi, 'EVENT_KEEPALIVE', 0.1)
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+
+    async def run():
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/channel/events',
+            'query_string': urlencode({
+                'token': user['token'],
+                'channel_id': channel['channel_id'],
+            }).encode('latin-1'),
+            'headers': [],
+        }
+        disconnect = asyncio.Event()
+        received = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        sent = []
+
+        async def receive():
+            if received:
+                return received.pop(0)
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            loop = asyncio.get_running_loop()
+            # the events are cleared once the stream has started
+            if len(sent) == 2:
+                bus.clear()
+                await loop.run_in_executor(
+                    None, message_send, user['token'], channel['channel_id'], 'Hello')
+            if b'reset' in message.get('body', b''):
+                await loop.run_in_executor(
+                    None, message_send, user['token'], channel['channel_id'], 'World')
+            if b'message_sent' in message.get('body', b''):
+                disconnect.set()
+
+        await asyncio.wait_for(app(scope, receive, send), 5)
+        return sent
+
+    sent = asyncio.run(run())
+    bodies = [message.get('body', b'').decode('utf-8') for message in sent[1:]]
+    assert bodies[-1].startswith('id: 2\nevent: message_sent\n')
+    assert '"World"' in bodies[-1]
+    assert 'event: reset\n' in bodies[-2]
+    assert not any('"Hello"' in body for body in bodies)
+
+def test_asgi_events_error():
+    '''
+    test if /channel/events answers errors as server.py does
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    other = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+
+    status, result = asyncio.run(call('GET', '/channel/events', params={
+        'token': other['token'],
+        'channel_id': channel['channel_id'],
+    }))
+    assert status == AccessError.code
+    assert result['code'] == AccessError.code
+
+def test_asgi_events_error_leaves_no_channel():
+    '''
+    test if /channel/events requests which are refused do not make entries
+    on the event bus
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    for channel_id in range(1000, 1005):
+        status, _ = asyncio.run(call('GET', '/channel/events', params={
+            'token': 'bogus',
+            'channel_id': channel_id,
+        }))
+        assert status == AccessError.code
+    assert bus.channels == {}
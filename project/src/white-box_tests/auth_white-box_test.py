@@ -4,12 +4,17 @@ White-box test of auth.py
 import sys
 sys.path.append('../')
 
+import re
+import auth
 from data import data
 from auth import auth_register,auth_passwordreset_request, auth_passwordreset_reset
 from other import clear
 from pytest import raises
 from error import InputError
 import hashlib
+import threading
+import time
+from persistence import WRITE_LOCK
 
 def test_handle_str_large():
     '''
@@ -104,28 +109,66 @@ def test_passwordreset_request_email_not_in_data():
     with raises(InputError):
         auth_passwordreset_request('emailnotindata@gmail.com')
 
-def test_passwordreset_reset():
+def request_reset_code(monkeypatch, email):
+    '''
+    Return the reset code emailed by auth_passwordreset_request
+    '''
+    sent = []
+    class SMTP(object):
+        def __init__(self, host):
+            pass
+        def ehlo(self):
+            pass
+        def login(self, user, password):
+            pass
+        def sendmail(self, sender, receiver, message):
+            sent.append(message)
+        def close(self):
+            pass
+    monkeypatch.setattr(auth.smtplib, 'SMTP_SSL', SMTP)
+    auth_passwordreset_request(email)
+    return re.search(r'Your resetcode is (\w+)', sent[0]).group(1)
+
+def test_passwordreset_reset(monkeypatch):
     '''
     White-box test: tests if auth_passwordreset_reset functions as intended
     '''
     clear()
     auth_register("emailreceivebot@gmail.com", "123456", "Alexander", "Abdelrahman")
-    auth_passwordreset_request('emailreceivebot@gmail.com')
-    auth_passwordreset_reset(data['users'][0].get_reset_code(), 'passwordnew')
+    reset_code = request_reset_code(monkeypatch, 'emailreceivebot@gmail.com')
+    auth_passwordreset_reset(reset_code, 'passwordnew')
 
     assert data['users'][0].get_password() == hashlib.sha256('passwordnew'.encode()).hexdigest()
 
-def test_passwordreset_reset_invalid_pws():
+def test_passwordreset_code_hashed_and_used_once(monkeypatch):
+    '''
+    White-box test: tests if only the hash of the reset code is kept, and
+    the code can not be used again once the password was reset
+    '''
+    clear()
+    auth_register("emailreceivebot@gmail.com", "123456", "Alexander", "Abdelrahman")
+    reset_code = request_reset_code(monkeypatch, 'emailreceivebot@gmail.com')
+
+    assert data['users'][0].get_reset_code() == hashlib.sha256(reset_code.encode()).hexdigest()
+    with raises(InputError):
+        auth_passwordreset_reset(data['users'][0].get_reset_code(), 'passwordnew')
+
+    auth_passwordreset_reset(reset_code, 'passwordnew')
+    assert data['users'][0].get_reset_code() is None
+    with raises(InputError):
+        auth_passwordreset_reset(reset_code, 'passwordagain')
+
+def test_passwordreset_reset_invalid_pws(monkeypatch):
     '''
     White-box test: tests if auth_passwordreset_reset raises an InputError when the input password
     is invalid
     '''
     clear()
     auth_register("emailreceivebot@gmail.com", "123456", "Alexander", "Abdelrahman")
-    auth_passwordreset_request('emailreceivebot@gmail.com')
+    reset_code = request_reset_code(monkeypatch, 'emailreceivebot@gmail.com')
     
     with raises(InputError):
-        auth_passwordreset_reset(data['users'][0].get_reset_code(), 'pass')
+        auth_passwordreset_reset(reset_code, 'pass')
 
 def test_passwordreset_reset_invalid_reset_code():
     '''
@@ -138,3 +181,32 @@ def test_passwordreset_reset_invalid_reset_code():
     
     with raises(InputError):
         auth_passwordreset_reset('invalidcode', 'password')
+
+def test_register_same_email_concurrently():
+    '''
+    White-box test: test if only one of the registrations with the same email
+    made at the same time succeeds, as the email is checked under WRITE_LOCK
+    '''
+    clear()
+    results = []
+    errors = []
+
+    def register():
+        try:
+            results.append(auth_register("t.holland@gmail.com", "123456", "Tom", "Holland"))
+        except InputError as err:
+            errors.append(err)
+
+    # every registration is started while the lock is held, so that none of
+    # them is done before the others have read data['users']
+    threads = [threading.Thread(target=register) for _ in range(8)]
+    with WRITE_LOCK:
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 1
+    assert len(errors) == 7
+    assert len(data['users']) == 1
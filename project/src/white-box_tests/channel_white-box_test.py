@@ -1,7 +1,9 @@
 import sys
 sys.path.append('../')
 from auth import auth_register
-from channel import channel_addowner, channel_removeowner
+from channel import channel_addowner, channel_removeowner, channel_join, channel_leave, channel_details, channel_sync
+from message import message_send, message_edit
+from user import user_profile_setname, set_profile_img_url
 from channels import channels_create
 from error import InputError
 from pytest import raises
@@ -43,3 +45,121 @@ def test_channel_removeowner_uid_invalid():
     with raises(InputError):
         channel_removeowner(user['token'], channel['channel_id'], invalid_uid)
 
+
+
+def test_channel_join_after_setname_not_duplicated():
+    '''
+    test if a member who renamed themselves and joins again is not listed twice
+    '''
+    # clear data
+    clear()
+
+    # intiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+    channel_join(user2['token'], channel['channel_id'])
+    user_profile_setname(user2['token'], 'Henry', 'Styles')
+    channel_join(user2['token'], channel['channel_id'])
+
+    # check the member is listed once
+    result = channel_details(user1['token'], channel['channel_id'])
+    assert len(result['all_members']) == 2
+
+
+def test_channel_removeowner_after_setname():
+    '''
+    test if an owner who renamed themselves can still be removed as an owner
+    '''
+    # clear data
+    clear()
+
+    # intiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+    channel_addowner(user1['token'], channel['channel_id'], user2['u_id'])
+    user_profile_setname(user2['token'], 'Henry', 'Styles')
+    channel_removeowner(user1['token'], channel['channel_id'], user2['u_id'])
+
+    # check only the first user is still an owner
+    result = channel_details(user1['token'], channel['channel_id'])
+    assert [owner['u_id'] for owner in result['owner_members']] == [user1['u_id']]
+
+
+def test_channel_details_cached():
+    '''
+    test if channel_details returns the payload kept by the channel, patched
+    by joins, leaves and owner changes, and built again after a profile
+    change, without changing the payloads already returned
+    '''
+    # clear data
+    clear()
+
+    # intiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+
+    first = channel_details(user1['token'], channel['channel_id'])
+    assert channel_details(user1['token'], channel['channel_id']) is first
+
+    channel_join(user2['token'], channel['channel_id'])
+    channel_addowner(user1['token'], channel['channel_id'], user2['u_id'])
+    joined = channel_details(user1['token'], channel['channel_id'])
+    assert [member['u_id'] for member in joined['all_members']] == [user1['u_id'], user2['u_id']]
+    assert [owner['u_id'] for owner in joined['owner_members']] == [user1['u_id'], user2['u_id']]
+    # the payload returned before is left as it was
+    assert [member['u_id'] for member in first['all_members']] == [user1['u_id']]
+
+    user_profile_setname(user2['token'], 'Harold', 'Styles')
+    set_profile_img_url(user2['u_id'], 'http://localhost/static/harold.jpg')
+    renamed = channel_details(user1['token'], channel['channel_id'])
+    assert renamed['all_members'][1] == {
+        'u_id': user2['u_id'],
+        'name_first': 'Harold',
+        'name_last': 'Styles',
+        'profile_img_url': 'http://localhost/static/harold.jpg',
+    }
+    assert joined['all_members'][1]['name_first'] == 'Harry'
+
+    channel_removeowner(user1['token'], channel['channel_id'], user2['u_id'])
+    channel_leave(user2['token'], channel['channel_id'])
+    left = channel_details(user1['token'], channel['channel_id'])
+    assert [member['u_id'] for member in left['all_members']] == [user1['u_id']]
+    assert [owner['u_id'] for owner in left['owner_members']] == [user1['u_id']]
+
+def test_channel_sync_changes_window(monkeypatch):
+    '''
+    test if only CHANGE_HISTORY changed messages are kept for channel_sync,
+    and a client which is further behind is told to fetch the channel again
+    '''
+    monkeypatch.setattr('data.CHANGE_HISTORY', 3)
+    # clear data
+    clear()
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+    message_ids = [message_send(user1['token'], channel['channel_id'], str(i))['message_id']
+        for i in range(3)]
+
+    # the 3 changes are all kept
+    result = channel_sync(user1['token'], channel['channel_id'], since_version=0)
+    assert [message['message_id'] for message in result['messages']] == message_ids
+    assert result['is_complete'] == True
+
+    # a message changed again only takes one place
+    message_edit(user1['token'], message_ids[0], 'edited')
+    message_edit(user1['token'], message_ids[0], 'edited again')
+    result = channel_sync(user1['token'], channel['channel_id'], since_version=1)
+    assert [message['message_id'] for message in result['messages']] == message_ids[1:] + message_ids[:1]
+    assert result['is_complete'] == True
+
+    # the change of version 2 is dropped once a fourth message changes
+    message_id = message_send(user1['token'], channel['channel_id'], 'new')['message_id']
+    result = channel_sync(user1['token'], channel['channel_id'], since_version=1)
+    assert result == {'messages': [], 'version': 6, 'has_more': False, 'is_complete': False}
+    result = channel_sync(user1['token'], channel['channel_id'], since_version=2)
+    assert [message['message_id'] for message in result['messages']] == [message_ids[2], message_ids[0], message_id]
+    assert result['is_complete'] == True
@@ -0,0 +1,479 @@
+'''
+white-box tests for the internal indexes kept in data.py
+'''
+import sys
+sys.path.append('../')
+import gc
+import pickle
+import threading
+import tracemalloc
+from array import array
+from auth import auth_register
+from channels import channels_create
+from message import message_send, message_edit, message_react, message_unreact, message_remove, \
+    message_compact
+from channel import channel_messages, channel_details, channel_join, channel_sync
+from user import user_profile_setname
+from other import search
+from data import data, User, Channel, Message, IdAllocator
+from other import clear
+from scheduler import scheduler
+from error import InputError
+from pytest import raises
+
+
+def test_indexes_follow_inserts():
+    '''
+    test if the user, channel and message indexes point at the objects which
+    were added by auth_register, channels_create and message_send
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user2['token'], 'COMP1531', True)
+    message = message_send(user2['token'], channel['channel_id'], 'Hello')
+
+    # check each index resolves to the matching object
+    assert data['users'][User.find_user(user1['u_id'])].get_email() == 't.holland@gmail.com'
+    assert data['users'][User.find_user(user2['u_id'])].get_email() == 'h.styles@gmail.com'
+    assert data['channels'][Channel.find_channel(channel['channel_id'])].get_name() == 'COMP1531'
+    assert data['messages'][Message.find_message(message['message_id'])].get_message() == 'Hello'
+
+def test_indexes_reset_by_clear():
+    '''
+    test if clear() empties the indexes so that old ids are no longer found
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message = message_send(user['token'], channel['channel_id'], 'Hello')
+
+    # clear data
+    clear()
+
+    # check nothing can be found any more
+    assert User.find_user(user['u_id']) is None
+    assert Channel.find_channel(channel['channel_id']) is None
+    assert Message.find_message(message['message_id']) is None
+
+def test_message_reacts_allocated_on_first_react():
+    '''
+    test if a message has no __dict__ and only allocates its reacts when it
+    is first reacted to, and frees them again after the last unreact
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message = message_send(user['token'], channel['channel_id'], 'Hello')
+    message_detail = data['messages'][Message.find_message(message['message_id'])]
+
+    # check the message starts without reacts but still lists react 1
+    assert not hasattr(message_detail, '__dict__')
+    assert message_detail.reacts is None
+    assert message_detail.get_reacts() == [{'react_id': 1, 'u_ids': []}]
+
+    message_detail.add_react(1, user['u_id'])
+    assert message_detail.has_react(1, user['u_id'])
+    assert message_detail.get_reacts() == [{'react_id': 1, 'u_ids': [user['u_id']]}]
+
+    message_detail.remove_react(1, user['u_id'])
+    assert message_detail.reacts is None
+
+def test_archived_messages_are_read_from_both_tiers():
+    '''
+    test if channel_messages and search return archived messages as before,
+    and new message_ids follow on from the archived ones
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    for text in ['Hello', 'Hello World!', 'Café']:
+        message_send(user['token'], channel['channel_id'], text)
+    before = channel_messages(user['token'], channel['channel_id'], 0)
+    Message.archive_messages(0)
+    message = message_send(user['token'], channel['channel_id'], 'World')
+
+    # check the archived messages are read without taking them out
+    assert data['messages'][0].get_message() == 'World'
+    assert message['message_id'] == 3
+    assert channel_messages(user['token'], channel['channel_id'], 0)['messages'][1:] == before['messages']
+    assert [item['message'] for item in search(user['token'], 'World')['messages']] == ['Hello World!', 'World']
+    assert data['message_archive'].get_live_count() == 3
+
+def test_archived_message_changed():
+    '''
+    test if an archived message is taken out of the archive when it is edited
+    or reacted to, and written over its old row when it is archived again
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message1 = message_send(user['token'], channel['channel_id'], 'Hello')
+    message2 = message_send(user['token'], channel['channel_id'], 'World')
+    Message.archive_messages(0)
+
+    message_edit(user['token'], message1['message_id'], 'Hi')
+    message_react(user['token'], message2['message_id'], 1)
+    assert data['message_archive'].get_live_count() == 0
+
+    # the reacted message can not be archived
+    Message.archive_messages(0)
+    assert [message.get_message_id() for message in data['messages']] == [message2['message_id']]
+    assert len(data['message_archive'].message_ids) == 2
+
+    result = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [item['message'] for item in result['messages']] == ['World', 'Hi']
+    assert result['messages'][0]['reacts'][0]['is_this_user_reacted'] == True
+
+def test_archive_waits_for_archivable_messages(monkeypatch):
+    '''
+    test if messages which can not be archived do not make every send run
+    the archive again once there are more of them than the limit
+    '''
+    monkeypatch.setattr('data.HOT_MESSAGE_LIMIT', 4)
+    archive_messages = Message.archive_messages
+    runs = []
+    def count_runs(keep):
+        runs.append(keep)
+        archive_messages(keep)
+    monkeypatch.setattr(Message, 'archive_messages', staticmethod(count_runs))
+
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    for _ in range(12):
+        message = message_send(user['token'], channel['channel_id'], 'Hello')
+        message_react(user['token'], message['message_id'], 1)
+
+    # the archive runs every HOT_MESSAGE_LIMIT // 2 sends, not on each one
+    assert len(data['messages']) == 12
+    assert len(runs) == 4
+    assert data['message_archive'].get_hot_limit() == 12
+
+def test_archived_text_reused_and_compacted():
+    '''
+    test if a message archived again keeps its text when it did not change,
+    and the texts no longer used are dropped once they are most of the text
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message = message_send(user['token'], channel['channel_id'], 'Hello')
+    Message.archive_messages(0)
+
+    message_react(user['token'], message['message_id'], 1)
+    message_unreact(user['token'], message['message_id'], 1)
+    Message.archive_messages(0)
+    assert bytes(data['message_archive'].text) == b'Hello'
+
+    archive = data['message_archive']
+    message_edit(user['token'], message['message_id'], 'Hi')
+    Message.archive_messages(0)
+    assert data['message_archive'] is not archive
+    assert bytes(data['message_archive'].text) == b'Hi'
+    assert bytes(archive.text) == b'HelloHi'
+    result = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [item['message'] for item in result['messages']] == ['Hi']
+
+def test_ids_not_reused():
+    '''
+    test if ids come from the id allocator, so an id is not handed out again
+    once the messages it was given to have left data['messages'], and a
+    block of ids can be allocated with a stride
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_send(user['token'], channel['channel_id'], 'Hello')
+    data['messages'].clear()
+    data['message_index'].clear()
+    message = message_send(user['token'], channel['channel_id'], 'World')
+
+    # check the second message gets a new id
+    assert message['message_id'] == 1
+    assert list(IdAllocator(stride=4, offset=1).allocate_block('messages', 3)) == [1, 5, 9]
+
+def test_concurrent_writers_and_readers():
+    '''
+    test if messages sent from several threads at once each get their own
+    message_id and can all be read, while other threads read the channel
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    errors = []
+
+    def send():
+        try:
+            for i in range(100):
+                message_send(user['token'], channel['channel_id'], f'Hello {i}')
+        except Exception as err:
+            errors.append(err)
+
+    def read():
+        try:
+            for _ in range(100):
+                channel_messages(user['token'], channel['channel_id'], 0)
+                search(user['token'], 'Hello')
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=send) for _ in range(4)]
+    threads += [threading.Thread(target=read) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # check every message was kept once
+    assert errors == []
+    assert len(search(user['token'], 'Hello')['messages']) == 400
+    assert len(set(message.get_message_id() for message in data['messages'])) == 400
+
+def test_members_are_u_ids_with_shared_views():
+    '''
+    test if channels only keep the u_ids of their members, and the details of
+    a user are one dict shared by every channel until the user changes
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel_ids = [channels_create(user1['token'], name, True)['channel_id']
+                   for name in ['COMP1531', 'COMP2521']]
+    for channel_id in channel_ids:
+        channel_join(user2['token'], channel_id)
+
+    channel = data['channels'][Channel.find_channel(channel_ids[0])]
+    assert channel.get_all_members() == [user1['u_id'], user2['u_id']]
+    assert channel.get_owner_members() == [user1['u_id']]
+
+    details = [channel_details(user1['token'], channel_id) for channel_id in channel_ids]
+    assert details[0]['all_members'][1] is details[1]['all_members'][1]
+
+    user_profile_setname(user2['token'], 'Harold', 'Styles')
+    renamed = [channel_details(user1['token'], channel_id) for channel_id in channel_ids]
+    assert renamed[0]['all_members'][1]['name_first'] == 'Harold'
+    assert renamed[0]['all_members'][1] is renamed[1]['all_members'][1]
+    assert details[0]['all_members'][1]['name_first'] == 'Harry'
+
+def test_members_of_older_snapshots():
+    '''
+    test if a channel pickled with its members as dicts is loaded with u_ids
+    '''
+    # clear data
+    clear()
+
+    channel = Channel('COMP1531', 1, [], [], True)
+    state = channel.__getstate__()
+    del state['member_ids'], state['owner_ids']
+    state['all_members'] = [{'u_id': 2, 'name_first': 'Tom'}, {'u_id': 0, 'name_first': 'Harry'}]
+    state['owner_members'] = [{'u_id': 2, 'name_first': 'Tom'}]
+    loaded = Channel.__new__(Channel)
+    loaded.__setstate__(pickle.loads(pickle.dumps(state)))
+    assert loaded.get_all_members() == [2, 0]
+    assert loaded.get_owner_members() == [2]
+    assert loaded.has_member(0) and not loaded.has_owner(0)
+
+def test_removed_messages_compacted():
+    '''
+    test if a removed message is a tombstone straight away, and the
+    compaction scheduled by the removal drops it from data['messages']
+    without changing the message_ids of the others
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_ids = [message_send(user['token'], channel['channel_id'], text)['message_id']
+                   for text in ['Hello', 'Bye', 'World']]
+    version = channel_sync(user['token'], channel['channel_id'])['version']
+
+    message_remove(user['token'], message_ids[1])
+    message_edit(user['token'], message_ids[2], '')
+    assert Message.find_message(message_ids[1]) is None
+    assert data['tombstones'] == {message_ids[1], message_ids[2]}
+    assert scheduler.has_job('message_compact')
+    with raises(InputError):
+        message_react(user['token'], message_ids[1], 1)
+
+    message_compact()
+    assert not scheduler.has_job('message_compact')
+    assert data['tombstones'] == set()
+    assert [message.get_message_id() for message in data['messages']] == message_ids[:1]
+    assert Message.load(message_ids[1]) is None
+
+    # the message left and new ones are found as before
+    message_edit(user['token'], message_ids[0], 'Hi')
+    new_message = message_send(user['token'], channel['channel_id'], 'Again')
+    assert new_message['message_id'] not in message_ids
+    result = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [message['message'] for message in result['messages']] == ['Again', 'Hi']
+
+    # clients which sync still hear of the removals
+    result = channel_sync(user['token'], channel['channel_id'], since_version=version)
+    assert {'message_id': message_ids[1], 'is_removed': True} in result['messages']
+    assert {'message_id': message_ids[2], 'is_removed': True} in result['messages']
+
+def test_removed_message_cursor_compacted():
+    '''
+    test if a removed message used as a channel_sync cursor gives the same
+    pages before and after it is compacted
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_ids = [message_send(user['token'], channel['channel_id'], text)['message_id']
+                   for text in ['Hello', 'Bye', 'World']]
+    message_remove(user['token'], message_ids[1])
+
+    def pages():
+        before = channel_sync(user['token'], channel['channel_id'], before=message_ids[1])
+        after = channel_sync(user['token'], channel['channel_id'], after=message_ids[1])
+        return ([message['message'] for message in before['messages']],
+                [message['message'] for message in after['messages']])
+
+    assert pages() == (['Hello'], ['World'])
+    message_compact()
+    assert Message.load(message_ids[1]) is None
+    assert pages() == (['Hello'], ['World'])
+    # only its message_id and time_created are kept, in arrays
+    assert list(data['channels'][0].removed_ids) == [message_ids[1]]
+    assert len(data['channels'][0].removed_times) == 1
+
+    # the cursor is kept in snapshots
+    saved = pickle.loads(pickle.dumps(data['channels'][0]))
+    assert saved.get_cursor(message_ids[1]) == data['channels'][0].get_cursor(message_ids[1])
+
+    # older snapshots keep the removed messages in a dict, and the timeline
+    # in a list
+    state = data['channels'][0].__getstate__()
+    del state['removed_ids'], state['removed_times']
+    state['removed'] = {message_ids[1]: 5, message_ids[0]: 3}
+    state['timeline'] = list(state['timeline'])
+    loaded = Channel.__new__(Channel)
+    loaded.__setstate__(state)
+    assert list(loaded.removed_ids) == message_ids[:2]
+    assert loaded.get_cursor(message_ids[1]) == (5, message_ids[1])
+    assert list(loaded.get_timeline()) == list(data['channels'][0].get_timeline())
+    assert [message_id for _, message_id in loaded.get_timeline()] == [message_ids[0], message_ids[2]]
+
+    # it is still not a cursor of another channel
+    other = channels_create(user['token'], 'COMP2521', True)
+    with raises(InputError):
+        channel_sync(user['token'], other['channel_id'], after=message_ids[1])
+
+def test_search_postings_are_arrays():
+    '''
+    test if the postings are arrays of message_ids in increasing order, and
+    search leaves out the messages edited or removed since they were added
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_ids = [message_send(user['token'], channel['channel_id'], text)['message_id']
+                   for text in ['Hello', 'Hello World', 'Hello again']]
+    postings = data['search_index']['Hel'][channel['channel_id']]
+    assert type(postings) is array and list(postings) == message_ids
+
+    # an edited message is added in order, and is still in the old postings
+    message_edit(user['token'], message_ids[0], 'Goodbye World')
+    assert list(data['search_index']['Wor'][channel['channel_id']]) == message_ids[:2]
+    assert list(postings) == message_ids
+    assert [item['message'] for item in search(user['token'], 'Hello')['messages']] == \
+        ['Hello World', 'Hello again']
+    assert [item['message'] for item in search(user['token'], 'World')['messages']] == \
+        ['Goodbye World', 'Hello World']
+
+    # a removed message is left out before and after it is compacted
+    message_remove(user['token'], message_ids[1])
+    assert [item['message'] for item in search(user['token'], 'Hello')['messages']] == ['Hello again']
+    message_compact()
+    assert [item['message'] for item in search(user['token'], 'Hello')['messages']] == ['Hello again']
+    assert [item['message'] for item in search(user['token'], 'World')['messages']] == ['Goodbye World']
+
+def test_archived_message_bytes():
+    '''
+    test if an archived message, with its place in the timeline and the
+    postings of its text, takes less memory than the Message it was
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    count = 10000
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        for i in range(count):
+            message_send(user['token'], channel['channel_id'], f'hello world {i}')
+        Message.archive_messages(0)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    assert len(data['messages']) == 0
+    # the timeline only holds arrays
+    timeline = data['channels'][0].get_timeline()
+    assert len(timeline) == count and type(timeline.message_ids) is array
+    assert used / count < 400
+
+def test_reacts_of_older_snapshots():
+    '''
+    test if the reacts of a message pickled with lists of u_ids are loaded as
+    ordered sets
+    '''
+    # clear data
+    clear()
+
+    message = Message(1, 0, 'Hello', 0, 0, None, False)
+    state = message.__getstate__()
+    state[1]['reacts'] = {1: [3, 2]}
+    loaded = Message.__new__(Message)
+    loaded.__setstate__(pickle.loads(pickle.dumps(state)))
+    assert loaded.get_reacts() == [{'react_id': 1, 'u_ids': [3, 2]}]
+    assert loaded.has_react(1, 2) and loaded.get_react_count(1) == 2
+
+    # a message is pickled and loaded as it was
+    loaded = pickle.loads(pickle.dumps(loaded))
+    assert loaded.get_message() == 'Hello' and loaded.get_react_count(1) == 2
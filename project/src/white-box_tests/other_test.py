@@ -9,7 +9,7 @@ from data import data
 from other import clear, users_all, admin_userpermission_change, search
 from channels import channels_create
 from channel import channel_invite
-from message import message_send
+from message import message_send, message_edit, message_remove
 from error import InputError, AccessError
 
 
@@ -29,7 +29,7 @@ def test_clear():
     # to test if clear() clear the users in data successfully, if the user
     # are not correctly cleared, it will raise InputError because the email
     # has already been registed 
-    assert data['valid_tokens'] == []
+    assert data['sessions'] == {}
     auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
     
 
@@ -114,6 +114,63 @@ def test_search():
 
 
 
+def test_search_after_edit_and_remove():
+    '''
+    test if search() follows the edited and removed messages
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', False)
+    message1 = message_send(user['token'], channel['channel_id'], 'Hello World!')
+    message2 = message_send(user['token'], channel['channel_id'], 'Hello there')
+    message_edit(user['token'], message1['message_id'], 'Goodbye World!')
+    message_remove(user['token'], message2['message_id'])
+
+    # test the old text is no longer found and the new text is
+    assert search(user['token'], 'Hello') == {'messages': []}
+    result = search(user['token'], 'bye Wo')
+    assert [message['message_id'] for message in result['messages']] == [message1['message_id']]
+
+def test_search_grams_in_other_order():
+    '''
+    test if search() does not return a message which holds every 3-character
+    piece of the query string but not the query string itself
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', False)
+    message_send(user['token'], channel['channel_id'], 'cdeabcd')
+    message = message_send(user['token'], channel['channel_id'], 'abcde')
+
+    # 'abc', 'bcd' and 'cde' are all in the first message, 'abcde' is not
+    result = search(user['token'], 'abcde')
+    assert [message['message_id'] for message in result['messages']] == [message['message_id']]
+
+def test_search_short_query():
+    '''
+    test if search() matches query strings shorter than 3 characters
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', False)
+    message1 = message_send(user['token'], channel['channel_id'], 'Hi!')
+    message_send(user['token'], channel['channel_id'], 'Hello')
+    message3 = message_send(user['token'], channel['channel_id'], 'Oh hi')
+
+    # test correct search
+    result = search(user['token'], 'i')
+    assert [message['message_id'] for message in result['messages']] == \
+        [message1['message_id'], message3['message_id']]
+
 def test_users_all_invalid_token1():
     '''
     Test if a 400 error is received when the token is invalid
@@ -0,0 +1,319 @@
+'''
+white-box tests for the write-ahead log and snapshots in persistence.py
+'''
+import sys
+sys.path.append('../')
+import os
+import time
+import pickle
+import re
+import auth
+from auth import auth_register, auth_login, auth_logout, auth_passwordreset_request
+from channels import channels_create, channels_list
+from channel import channel_messages, channel_details, channel_join
+from message import message_send, message_edit, message_sendlater, message_react
+from data import data, copy_data, finish_copy, Message
+from other import clear, search
+from persistence import open_store, close_store, take_snapshot
+from scheduler import scheduler
+
+
+def restart(directory):
+    '''
+    Simulate a restart of the server: stop logging, drop the in-memory data
+    and recover it from the directory
+    '''
+    close_store()
+    clear()
+    open_store(str(directory), flush_interval=0.01)
+
+def test_recover_from_log(tmp_path):
+    '''
+    test if the state is rebuilt by replaying the write-ahead log
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message = message_send(user['token'], channel['channel_id'], 'Hello')
+    message_edit(user['token'], message['message_id'], 'Hello World!')
+    time_created = data['messages'][0].get_time_created()
+
+    restart(tmp_path)
+
+    # check the recovered state, including the original time of the message
+    result = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [item['message'] for item in result['messages']] == ['Hello World!']
+    assert result['messages'][0]['time_created'] == time_created
+    assert channel_details(user['token'], channel['channel_id'])['name'] == 'COMP1531'
+    close_store()
+
+def test_recover_from_snapshot_and_log(tmp_path):
+    '''
+    test if the records logged after a snapshot are replayed on top of it,
+    and the segments older than the snapshot are removed
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_send(user['token'], channel['channel_id'], 'Hello')
+    take_snapshot()
+    message_send(user['token'], channel['channel_id'], 'World')
+    auth_logout(user['token'])
+
+    restart(tmp_path)
+
+    # check the logout after the snapshot was replayed
+    assert data['sessions'] == {}
+    user = auth_login('t.holland@gmail.com', '12345678')
+    result = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [item['message'] for item in result['messages']] == ['World', 'Hello']
+    assert len([name for name in os.listdir(str(tmp_path)) if name.startswith('wal-')]) <= 2
+    close_store()
+
+def test_search_index_rebuilt_from_snapshot(tmp_path):
+    '''
+    test if the search index is left out of the snapshot and made again
+    when it is loaded, with only trigrams in it
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_send(user['token'], channel['channel_id'], 'Hello')
+    message_send(user['token'], channel['channel_id'], 'Hi')
+    take_snapshot()
+
+    restart(tmp_path)
+
+    assert all(len(gram) == 3 for gram in data['search_index'])
+    assert 'Hel' in data['search_index']
+    result = search(user['token'], 'ello')
+    assert [item['message'] for item in result['messages']] == ['Hello']
+    result = search(user['token'], 'H')
+    assert [item['message'] for item in result['messages']] == ['Hello', 'Hi']
+    result = search(user['token'], 'Hi')
+    assert [item['message'] for item in result['messages']] == ['Hi']
+    close_store()
+
+def test_snapshot_without_indexes(tmp_path):
+    '''
+    test if only the primary state is saved in a snapshot, and the indexes
+    are made again from it when it is loaded
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+    channel_join(user2['token'], channel['channel_id'])
+    message_send(user1['token'], channel['channel_id'], 'Hello')
+    take_snapshot()
+
+    with open(os.path.join(str(tmp_path), 'snapshot.pickle'), 'rb') as snapshot_file:
+        state = pickle.load(snapshot_file)
+    assert sorted(state['data']) == ['channels', 'ids', 'message_archive', 'messages',
+                                     'sessions', 'tombstones', 'users']
+
+    restart(tmp_path)
+
+    assert data['user_channels'] == {user1['u_id']: {channel['channel_id']},
+                                     user2['u_id']: {channel['channel_id']}}
+    assert channels_list(user2['token'])['channels'][0]['channel_id'] == channel['channel_id']
+    result = channel_messages(user2['token'], channel['channel_id'], 0)
+    assert [item['message'] for item in result['messages']] == ['Hello']
+    close_store()
+
+def test_snapshot_copy_not_changed():
+    '''
+    test if the copy pickled by a snapshot is not changed by the commands
+    run after it was taken, and the archived messages are only copied once
+    it is finished
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+    archived = message_send(user1['token'], channel['channel_id'], 'Archived')
+    Message.archive_messages(0)
+    message = message_send(user1['token'], channel['channel_id'], 'Hello')
+    saved = copy_data()
+    # the columns which are only appended to are not copied yet
+    assert saved['message_archive'].text is data['message_archive'].text
+
+    channel_join(user2['token'], channel['channel_id'])
+    message_react(user2['token'], message['message_id'], 1)
+    message_send(user1['token'], channel['channel_id'], 'World')
+    message_edit(user1['token'], archived['message_id'], 'Edited')
+    Message.archive_messages(0)
+    auth_logout(user2['token'])
+    finish_copy(saved)
+
+    assert saved['channels'][0].get_all_members() == [user1['u_id']]
+    assert len(saved['channels'][0].get_timeline()) == 2
+    assert saved['messages'][0].reacts is None
+    assert len(saved['messages']) == 1
+    assert len(saved['sessions']) == 2
+    assert saved['ids'].allocate('messages') == 2
+    archive = saved['message_archive']
+    assert [archive.load(row).get_message() for row in archive.get_live_rows()] == ['Archived']
+    assert saved['message_archive'].text is not data['message_archive'].text
+
+def wait_for_messages(token, channel_id):
+    '''
+    Return the texts of the messages of the channel once it has any, so that
+    a scheduled message can be waited for
+    '''
+    for _ in range(100):
+        messages = channel_messages(token, channel_id, 0)['messages']
+        if messages:
+            break
+        time.sleep(0.05)
+    return [item['message'] for item in messages]
+
+def test_sendlater_survives_restart(tmp_path):
+    '''
+    test if a message sent later is still delivered after a restart, both
+    when its job was saved in a snapshot and when it was scheduled after it
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel1 = channels_create(user['token'], 'COMP1531', True)
+    channel2 = channels_create(user['token'], 'COMP2521', True)
+    time_sent = int(time.time()) + 2
+    message_sendlater(user['token'], channel1['channel_id'], 'Hello', time_sent)
+    take_snapshot()
+    message_sendlater(user['token'], channel2['channel_id'], 'World', time_sent)
+
+    restart(tmp_path)
+
+    # check both jobs are pending again and are delivered
+    assert [job['deadline'] for job in scheduler.get_pending()] == [time_sent, time_sent]
+    assert wait_for_messages(user['token'], channel1['channel_id']) == ['Hello']
+    assert wait_for_messages(user['token'], channel2['channel_id']) == ['World']
+    close_store()
+
+def test_overdue_sendlater_delivered_once_after_restart(tmp_path):
+    '''
+    test if a message whose time_sent passed while the server was down is
+    delivered straight after the restart, and its delivery is logged so that
+    the job is not run again by the next restart
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    scheduler.pause()
+    message_sendlater(user['token'], channel['channel_id'], 'Hello', int(time.time()) + 1)
+    close_store()
+    clear()
+    time.sleep(1.5)
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # check the overdue message is delivered
+    assert wait_for_messages(user['token'], channel['channel_id']) == ['Hello']
+
+    restart(tmp_path)
+
+    # check the delivery was replayed rather than scheduled again
+    assert scheduler.get_pending() == []
+    assert wait_for_messages(user['token'], channel['channel_id']) == ['Hello']
+    close_store()
+
+def test_password_not_logged(tmp_path):
+    '''
+    test if plain text passwords never reach the write-ahead log
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    auth_register('t.holland@gmail.com', 'secretpassword', 'Tom', 'Holland')
+    auth_login('t.holland@gmail.com', 'secretpassword')
+    close_store()
+
+    # check the password is in none of the files
+    for name in os.listdir(str(tmp_path)):
+        with open(os.path.join(str(tmp_path), name), 'rb') as log_file:
+            assert b'secretpassword' not in log_file.read()
+
+def test_reset_code_not_logged(tmp_path, monkeypatch):
+    '''
+    test if a reset code never reaches the write-ahead log, only its hash
+    '''
+    sent = []
+    class SMTP(object):
+        def __init__(self, host):
+            pass
+        def ehlo(self):
+            pass
+        def login(self, user, password):
+            pass
+        def sendmail(self, sender, receiver, message):
+            sent.append(message)
+        def close(self):
+            pass
+    monkeypatch.setattr(auth.smtplib, 'SMTP_SSL', SMTP)
+
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    auth_register('t.holland@gmail.com', 'secretpassword', 'Tom', 'Holland')
+    auth_passwordreset_request('t.holland@gmail.com')
+    reset_code = re.search(r'Your resetcode is (\w+)', sent[0]).group(1)
+    close_store()
+
+    # check the code is in none of the files
+    for name in os.listdir(str(tmp_path)):
+        with open(os.path.join(str(tmp_path), name), 'rb') as log_file:
+            assert reset_code.encode() not in log_file.read()
+
+def test_recover_partly_written_record(tmp_path):
+    '''
+    test if a record which was only partly written when the server stopped
+    is skipped
+    '''
+    # clear data
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    close_store()
+    segment = sorted(name for name in os.listdir(str(tmp_path)) if name.startswith('wal-'))[-1]
+    with open(os.path.join(str(tmp_path), segment), 'ab') as log_file:
+        log_file.write(b'{"seq": 2, "time": 0, "comm')
+
+    clear()
+    open_store(str(tmp_path), flush_interval=0.01)
+
+    # check the complete record was still replayed
+    assert data['sessions'][user['token']]['u_id'] == user['u_id']
+    close_store()
+    clear()
@@ -0,0 +1,82 @@
+'''
+white-box tests for the job heap in scheduler.py
+'''
+import sys
+sys.path.append('../')
+import time
+import threading
+from auth import auth_register
+from channels import channels_create
+from message import message_sendlater
+from standup import standup_start
+from scheduler import Scheduler, scheduler
+from other import clear
+
+
+def test_jobs_run_in_deadline_order():
+    '''
+    test if the jobs are run by the deadline and not by the order they were
+    scheduled in, and a cancelled job is never run
+    '''
+    # initiate data
+    job_scheduler = Scheduler()
+    results = []
+    done = threading.Event()
+    job_scheduler.register('append', results.append)
+    job_scheduler.register('done', done.set)
+    now = time.time()
+    job_scheduler.schedule('c', now + 0.3, 'append', ['c'])
+    job_scheduler.schedule('a', now + 0.1, 'append', ['a'])
+    job_scheduler.schedule('b', now + 0.2, 'append', ['b'])
+    job_scheduler.schedule('done', now + 0.4, 'done', [])
+
+    assert job_scheduler.cancel('b') == True
+    assert job_scheduler.cancel('b') == False
+    assert [job['key'] for job in job_scheduler.get_pending()] == ['a', 'c', 'done']
+
+    # check the jobs left were run in order
+    assert done.wait(5)
+    assert results == ['a', 'c']
+    assert job_scheduler.get_pending() == []
+
+def test_job_replaced_by_key():
+    '''
+    test if scheduling a job with a key in use replaces the job
+    '''
+    # initiate data
+    job_scheduler = Scheduler()
+    job_scheduler.register('append', lambda item: None)
+    deadline = time.time() + 60
+    job_scheduler.schedule('a', deadline, 'append', ['first'])
+    job_scheduler.schedule('a', deadline, 'append', ['second'])
+
+    # check only the second job is pending
+    assert job_scheduler.get_pending() == [
+        {'key': 'a', 'deadline': deadline, 'kind': 'append', 'args': ['second']}
+    ]
+
+def test_sendlater_and_standup_share_scheduler():
+    '''
+    test if message_sendlater and standup_start schedule jobs instead of
+    starting threads, and clear() cancels them
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    threads = threading.active_count()
+    time_sent = int(time.time()) + 60
+    message = message_sendlater(user['token'], channel['channel_id'], 'Hello', time_sent)
+    standup_start(user['token'], channel['channel_id'], 60)
+
+    # check the pending jobs
+    pending = scheduler.get_pending()
+    assert [job['kind'] for job in pending] == ['message_sendlater', 'standup_finish']
+    assert pending[0]['args'] == [message['message_id'], 'Hello']
+    assert threading.active_count() <= threads + 1
+
+    # clear data
+    clear()
+    assert scheduler.get_pending() == []
@@ -0,0 +1,114 @@
+'''
+white-box tests for the commands applied on the shards by shard.py
+'''
+import sys
+sys.path.append('../')
+import json
+from flask import Flask
+from auth import auth_register
+from data import data
+from error import InputError, AccessError
+from other import clear
+from shard import configure_worker, Router, SECRET_HEADER, COMMANDS_HEADER
+
+
+def make_worker():
+    '''
+    Return a test client of an app configured as the only shard
+    '''
+    app = Flask(__name__)
+    app.testing = True
+    configure_worker(app, 0, 1, 'secret')
+    return app.test_client()
+
+def test_apply_needs_secret():
+    '''
+    test if /shard/apply refuses the commands sent without the secret
+    '''
+    # clear data
+    clear()
+    client = make_worker()
+
+    # initiate data
+    auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    commands = {'commands': [{'time': 0, 'command': 'other.clear', 'args': []}]}
+
+    response = client.post('/shard/apply', json=commands)
+    assert response.status_code == AccessError.code
+    response = client.post('/shard/apply', json=commands, headers={SECRET_HEADER: 'guess'})
+    assert response.status_code == AccessError.code
+    assert len(data['users']) == 1
+
+    response = client.post('/shard/apply', json=commands, headers={SECRET_HEADER: 'secret'})
+    assert response.status_code == 200
+    assert data['users'] == []
+
+def test_apply_directory_commands_only():
+    '''
+    test if /shard/apply only runs the commands of the requests which change
+    the users
+    '''
+    # clear data
+    clear()
+    client = make_worker()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    commands = {'commands': [
+        {'time': 0, 'command': 'auth.auth_logout', 'args': [user['token']]},
+        {'time': 0, 'command': 'channels.channels_create', 'args': [user['token'], 'COMP1531', True]},
+    ]}
+
+    response = client.post('/shard/apply', json=commands, headers={SECRET_HEADER: 'secret'})
+    assert response.status_code == InputError.code
+    # none of them was run
+    assert data['channels'] == []
+    assert len(data['sessions']) == 1
+
+def test_apply_failure_answered():
+    '''
+    test if a command which fails on the shard is answered with an error
+    rather than skipped
+    '''
+    # clear data
+    clear()
+    client = make_worker()
+
+    commands = {'commands': [{'time': 0, 'command': 'auth.auth_logout', 'args': ['bogus']}]}
+    response = client.post('/shard/apply', json=commands, headers={SECRET_HEADER: 'secret'})
+    assert response.status_code == 500
+
+class FailingRouter(Router):
+    '''
+    A router whose shard 0 runs every change, and whose other shards answer
+    /shard/apply with status
+    '''
+    def __init__(self, urls, secret, status):
+        super().__init__(urls, secret)
+        self.status = status
+
+    def send(self, index, method, path, query, body, headers):
+        if index == 0:
+            commands = [{'time': 0, 'command': 'other.clear', 'args': []}]
+            return 200, {COMMANDS_HEADER: json.dumps(commands)}, b'{}'
+        if index == 2:
+            raise OSError('shard 2 can not be reached')
+        return self.status, {}, b'{}'
+
+def test_directory_change_not_applied():
+    '''
+    test if the router answers with an error when a shard did not apply a
+    change to the users, or could not be reached
+    '''
+    router = FailingRouter(['shard0', 'shard1', 'shard2'], 'secret', 200)
+    status, _, body = router.handle('DELETE', '/clear', '', b'', {})
+    assert status == 500
+    assert 'shards [2]' in json.loads(body)['message']
+
+    router = FailingRouter(['shard0', 'shard1'], 'secret', 500)
+    status, _, _ = router.handle('DELETE', '/clear', '', b'', {})
+    assert status == 500
+
+    router = FailingRouter(['shard0', 'shard1'], 'secret', 200)
+    status, _, _ = router.handle('DELETE', '/clear', '', b'', {})
+    assert status == 200
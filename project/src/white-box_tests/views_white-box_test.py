@@ -0,0 +1,91 @@
+'''
+white-box tests for the message payloads of views.py
+'''
+import sys
+sys.path.append('../')
+from auth import auth_register
+from channels import channels_create
+from channel import channel_join, channel_messages
+from message import message_send, message_react, message_edit
+from other import clear, search
+from data import Message
+from views import views, get_message_view
+
+
+def test_payload_shared_between_viewers():
+    '''
+    test if the users reading a message share its payload, each with their
+    own is_this_user_reacted, and reading changes nothing stored
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user1 = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    user2 = auth_register('h.styles@gmail.com', '12345678', 'Harry', 'Styles')
+    channel = channels_create(user1['token'], 'COMP1531', True)
+    channel_join(user2['token'], channel['channel_id'])
+    message_id = message_send(user1['token'], channel['channel_id'], 'Hello')['message_id']
+    message_react(user1['token'], message_id, 1)
+
+    message = Message.load(message_id)
+    view1 = get_message_view(message, user1['u_id'])
+    view2 = get_message_view(message, user2['u_id'])
+    assert view1['reacts'][0]['is_this_user_reacted'] is True
+    assert view2['reacts'][0]['is_this_user_reacted'] is False
+    payload = views.get_payload(message)
+    assert views.get_payload(message) is payload
+    assert 'is_this_user_reacted' not in payload['reacts'][0]
+
+    # the readers of channel_messages and search get the same payloads
+    result1 = channel_messages(user1['token'], channel['channel_id'], 0)
+    result2 = search(user2['token'], 'Hello')
+    assert result1['messages'][0]['reacts'][0]['is_this_user_reacted'] is True
+    assert result2['messages'][0]['reacts'][0]['is_this_user_reacted'] is False
+
+def test_payload_follows_changes():
+    '''
+    test if a payload is made again once its message changes
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_id = message_send(user['token'], channel['channel_id'], 'Hello')['message_id']
+
+    payload = views.get_payload(Message.load(message_id))
+    message_edit(user['token'], message_id, 'Hi')
+    edited = views.get_payload(Message.load(message_id))
+    assert edited is not payload
+    assert (payload['message'], edited['message']) == ('Hello', 'Hi')
+
+    message_react(user['token'], message_id, 2)
+    result = channel_messages(user['token'], channel['channel_id'], 0)
+    assert result['messages'][0]['reacts'][1] == {
+        'react_id': 2,
+        'u_ids': [user['u_id']],
+        'is_this_user_reacted': True,
+    }
+
+def test_payloads_dropped_by_clear():
+    '''
+    test if clear forgets the payloads, as the message_ids and versions
+    start again
+    '''
+    # clear data
+    clear()
+
+    # initiate data
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_send(user['token'], channel['channel_id'], 'Hello')
+    channel_messages(user['token'], channel['channel_id'], 0)
+
+    clear()
+    user = auth_register('t.holland@gmail.com', '12345678', 'Tom', 'Holland')
+    channel = channels_create(user['token'], 'COMP1531', True)
+    message_send(user['token'], channel['channel_id'], 'Bye')
+    result = channel_messages(user['token'], channel['channel_id'], 0)
+    assert [message['message'] for message in result['messages']] == ['Bye']